@@ -0,0 +1,191 @@
+'''
+Streams OCW course files from S3 into Contentful assets and links each asset to its
+courseFile entry.
+'''
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import posixpath
+import time
+import urllib
+import urlparse
+
+from contentful_management.errors import VersionMismatchError, get_error
+from contentful_management.resource import Link
+import requests
+
+from metrics import default_metrics
+from schema import DEFAULT_LOCALE, EntryMapper
+import secure
+
+
+# Content type of the entries assets are linked from, and the field holding the link
+COURSE_FILE = 'courseFile'
+ASSET_FIELD = 'asset'
+
+
+class _ChunkedBody(object):
+    """
+    File-like view of an S3 object body for requests: its length is known up front (so
+    the upload is sent with a Content-Length) and every read returns at most chunk_size
+    bytes, so a transfer never holds more than one chunk of the file.
+    """
+    def __init__(self, body, length, chunk_size):
+        self.body = body
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.body.read(self.chunk_size)
+
+
+class AssetIngester(object):
+    def __init__(self, s3, translate, bucket=None, manifest=None, workers=4, chunk_size=1 << 20,
+                 max_memory=64 << 20, metrics=None):
+        """
+        Creates a Contentful asset for each course file (same id as its courseFile entry)
+        and links it from the entry's asset field. Each S3 object is streamed to the
+        upload endpoint chunk_size bytes at a time, so parallel transfers hold at most
+        workers x chunk_size bytes of file data, which is capped at max_memory.
+
+        With a manifest, the S3 ETag of each ingested object is recorded and objects
+        whose ETag has not changed are skipped without any Contentful request.
+
+        :param s3: boto3 S3 client (works against moto or any local S3 stand-in).
+        :param translate: contentful_mapping.Translate whose client and entries are used.
+        :param bucket: str, bucket holding the course files (defaults to secure.BUCKET).
+        :param manifest: optional manifest.Manifest for skipping unchanged objects.
+        :param workers: int, parallel transfers.
+        :param chunk_size: bytes read from S3 and sent per chunk.
+        :param max_memory: bytes of file data allowed in flight; lowers workers if needed.
+        :param metrics: metrics.Metrics for upload timings (defaults to the translate's).
+        :raises ValueError: if the courseFile content type has no asset field (see README).
+        """
+        self.s3 = s3
+        self.T = translate
+        self.client = translate.client
+        self.bucket = bucket or secure.BUCKET
+        self.manifest = manifest
+        self.chunk_size = chunk_size
+        self.workers = max(1, min(workers, max_memory // chunk_size))
+        self.metrics = metrics or getattr(translate, 'metrics', None) or default_metrics()
+        self.assets_client = self.client.assets(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+        self.upload_url = self.client._url('spaces/{}/uploads'.format(secure.SPACE_ID), file_upload=True)
+        self.scheduler = getattr(self.client, 'scheduler', None)
+        self.session = getattr(self.client, 'session', None) or requests.Session()
+        self.check_content_model()
+
+    def check_content_model(self):
+        """
+        Make sure courseFile entries can link to assets. The OCW content model has no
+        asset field on courseFile until it is added (see "Course file assets" in the README).
+        """
+        mapper = self.T.mapper(COURSE_FILE)
+        if mapper is None:
+            # Validation is off: compile the schema just for this check
+            mapper = EntryMapper(self.T.content_types_client.find(COURSE_FILE).raw)
+        field = mapper.fields.get(ASSET_FIELD)
+        if field is None or field.disabled or field.type != 'Link' or field.link_type != 'Asset':
+            raise ValueError("The {} content type needs an '{}' field linking to an Asset before course files "
+                             "can be ingested; see 'Course file assets' in the README".format(COURSE_FILE, ASSET_FIELD))
+
+    def s3_key(self, record):
+        """
+        Key of a course file in the bucket, from the path of its file_location.
+        """
+        return urllib.unquote(urlparse.urlparse(record['file_location']).path.lstrip('/'))
+
+    def ingest(self, records):
+        """
+        Ingest course files in parallel transfers.
+
+        :param records: iterable of course file records (see Ocw2Contentful.create_course_file).
+        :return: dict counting files per outcome: created, updated or skipped.
+        """
+        counts = Counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for operation in pool.map(self.ingest_file, records):
+                counts[operation] += 1
+        return dict(counts)
+
+    def ingest_file(self, record):
+        """
+        Upload one course file, create or update its asset and link it from the
+        courseFile entry, which must already exist.
+
+        :return: 'created', 'updated' or 'skipped'
+        """
+        uid = record['uid']
+        key = self.s3_key(record)
+        head = self.s3.head_object(Bucket=self.bucket, Key=key)
+        digest = None
+        if self.manifest is not None:
+            digest = self.manifest.digest(self.bucket, key, head['ETag'].strip('"'))
+            if self.manifest.is_current('asset', uid, digest):
+                return 'skipped'
+
+        with self.metrics.step('asset_upload'):
+            upload_id = self.upload(key, head['ContentLength'])
+        with self.metrics.step('asset_save'):
+            operation = self.save_asset(uid, record, key, head, upload_id)
+            link = Link({'sys': {'type': 'Link', 'linkType': 'Asset', 'id': uid}}, client=self.client)
+            self.T.save_entry(self.T.find_entry(uid), {ASSET_FIELD: link})
+
+        if self.manifest is not None:
+            self.manifest.update([('asset', uid, digest)])
+        return operation
+
+    def upload(self, key, length):
+        """
+        Stream an S3 object to the upload endpoint. A retried request reopens the object.
+
+        :return: id of the Contentful upload.
+        """
+        headers = self.client._request_headers()
+        headers.update(self.client.additional_headers)
+        headers['Content-Type'] = 'application/octet-stream'
+
+        def send():
+            body = self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+            try:
+                return self.session.post(self.upload_url, data=_ChunkedBody(body, length, self.chunk_size),
+                                         headers=headers)
+            finally:
+                body.close()
+
+        started = time.time()
+        response = self.scheduler.call(send) if self.scheduler is not None else send()
+        self.metrics.observe_request('contentful', 'POST', 'uploads', response.status_code, time.time() - started)
+        if response.status_code >= 300:
+            raise get_error(response)
+        return response.json()['sys']['id']
+
+    def save_asset(self, uid, record, key, head, upload_id):
+        """
+        Point the asset's file at a finished upload and process it.
+
+        :return: 'created' or 'updated'
+        """
+        fields = {
+            'title': {DEFAULT_LOCALE: record.get('title') or posixpath.basename(key)},
+            'file': {DEFAULT_LOCALE: {
+                'fileName': posixpath.basename(key),
+                'contentType': record.get('file_type') or head.get('ContentType') or 'application/octet-stream',
+                'uploadFrom': {'sys': {'type': 'Link', 'linkType': 'Upload', 'id': upload_id}},
+            }},
+        }
+        if record.get('description'):
+            fields['description'] = {DEFAULT_LOCALE: record['description']}
+
+        try:
+            asset = self.assets_client.create(uid, {'fields': fields})
+            operation = 'created'
+        except VersionMismatchError:
+            # Ingested before: the object changed since
+            asset = self.assets_client.find(uid)
+            asset.update({'fields': fields})
+            operation = 'updated'
+        asset.process()
+        return operation
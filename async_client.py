@@ -0,0 +1,327 @@
+'''
+Asynchronous Contentful Management API client for the entry operations this project
+uses (find, create, update, list), built on tornado coroutines so thousands of entry
+operations can be in flight on one thread.
+'''
+import json
+import time
+import urllib
+
+from contentful_management.utils import snake_case
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from contentful_mapping import JSON_PATCH_TYPE, PATCH_ATTEMPTS, Translate, _comparable, fields_patch
+from schema import EntryMapper
+from metrics import default_metrics, request_resource
+from scheduler import default_scheduler
+
+
+try:
+    import pycurl  # noqa: F401  libcurl keeps connections alive and reuses them
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+except ImportError:
+    pass
+
+
+class AsyncAPIError(Exception):
+    """
+    Non-2xx response from the Management API.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.code
+        self.headers = response.headers
+        super(AsyncAPIError, self).__init__(
+            "HTTP {} for {} {}".format(response.code, response.request.method, response.request.url))
+
+
+class AsyncEntry(object):
+    """
+    Entry returned by AsyncManagementClient. Links to it are built from sys['id'] like
+    for contentful_management entries, and fields() returns the default-locale fields
+    with snake_case names.
+    """
+    def __init__(self, item, default_locale='en-US'):
+        self.raw = item
+        self.default_locale = default_locale
+        self.sys = dict(item['sys'])
+
+    def fields(self):
+        return dict((snake_case(k), v.get(self.default_locale))
+                    for k, v in self.raw.get('fields', {}).items())
+
+    def __repr__(self):
+        return "<AsyncEntry id='{}' version='{}'>".format(self.sys.get('id'), self.sys.get('version'))
+
+
+class AsyncManagementClient(object):
+    def __init__(self, access_token, space_id, environment_id, api_url='api.contentful.com', https=True,
+                 max_clients=200, default_locale='en-US', request_timeout=60, scheduler=None, metrics=None):
+        """
+        Entry operations for one space environment over a shared AsyncHTTPClient. With
+        pycurl installed connections are pooled and kept alive; otherwise tornado's
+        simple client is used with the same concurrency limit.
+
+        :param api_url: host[:port] of the API, e.g. a local fake_contentful.FakeContentful.
+        :param max_clients: requests in flight at once (the rest queue inside the client).
+        :param scheduler: scheduler.RequestScheduler pacing every request (defaults to the
+            process-wide one shared with the sync clients).
+        :param metrics: metrics.Metrics timing each request (defaults to default_metrics()).
+        """
+        self.access_token = access_token
+        self.space_id = space_id
+        self.environment_id = environment_id
+        self.default_locale = default_locale
+        self.request_timeout = request_timeout
+        self.base_url = '{}://{}/spaces/{}/environments/{}'.format(
+            'https' if https else 'http', api_url, space_id, environment_id)
+        self.http = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        self.scheduler = scheduler or default_scheduler()
+        self.metrics = metrics or default_metrics()
+
+    @gen.coroutine
+    def request(self, method, path, body=None, headers=None, query=None):
+        """
+        :return: decoded JSON response body.
+        :raises AsyncAPIError: on any non-2xx status.
+        """
+        url = self.base_url + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        request_headers = {
+            'Authorization': 'Bearer {}'.format(self.access_token),
+            'Content-Type': 'application/vnd.contentful.management.v1+json',
+        }
+        request_headers.update(headers or {})
+        request = HTTPRequest(
+            url, method=method, headers=request_headers,
+            body=json.dumps(body) if body is not None else None,
+            request_timeout=self.request_timeout,
+        )
+        started = time.time()
+        response = yield self.scheduler.call_async(self.http.fetch, request, raise_error=False)
+        self.metrics.observe_request('contentful', method, request_resource(path), response.code,
+                                     time.time() - started)
+        if response.code >= 300 or response.code < 200:
+            raise AsyncAPIError(response)
+        raise gen.Return(json.loads(response.body) if response.body else None)
+
+    @gen.coroutine
+    def find(self, entry_id):
+        item = yield self.request('GET', '/entries/{}'.format(entry_id))
+        raise gen.Return(AsyncEntry(item, self.default_locale))
+
+    @gen.coroutine
+    def create(self, entry_id, attributes):
+        """
+        :param attributes: payload as built by the Translate payload methods
+            ({'content_type_id': ..., 'fields': ...}).
+        """
+        item = yield self.request(
+            'PUT', '/entries/{}'.format(entry_id),
+            body={'fields': attributes.get('fields', {})},
+            headers={'X-Contentful-Content-Type': attributes['content_type_id']},
+        )
+        raise gen.Return(AsyncEntry(item, self.default_locale))
+
+    @gen.coroutine
+    def update(self, entry, fields):
+        """
+        Replace the fields of entry, checked against its current version.
+        """
+        item = yield self.request(
+            'PUT', '/entries/{}'.format(entry.sys['id']),
+            body={'fields': fields},
+            headers={'X-Contentful-Version': str(entry.sys['version'])},
+        )
+        entry.raw = item
+        entry.sys = dict(item['sys'])
+        raise gen.Return(entry)
+
+    @gen.coroutine
+    def patch(self, entry, operations):
+        """
+        Apply JSON Patch operations to entry, checked against its current version.
+        """
+        item = yield self.request(
+            'PATCH', '/entries/{}'.format(entry.sys['id']),
+            body=operations,
+            headers={'X-Contentful-Version': str(entry.sys['version']), 'Content-Type': JSON_PATCH_TYPE},
+        )
+        entry.raw = item
+        entry.sys = dict(item['sys'])
+        raise gen.Return(entry)
+
+    @gen.coroutine
+    def all(self, query=None):
+        """
+        :return: dict with 'items' (AsyncEntry list), 'total', 'skip' and 'limit'.
+        """
+        page = yield self.request('GET', '/entries', query=query or {})
+        page['items'] = [AsyncEntry(item, self.default_locale) for item in page['items']]
+        raise gen.Return(page)
+
+    def close(self):
+        self.http.close()
+
+
+class AsyncTranslate(Translate):
+    def __init__(self, async_client, cache_size=1024, client=None, metrics=None, validate=True, truncate=True):
+        """
+        Translate whose entry methods are coroutines running on AsyncManagementClient.
+        Payloads are mapped exactly as in Translate. Entry attributes may hold futures
+        (e.g. the department entry still being created), which are resolved first, so
+        the Ocw2Contentful create_* methods work unchanged on top of it.
+
+        :param client: optional sync contentful_management.Client for what has no async
+            version (e.g. publish.Publisher); none is built by default.
+        :param metrics: metrics.Metrics timing entry operations (defaults to the async client's).
+        :param validate: see Translate; schemas are fetched with load_mapper.
+        :param truncate: see Translate.
+        """
+        super(AsyncTranslate, self).__init__(cache_size, client=client, metrics=metrics or async_client.metrics,
+                                             validate=validate, truncate=truncate, connect=False)
+        self.async_client = async_client
+        self._pending = dict()  # entry id (or index key) -> future of an in-flight lookup
+
+    @gen.coroutine
+    def index_existing(self, content_type_name, page_size=1000):
+        content_type_id = self.to_camel_case(content_type_name)
+        if content_type_id not in self._existing:
+            key = ('index', content_type_id)
+            if key not in self._pending:
+                self._pending[key] = self._list_ids(content_type_id, page_size)
+            ids = yield self._pending[key]
+            self._existing.setdefault(content_type_id, ids)
+            self._pending.pop(key, None)
+        raise gen.Return(self._existing[content_type_id])
+
+    @gen.coroutine
+    def load_mapper(self, content_type_name):
+        """
+        Fetch and compile the content type's schema once, so the payload methods (which
+        call Translate.mapper synchronously) find it already compiled.
+        """
+        content_type_id = self.to_camel_case(content_type_name)
+        if self.validate and content_type_id not in self._mappers:
+            key = ('schema', content_type_id)
+            if key not in self._pending:
+                self._pending[key] = self.async_client.request('GET', '/content_types/{}'.format(content_type_id))
+            raw = yield self._pending[key]
+            self._mappers.setdefault(content_type_id, EntryMapper(raw, self.truncate))
+            self._pending.pop(key, None)
+
+    @gen.coroutine
+    def _list_ids(self, content_type_id, page_size):
+        ids = set()
+        skip = 0
+        while True:
+            page = yield self.async_client.all({
+                'content_type': content_type_id, 'select': 'sys', 'limit': page_size, 'skip': skip})
+            ids.update(e.sys['id'] for e in page['items'])
+            skip += len(page['items'])
+            if not page['items'] or skip >= page['total']:
+                break
+        raise gen.Return(ids)
+
+    @gen.coroutine
+    def _resolve_attributes(self, entry_attributes):
+        resolved = dict()
+        for k, v in entry_attributes.items():
+            if gen.is_future(v):
+                v = yield v
+            elif isinstance(v, list) and any(gen.is_future(i) for i in v):
+                v = yield [i if gen.is_future(i) else gen.maybe_future(i) for i in v]
+            resolved[k] = v
+        raise gen.Return(resolved)
+
+    @gen.coroutine
+    def _find_or_create(self, content_type_name, entry_uid, entry_attributes, update=False):
+        entry = self.entry_cache.get(entry_uid)
+        if entry is not None and not update:
+            raise gen.Return(entry)
+
+        # Concurrent coroutines asking for the same entry share one lookup
+        if entry_uid in self._pending and not update:
+            entry = yield self._pending[entry_uid]
+            raise gen.Return(entry)
+
+        future = self._pending[entry_uid] = self._fetch_or_create(
+            content_type_name, entry_uid, entry_attributes, update)
+        try:
+            entry = yield future
+        finally:
+            if self._pending.get(entry_uid) is future:
+                del self._pending[entry_uid]
+        raise gen.Return(entry)
+
+    @gen.coroutine
+    def _fetch_or_create(self, content_type_name, entry_uid, entry_attributes, update):
+        existing = yield self.index_existing(content_type_name)
+        yield self.load_mapper(content_type_name)
+        entry_attributes = yield self._resolve_attributes(entry_attributes)
+        entry = self.entry_cache.get(entry_uid)
+
+        if entry_uid in existing:
+            if entry is None:
+                entry = yield self.async_client.find(entry_uid)
+            if update:
+                entry = yield self.patch_entry(entry, getattr(self, content_type_name)(entry_attributes)['fields'])
+        else:
+            print("Creating {}: {}".format(content_type_name, entry_uid))
+            try:
+                entry = yield self.async_client.create(
+                    entry_uid, getattr(self, content_type_name)(entry_attributes))
+            except AsyncAPIError as e:
+                if e.status_code != 409:
+                    raise
+                entry = yield self.async_client.find(entry_uid)
+            self._written(entry)
+            existing.add(entry_uid)
+
+        self.entry_cache.put(entry_uid, entry)
+        raise gen.Return(entry)
+
+    @gen.coroutine
+    def patch_entry(self, entry, fields):
+        """
+        Coroutine version of Translate.patch_entry.
+
+        :return: the entry, updated if any field differed.
+        """
+        for attempt in range(PATCH_ATTEMPTS):
+            operations = fields_patch(entry.raw.get('fields', {}), fields)
+            if not operations:
+                raise gen.Return(entry)
+            print("Updating {}: {}".format(entry.raw['sys']['contentType']['sys']['id'], entry.sys['id']))
+            try:
+                entry = yield self.async_client.patch(entry, operations)
+                self._written(entry)
+                raise gen.Return(entry)
+            except AsyncAPIError as e:
+                if e.status_code != 409 or attempt == PATCH_ATTEMPTS - 1:
+                    raise
+            entry = yield self.async_client.find(entry.sys['id'])
+
+    @gen.coroutine
+    def save_entry(self, entry, changes):
+        """
+        Coroutine version of Translate.save_entry: merge changes into the entry's fields
+        and send a single versioned update, or return the entry unsaved if it already
+        holds those values and links.
+        """
+        started = time.time()
+        stored = entry.fields()
+        if all(_comparable(stored.get(field)) == _comparable(value) for field, value in changes.items()):
+            # Same values and links as stored: nothing to send
+            self.metrics.observe_entry(entry.sys['contentType']['sys']['id'], 'unchanged', time.time() - started)
+            raise gen.Return(entry)
+        fields = dict(entry.raw.get('fields', {}))
+        for field, value in changes.items():
+            fields[self.to_camel_case(field)] = self._set_field_type(value)
+        entry = yield self.async_client.update(entry, fields)
+        self.entry_cache.put(entry.sys['id'], entry)
+        self._written(entry)
+        self.metrics.observe_entry(entry.sys['contentType']['sys']['id'], 'save', time.time() - started)
+        raise gen.Return(entry)
@@ -0,0 +1,278 @@
+'''
+Offline benchmarks for the OCW -> Contentful import, with no network access needed.
+
+The Contentful Management API is a local fake_contentful.FakeContentful with simulated
+latency and rate limits, and S3 is a moto bucket filled with synthetic _master.json
+courses. Requires moto (pip install moto) and a secure.py (copied from secure.py.example).
+
+Usage:
+    python benchmark.py
+    python benchmark.py --courses 20 --pages 40 --files 200 --latency 50 --rate-limit 10 --workers 8
+    python benchmark.py --scenario clean_html --json results.json
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import boto3
+from moto import mock_s3
+
+from fake_contentful import FakeContentful
+from ocw2contentful import DEPARTMENTS_URL, Ocw2Contentful
+from contentful_mapping import Translate
+from html_clean import SAMPLE_PAGE, HtmlCleaner
+from http_cache import HttpCache
+from metrics import Metrics
+from scheduler import RequestScheduler, ScheduledClient
+import secure
+
+
+SCENARIOS = ['get_courseware_metadata', 'add_courseware', 'clean_html']
+
+DEPARTMENTS = [
+    {u'depNo': u'2', u'id': u'mechanical-engineering', u'title': u'Mechanical Engineering'},
+    {u'depNo': u'6', u'id': u'electrical-engineering-and-computer-science',
+     u'title': u'Electrical Engineering and Computer Science'},
+    {u'depNo': u'8', u'id': u'physics', u'title': u'Physics'},
+    {u'depNo': u'18', u'id': u'mathematics', u'title': u'Mathematics'},
+]
+
+
+def synthetic_course(n, pages=20, files=100, media=5, text_size=4000):
+    """
+    A _master.json record shaped like the OCW ones, with unique ids and page texts.
+
+    :param n: course number, makes ids and texts unique across courses.
+    :param text_size: approximate characters of HTML per page.
+    """
+    department = DEPARTMENTS[n % len(DEPARTMENTS)]
+    uid = u'course{:04d}'.format(n)
+    text = SAMPLE_PAGE * max(1, text_size // len(SAMPLE_PAGE))
+    course_pages = [{
+        u'uid': u'{}page{:03d}'.format(uid, i),
+        u'title': u'Page {}'.format(i),
+        u'url': u'/courses/{}/{}/page-{}'.format(department['id'], uid, i),
+        u'text': u'<p>{} page {}</p>'.format(uid, i) + text,
+        u'short_url': u'page-{}'.format(i),
+        u'type': u'CourseSection',
+        u'parent_uid': uid,
+        u'description': u'Page {} of {}'.format(i, uid),
+    } for i in range(pages)]
+    course_files = [{
+        u'uid': u'{}file{:04d}'.format(uid, i),
+        u'caption': None,
+        u'file_type': u'application/pdf',
+        u'file_location': u'https://{}.s3.amazonaws.com/{}/{}file{:04d}_notes.pdf'.format(secure.BUCKET, uid, uid, i),
+        u'title': u'notes{}.pdf'.format(i),
+        u'alt_text': None,
+        u'platform_requirements': None,
+        u'credit': None,
+        u'parent_uid': course_pages[i % pages][u'uid'] if pages else uid,
+        u'description': None,
+    } for i in range(files)]
+    course_embedded_media = dict((u'{}media{:03d}'.format(uid, i), {
+        u'technical_location': u'https://ocw.mit.edu/courses/{}/{}/lecture-{}'.format(department['id'], uid, i),
+        u'inline_embed_id': u'{}media{:03d}'.format(uid, i),
+        u'uid': u'{}media{:03d}'.format(uid, i),
+        u'title': u'Lecture {}'.format(i),
+        u'parent_uid': course_pages[i % pages][u'uid'] if pages else uid,
+        u'embedded_media': [
+            {u'media_info': u'yt{:08d}'.format(n * 1000 + i), u'title': u'Video-YouTube-Stream',
+             u'id': u'Video-YouTube-Stream', u'uid': u'{}media{:03d}yt'.format(uid, i)},
+        ],
+        u'id': u'lecture-{}'.format(i),
+    }) for i in range(media))
+    return {
+        u'uid': uid,
+        u'title': u'Synthetic Course {}'.format(n),
+        u'description': u'<p>Benchmark course {}</p>'.format(n),
+        u'department_number': department['depNo'],
+        u'master_course_number': u'{:03d}'.format(n),
+        u'course_owner': u'nobody',
+        u'url': u'/courses/{}/{}'.format(department['id'], uid),
+        u'instructors': [{
+            u'uid': u'{}instructor{}'.format(uid, i), u'first_name': u'Ada', u'last_name': u'Lovelace{}'.format(i),
+            u'middle_initial': u'', u'suffix': u'', u'title': u'Lovelace{}, Ada'.format(i), u'mit_id': u'',
+            u'department': department['title'], u'directory_title': u'Prof. Ada Lovelace{}'.format(i),
+        } for i in range(2)],
+        u'tags': [{u'name': u'topic {}'.format((n + i) % 50)} for i in range(5)],
+        u'course_pages': course_pages,
+        u'course_files': course_files,
+        u'course_embedded_media': course_embedded_media,
+    }
+
+
+def fill_bucket(s3, courses, **sizes):
+    """
+    Upload synthetic courses (each file object plus the _master.json) to secure.BUCKET.
+
+    :return: list of OCW course URLs, one per course.
+    """
+    s3.create_bucket(Bucket=secure.BUCKET)
+    urls = []
+    for n in range(courses):
+        record = synthetic_course(n, **sizes)
+        prefix = record['uid']
+        for cf in record['course_files']:
+            s3.put_object(Bucket=secure.BUCKET, Key=cf['file_location'].split('.com/')[1], Body=b'')
+        s3.put_object(Bucket=secure.BUCKET, Key='{}/{}_master.json'.format(prefix, prefix),
+                      Body=json.dumps(record).encode('utf-8'))
+        urls.append('https://ocw.mit.edu/courses/{}/{}/'.format(record['url'].split('/')[2], prefix))
+    return urls
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    ordered = sorted(samples)
+    if not ordered:
+        return dict(('p{}'.format(p), None) for p in points)
+    return dict(('p{}'.format(p), ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))])
+                for p in points)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is KB on Linux
+
+
+def _summary(name, unit, timings, elapsed, **extra):
+    result = dict(scenario=name, unit=unit, count=len(timings), seconds=elapsed,
+                  throughput=len(timings) / elapsed if elapsed else None, peak_rss_mb=peak_rss_mb())
+    result.update(('latency_' + k, v) for k, v in percentiles(timings).items())
+    result.update(extra)
+    return result
+
+
+def bench_get_courseware_metadata(ocw, urls):
+    timings = []
+    started = time.time()
+    for url in urls:
+        t = time.time()
+        ocw.get_courseware_metadata(url)
+        timings.append(time.time() - t)
+    return _summary('get_courseware_metadata', 'course', timings, time.time() - started)
+
+
+def bench_add_courseware(ocw, api, urls, workers):
+    timings = []
+    requests_per_course = []
+    started = time.time()
+    for url in urls:
+        before = sum(api.requests.values()) + api.throttled
+        t = time.time()
+        ocw.add_courseware(url, workers=workers)
+        timings.append(time.time() - t)
+        requests_per_course.append(sum(api.requests.values()) + api.throttled - before)
+    elapsed = time.time() - started
+    return _summary('add_courseware', 'course', timings, elapsed,
+                    entries=len(api.entries),
+                    entries_per_second=len(api.entries) / elapsed if elapsed else None,
+                    requests_per_course=float(sum(requests_per_course)) / len(requests_per_course),
+                    requests=dict(('{} {}'.format(*k), v) for k, v in api.requests.items()),
+                    throttled=api.throttled,
+                    scheduler=dict(ocw.T.client.scheduler.stats))
+
+
+def bench_clean_html(ocw, records):
+    texts = [cp['text'] for r in records for cp in r['course_pages']]
+    ocw.html_cleaner = HtmlCleaner()  # start cold: add_courseware has cleaned these pages already
+    timings = []
+    started = time.time()
+    for text in texts:
+        t = time.time()
+        ocw._clean_html(text)
+        timings.append(time.time() - t)
+    return _summary('clean_html', 'page', timings, time.time() - started,
+                    characters=sum(len(t) for t in texts))
+
+
+def run(scenarios=SCENARIOS, courses=10, pages=20, files=100, media=5, text_size=4000,
+        latency=0.02, rate_limit=None, workers=4, metrics=None):
+    """
+    Run the scenarios against a fresh fake API and moto bucket.
+
+    :param latency: seconds added to every fake API request.
+    :param rate_limit: requests per second the fake API allows (None for unlimited).
+    :param metrics: metrics.Metrics collecting step and request timings (a new one by default).
+    :return: list of result dicts, one per scenario.
+    """
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN']:
+        os.environ.setdefault(var, 'benchmark')
+    sizes = dict(pages=pages, files=files, media=media, text_size=text_size)
+    cache_dir = tempfile.mkdtemp(prefix='ocw_benchmark_')
+    api = FakeContentful(secure.SPACE_ID, secure.ENVIRONMENT_ID, latency=latency, rate_limit=rate_limit).start()
+    metrics = metrics or Metrics()
+    results = []
+    try:
+        with mock_s3():
+            s3 = boto3.client('s3', region_name='us-east-1')
+            urls = fill_bucket(s3, courses, **sizes)
+
+            http_cache = HttpCache(cache_dir, offline=True)
+            http_cache.put(DEPARTMENTS_URL, json.dumps(DEPARTMENTS))
+            # Without a rate limit the fake sends no rate headers, so start the scheduler unthrottled
+            scheduler = RequestScheduler(rate=rate_limit or 1000.0)
+            client = ScheduledClient('benchmark', scheduler=scheduler, metrics=metrics,
+                                     api_url=api.host, https=False)
+            ocw = Ocw2Contentful(s3=s3, http_cache=http_cache, translate=Translate(client=client, metrics=metrics),
+                                 metrics=metrics)
+
+            if 'get_courseware_metadata' in scenarios:
+                results.append(bench_get_courseware_metadata(ocw, urls))
+            if 'add_courseware' in scenarios:
+                results.append(bench_add_courseware(ocw, api, urls, workers))
+            if 'clean_html' in scenarios:
+                results.append(bench_clean_html(ocw, [synthetic_course(n, **sizes) for n in range(courses)]))
+    finally:
+        api.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def report(results):
+    for r in results:
+        print("{scenario}: {count} {unit}s in {seconds:.2f}s ({throughput:.1f} {unit}s/s), "
+              "latency p50 {latency_p50:.4f}s p90 {latency_p90:.4f}s p99 {latency_p99:.4f}s, "
+              "peak RSS {peak_rss_mb:.0f} MB".format(**r))
+        if r['scenario'] == 'add_courseware':
+            print("    {entries} entries ({entries_per_second:.1f}/s), {requests_per_course:.1f} requests/course, "
+                  "{throttled} throttled".format(**r))
+            for k in sorted(r['requests']):
+                print("    {:>20}: {}".format(k, r['requests'][k]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (repeatable; default: all)')
+    parser.add_argument('--courses', type=int, default=10)
+    parser.add_argument('--pages', type=int, default=20, help='course pages per course')
+    parser.add_argument('--files', type=int, default=100, help='course files per course')
+    parser.add_argument('--media', type=int, default=5, help='embedded media per course')
+    parser.add_argument('--text-size', type=int, default=4000, help='characters of HTML per page')
+    parser.add_argument('--latency', type=float, default=20, help='fake API latency in ms')
+    parser.add_argument('--rate-limit', type=int, default=None, help='fake API requests per second')
+    parser.add_argument('--workers', type=int, default=4, help='add_courseware thread pool size')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--prometheus', help='write the step and request metrics in Prometheus text format')
+    args = parser.parse_args(argv)
+
+    metrics = Metrics()
+    results = run(args.scenario or SCENARIOS, courses=args.courses, pages=args.pages, files=args.files,
+                  media=args.media, text_size=args.text_size, latency=args.latency / 1000.0,
+                  rate_limit=args.rate_limit, workers=args.workers, metrics=metrics)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(results=results, metrics=metrics.snapshot()), f, indent=2, sort_keys=True)
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f:
+            f.write(metrics.prometheus())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,426 @@
+'''
+Record-and-replay HTTP cassettes: every S3 and Contentful request of an import and its
+response, with timings, so the same traffic can be replayed offline.
+
+Usage:
+    python cassette.py record courses.cassette.gz https://ocw.mit.edu/courses/physics/8-01sc-.../ --workers 8
+    python cassette.py replay courses.cassette.gz --latency recorded --json replay.json
+'''
+import argparse
+import base64
+from collections import deque
+from datetime import timedelta
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+import boto3
+from botocore.awsrequest import AWSResponse
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from contentful_mapping import Translate
+from http_cache import HttpCache
+from metrics import Metrics
+from ocw2contentful import Ocw2Contentful
+from scheduler import LIMIT_HEADER, REMAINING_HEADER, RequestScheduler, ScheduledClient
+import secure
+
+
+# Cassette file format, written in the header line
+FORMAT_VERSION = 1
+# Headers dropped from recorded requests responses: their bodies are stored decoded
+DROPPED_HEADERS = ['content-encoding', 'transfer-encoding', 'content-length']
+
+
+class CassetteMissError(IOError):
+    """
+    Raised in replay mode for a request the cassette has no response to.
+    """
+
+
+class _Body(io.BytesIO):
+    """
+    A stored body read back like an HTTP response's raw stream (by requests and by botocore).
+    """
+    decode_content = True
+
+    def stream(self, amt=1 << 16, decode_content=None):
+        while True:
+            chunk = self.read(amt)
+            if not chunk:
+                break
+            yield chunk
+
+    def release_conn(self):
+        pass
+
+
+def request_key(method, url, body=None, match_body=True):
+    """
+    What a request is matched on: method, URL with its query parameters sorted and, with
+    match_body, a digest of the body (canonical JSON for JSON bodies, 'stream' for bodies
+    sent from a file or generator). Request headers are never stored, so neither are tokens.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    key = [method.upper(), urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))]
+    if match_body:
+        key.append(body_digest(body))
+    return tuple(key)
+
+
+def body_digest(body):
+    if body is None or body in (b'', u''):
+        return None
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if not isinstance(body, str):
+        return 'stream'
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha1(body).hexdigest()
+
+
+class Cassette(object):
+    def __init__(self, path, mode='replay', latency=None, match_body=True, meta=None, drop_headers=()):
+        """
+        A gzipped JSON lines file: a header line with meta, then one line per request with
+        the service, method, URL, body digest, start offset and elapsed seconds (including
+        reading the body), and the response status, headers and body. Recording appends
+        each interaction as it completes; replay serves them from memory.
+
+        Requests with the same key (see request_key) are answered in recorded order, and
+        the last response is repeated once they run out (e.g. extra status polls). Bodies
+        are buffered whole while recording, S3 objects included.
+
+        :param path: cassette file, written in 'record' mode and read in 'replay' mode.
+        :param mode: 'record' or 'replay'.
+        :param latency: in replay, seconds to wait before each response, or 'recorded' to
+            wait as long as the recorded request took (default: no wait).
+        :param match_body: match requests on their bodies as well as method and URL; without
+            it a change to what is written still replays.
+        :param meta: dict stored in the header when recording (e.g. the URLs imported).
+        :param drop_headers: response headers left out in replay (e.g. the rate limit ones).
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError('mode must be record or replay: {}'.format(mode))
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.match_body = match_body
+        self.drop_headers = set(h.lower() for h in drop_headers)
+        self.stats = dict(recorded=0, played=0, repeated=0, misses=0)
+        self.missed = set()
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._queues = dict()  # request key -> deque of interactions not played yet
+        self._last = dict()  # request key -> last interaction played
+        if mode == 'record':
+            self.meta = dict(meta or {}, created=time.time())
+            self._file = gzip.open(path, 'wb')
+            self._file.write(json.dumps(dict(cassette=FORMAT_VERSION, meta=self.meta)) + '\n')
+        else:
+            self._file = None
+            with gzip.open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('cassette') != FORMAT_VERSION:
+                    raise ValueError('Not a version {} cassette: {}'.format(FORMAT_VERSION, path))
+                self.meta = header['meta']
+                for line in f:
+                    interaction = json.loads(line)
+                    key = request_key(interaction['method'], interaction['url'], match_body=False)
+                    if match_body:
+                        key += (interaction['body_digest'],)
+                    self._queues.setdefault(key, deque()).append(interaction)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def unplayed(self):
+        """
+        :return: number of recorded interactions replay has not served (requests no longer made).
+        """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def record(self, service, method, url, body, status, headers, content, started, elapsed, reason=None):
+        """
+        Append one interaction to the cassette.
+
+        :param body: request body (only its digest is kept).
+        :param content: response body, decoded bytes.
+        :param started: time.time() the request was sent.
+        """
+        interaction = dict(service=service, method=method.upper(), url=url, body_digest=body_digest(body),
+                           started=round(started - self._started, 6), elapsed=round(elapsed, 6),
+                           status=status, reason=reason,
+                           headers=dict(headers.items()))
+        try:
+            interaction['body'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body'], interaction['encoding'] = base64.b64encode(content), 'base64'
+        line = json.dumps(interaction, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.stats['recorded'] += 1
+
+    def play(self, method, url, body=None):
+        """
+        :return: (recorded interaction for the request, its response headers, its response
+            body bytes), after the latency wait.
+        """
+        key = request_key(method, url, body, self.match_body)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                interaction = self._last[key] = queue.popleft()
+                self.stats['played'] += 1
+            elif key in self._last:
+                interaction = self._last[key]
+                self.stats['repeated'] += 1
+            else:
+                self.stats['misses'] += 1
+                self.missed.add(key[:2])
+                raise CassetteMissError('Not in the cassette: {} {}'.format(method.upper(), url))
+
+        wait = interaction['elapsed'] if self.latency == 'recorded' else self.latency
+        if wait:
+            time.sleep(wait)
+        headers = dict((k, v) for k, v in interaction['headers'].items() if k.lower() not in self.drop_headers)
+        content = interaction['body']
+        if interaction.get('encoding') == 'base64':
+            return interaction, headers, base64.b64decode(content)
+        return interaction, headers, content.encode('utf-8')
+
+    def session(self, service='contentful'):
+        """
+        :return: requests.Session whose requests are recorded or replayed, for a
+            scheduler.ScheduledClient or an http_cache.HttpCache.
+        """
+        session = requests.Session()
+        adapter = _RecordingAdapter(self, service) if self.mode == 'record' else _ReplayAdapter(self)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def instrument_s3(self, s3):
+        """
+        Record or replay every request of a boto3 S3 client. Requests are still built and
+        signed by botocore; only sending them is replaced, below the retries and event hooks.
+        """
+        endpoint = s3._endpoint
+        endpoint.http_session = _S3Session(self, endpoint.http_session)
+        return s3
+
+
+class _RecordingAdapter(HTTPAdapter):
+    def __init__(self, cassette, service, **kwargs):
+        super(_RecordingAdapter, self).__init__(**kwargs)
+        self.cassette = cassette
+        self.service = service
+
+    def send(self, request, **kwargs):
+        started = time.time()
+        response = super(_RecordingAdapter, self).send(request, **kwargs)
+        content = response.content
+        for header in DROPPED_HEADERS:
+            response.headers.pop(header, None)
+        self.cassette.record(self.service, request.method, request.url, request.body, response.status_code,
+                             response.headers, content, started, time.time() - started, response.reason)
+        # Hand the caller a fresh raw stream of the decoded body (http_cache reads response.raw)
+        response.raw = _Body(content)
+        response._content = False
+        response._content_consumed = False
+        return response
+
+
+class _ReplayAdapter(BaseAdapter):
+    def __init__(self, cassette):
+        super(_ReplayAdapter, self).__init__()
+        self.cassette = cassette
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        interaction, headers, content = self.cassette.play(request.method, request.url, request.body)
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction.get('reason')
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = _Body(content)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = timedelta(seconds=interaction['elapsed'])
+        return response
+
+    def close(self):
+        pass
+
+
+class _S3Session(object):
+    # Stands in for a botocore endpoint's http_session
+    def __init__(self, cassette, http_session):
+        self.cassette = cassette
+        self.http_session = http_session
+
+    def send(self, request):
+        if self.cassette.mode == 'replay':
+            interaction, headers, content = self.cassette.play(request.method, request.url, request.body)
+            return AWSResponse(request.url, interaction['status'], headers, _Body(content))
+        started = time.time()
+        response = self.http_session.send(request)
+        content = response.content
+        self.cassette.record('s3', request.method, request.url, request.body, response.status_code,
+                             response.headers, content, started, time.time() - started)
+        return AWSResponse(request.url, response.status_code, response.headers, _Body(content))
+
+    def close(self):
+        self.http_session.close()
+
+
+def instrumented_ocw(cassette, cache_dir, metrics=None, scheduler=None):
+    """
+    Ocw2Contentful whose S3, Contentful and OCW JSON requests all go through cassette,
+    with an empty HTTP cache in cache_dir so that the OCW JSON is requested too.
+
+    :param scheduler: scheduler.RequestScheduler for the Contentful client (defaults to default_scheduler()).
+    """
+    meta = cassette.meta
+    metrics = metrics or Metrics()
+    s3 = cassette.instrument_s3(boto3.client('s3', region_name=meta['region']))
+    client = ScheduledClient(secure.MANAGEMENT_API_TOKEN, scheduler=scheduler, session=cassette.session(),
+                             metrics=metrics, api_url=meta['api_url'], https=meta['https'])
+    http_cache = HttpCache(cache_dir, session=cassette.session('ocw'))
+    return Ocw2Contentful(s3=s3, http_cache=http_cache, translate=Translate(client=client, metrics=metrics),
+                          metrics=metrics)
+
+
+def _import(ocw, urls, workers):
+    timings = []
+    for url in urls:
+        started = time.time()
+        ocw.add_courseware(url, workers=workers)
+        timings.append(time.time() - started)
+        print("{}: {:.2f}s".format(url, timings[-1]))
+    return timings
+
+
+def record(path, urls, workers=None, api_url='api.contentful.com', https=True, region=None):
+    """
+    Import urls with add_courseware into the space in secure.py, recording every request.
+
+    :return: list of seconds per course.
+    """
+    meta = dict(urls=urls, workers=workers, api_url=api_url, https=https,
+                region=region or boto3.session.Session().region_name, bucket=secure.BUCKET,
+                space_id=secure.SPACE_ID, environment_id=secure.ENVIRONMENT_ID)
+    cache_dir = tempfile.mkdtemp(prefix='ocw_cassette_')
+    try:
+        with Cassette(path, 'record', meta=meta) as cassette:
+            timings = _import(instrumented_ocw(cassette, cache_dir), urls, workers)
+            print("Recorded {} requests to {}".format(cassette.stats['recorded'], path))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return timings
+
+
+def replay(path, latency=None, workers=None, match_body=True, rate=None, metrics=None):
+    """
+    Replay a recorded import with no network: the same courses, bucket and space ids
+    (taken from the cassette, not secure.py) and every response served from the cassette.
+    Requests are paced by the recorded rate limit headers, like the recorded run, unless
+    a rate is given.
+
+    :param workers: add_courseware thread pool size (defaults to the recorded one).
+    :param rate: requests per second for the Contentful scheduler instead of the recorded
+        rate limit (e.g. a large one, to profile the import code alone).
+    :return: result dict with per-course seconds, the cassette stats and the recorded duration.
+    """
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(var, 'replay')  # requests are still signed
+    scheduler = RequestScheduler(rate=rate) if rate else None
+    cassette = Cassette(path, 'replay', latency=latency, match_body=match_body,
+                        drop_headers=[LIMIT_HEADER, REMAINING_HEADER] if rate else ())
+    meta = cassette.meta
+    secure.BUCKET, secure.SPACE_ID, secure.ENVIRONMENT_ID = meta['bucket'], meta['space_id'], meta['environment_id']
+    workers = workers if workers is not None else meta['workers']
+    cache_dir = tempfile.mkdtemp(prefix='ocw_cassette_')
+    try:
+        started = time.time()
+        timings = _import(instrumented_ocw(cassette, cache_dir, metrics, scheduler), meta['urls'], workers)
+        elapsed = time.time() - started
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return dict(cassette=path, latency=latency, workers=workers, rate=rate, seconds=elapsed, course_seconds=timings,
+                unplayed=cassette.unplayed(), missed=sorted(' '.join(k) for k in cassette.missed),
+                **cassette.stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    recorder = commands.add_parser('record', help='import courses and record their requests')
+    recorder.add_argument('cassette')
+    recorder.add_argument('urls', nargs='+', help='OCW course URLs')
+    recorder.add_argument('--workers', type=int, default=None, help='add_courseware thread pool size')
+    recorder.add_argument('--api-url', default='api.contentful.com', help='Contentful Management API host')
+    recorder.add_argument('--no-https', dest='https', action='store_false')
+    recorder.add_argument('--region', help='S3 region (default: from the AWS configuration)')
+    player = commands.add_parser('replay', help='replay a recorded import with no network')
+    player.add_argument('cassette')
+    player.add_argument('--latency', default=None,
+                        help="'recorded', or seconds added to every response (default: none)")
+    player.add_argument('--workers', type=int, default=None, help='default: as recorded')
+    player.add_argument('--rate', type=float, default=None,
+                        help='Contentful requests per second instead of the recorded rate limit')
+    player.add_argument('--ignore-bodies', dest='match_body', action='store_false',
+                        help='match requests on method and URL only')
+    player.add_argument('--json', help='write the result and metrics to this file')
+    player.add_argument('--prometheus', help='write the step and request metrics in Prometheus text format')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        record(args.cassette, args.urls, args.workers, args.api_url, args.https, args.region)
+        return 0
+
+    latency = args.latency if args.latency in (None, 'recorded') else float(args.latency)
+    metrics = Metrics()
+    result = replay(args.cassette, latency, args.workers, args.match_body, args.rate, metrics)
+    print("Replayed {played} requests ({repeated} repeated) in {seconds:.2f}s: "
+          "{misses} misses, {unplayed} recorded requests not made".format(**result))
+    for missed in result['missed']:
+        print("    missed: {}".format(missed))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(result=result, metrics=metrics.snapshot()), f, indent=2, sort_keys=True)
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f:
+            f.write(metrics.prometheus())
+    return 1 if result['misses'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+'''
+Profiles the OCW catalog before a migration: entries, HTML bytes and shared entities per
+department, and the requests and hours an import would take under a rate limit.
+
+Usage:
+    python catalog_profile.py physics mathematics
+    python catalog_profile.py --rate 10 --latency 0.25 --processes 4 --workers 8 --publish
+    python catalog_profile.py --source department --csv courses.csv
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import sys
+
+import numpy as np
+import pandas as pd
+
+import course_record
+from ocw2contentful import DEPARTMENT_URL, Ocw2Contentful
+from ocw_parser import OCW, parse_departments
+
+
+# Per-course columns, in output order
+COLUMNS = ['department', 'course', 'pages', 'files', 'media', 'instructors', 'tags',
+           'linked_pages', 'html_bytes', 'html_max']
+# Content types add_courseware creates once per course record
+COURSE_ENTRIES = ['pages', 'files', 'media']
+# Shared entities, created once for the whole catalog (see Ocw2Contentful.add_shared_entities)
+SHARED = ['department', 'tag', 'instructor']
+# Requests per course file when assets are ingested: upload, asset create, process, entry link
+ASSET_REQUESTS = 4
+# Entries per bulk publish action, each created and then polled at least once
+PUBLISH_BATCH = 200
+
+
+def _identity(item):
+    # Entity id of a department JSON item whose shape is not mapped (uid, name or the item itself)
+    if isinstance(item, dict):
+        return item.get('uid') or item.get('name') or json.dumps(item, sort_keys=True)
+    return item
+
+
+class CatalogProfiler(object):
+    def __init__(self, ocw, workers=8):
+        """
+        Streams every course of the catalog once and keeps a row of counts per course and
+        the ids of the shared entities (departments, tags, instructors) it links to.
+
+        :param ocw: Ocw2Contentful used for the department JSON and the S3 master records.
+        :param workers: int, courses fetched in parallel.
+        """
+        self.ocw = ocw
+        self.workers = workers
+
+    def master_course(self, ocw_url, department_id):
+        """
+        Profile a course from its _master.json, streamed like add_courseware reads it.
+
+        :return: (row dict, list of (kind, entity id) shared entity references)
+        """
+        with self.ocw.open_courseware_metadata(ocw_url) as record:
+            row = dict(department=department_id, course=record['uid'], html_bytes=0, html_max=0)
+            page_uids, parents = set(), set()
+            for page in course_record.stream(record, 'course_pages'):
+                size = len((page.get('text') or u'').encode('utf-8'))
+                row['html_bytes'] += size
+                row['html_max'] = max(row['html_max'], size)
+                page_uids.add(page['uid'])
+            row['pages'] = len(page_uids)
+            for key, column in [('course_files', 'files'), ('course_embedded_media', 'media')]:
+                row[column] = 0
+                for child in course_record.stream(record, key):
+                    row[column] += 1
+                    parents.add(child.get('parent_uid'))
+            row['linked_pages'] = len(parents & page_uids)
+            row['instructors'] = len(record.get('instructors') or [])
+            row['tags'] = len(record.get('tags') or [])
+
+            departments, tags, instructors = dict(), dict(), dict()
+            self.ocw._collect_shared(record, departments, tags, instructors)
+        refs = ([('department', uid) for uid in departments] + [('tag', uid) for uid in tags] +
+                [('instructor', uid) for uid in instructors])
+        return row, refs
+
+    def department_course(self, course, department_id):
+        """
+        Profile a course from its department JSON (ocw_parser.OCW record). Without the
+        master record there are no page texts, so HTML sizes are unknown (NaN).
+
+        :return: (row dict, list of (kind, entity id) shared entity references)
+        """
+        pages = course.get('course_section_and_tlp_urls') or []
+        row = dict(department=department_id, course=course.get('course_path'),
+                   pages=len(pages), files=len(course.get('pdf_list') or []),
+                   media=len(course.get('media_resources') or []),
+                   instructors=len(course.get('faculty') or []), tags=len(course.get('course_topics') or []),
+                   linked_pages=len(pages), html_bytes=np.nan, html_max=np.nan)
+        refs = ([('department', department_id)] +
+                [('tag', _identity(t)) for t in course.get('course_topics') or []] +
+                [('instructor', _identity(f)) for f in course.get('faculty') or []])
+        return row, refs
+
+    def scan(self, department_ids=None, source='master'):
+        """
+        Profile every course of the given departments (all by default).
+
+        :param source: 'master' for the S3 master records (what add_courseware imports),
+            'department' for the department JSON only (no S3 access, no HTML sizes).
+        :return: (courses DataFrame with COLUMNS, refs DataFrame with department, course, kind, entity)
+        """
+        if department_ids is None:
+            department_ids = [self.ocw.departments_by_num[n]['id'] for n in sorted(self.ocw.departments_by_num)]
+        rows, refs = [], []
+
+        def add(result):
+            row, course_refs = result
+            rows.append(row)
+            refs.extend((row['department'], row['course'], kind, entity) for kind, entity in course_refs)
+
+        if source == 'department':
+            # Every department parsed at once, across all cores
+            urls = [DEPARTMENT_URL.format(department_id) for department_id in department_ids]
+            department_by_url = dict(zip(urls, department_ids))
+            for url, ocw_uid, course in parse_departments(urls, http_cache=self.ocw.http_cache):
+                add(self.department_course(course, department_by_url[url]))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for department_id in department_ids:
+                    with OCW(DEPARTMENT_URL.format(department_id), stream=True,
+                             http_cache=self.ocw.http_cache) as department:
+                        urls = [course['course_path'] for ocw_uid, course in department.iter_courses()]
+                    # A bounded window of courses in flight, like Ocw2Contentful._scan_catalog
+                    batch = 4 * self.workers
+                    for i in range(0, len(urls), batch):
+                        for result in pool.map(lambda url: self.master_course(url, department_id),
+                                               urls[i:i + batch]):
+                            add(result)
+                    print("Profiled {}: {} courses".format(department_id, len(urls)))
+
+        courses = pd.DataFrame(rows, columns=COLUMNS)
+        return courses, pd.DataFrame(refs, columns=['department', 'course', 'kind', 'entity'])
+
+
+def summarize(courses, refs):
+    """
+    Per-department totals and distributions, plus a 'total' row for the whole catalog.
+
+    :return: DataFrame indexed by department: course count, sums and p50/p90/max of the
+        per-course counts and HTML sizes, and for each shared kind the references, unique
+        entities, entities also used by other departments, and new entities (first seen
+        in the department, so the new counts add up to the catalog's unique entities).
+    """
+    unique = refs.drop_duplicates(['department', 'kind', 'entity'])
+    spread = unique.groupby(['kind', 'entity']).size().rename('departments').reset_index()
+    first = refs.drop_duplicates(['kind', 'entity'])
+    catalog = [frame.assign(department='total') for frame in (courses, refs, first)]
+    return pd.concat([_summary(courses, refs, first, spread), _summary(*catalog + [spread])], sort=False)
+
+
+def _summary(courses, refs, first, spread):
+    grouped = courses.groupby('department')
+    summary = pd.DataFrame({'courses': grouped.size()})
+    for column in COURSE_ENTRIES + ['instructors', 'tags', 'linked_pages', 'html_bytes']:
+        summary[column] = grouped[column].sum(min_count=1)
+    for column in ['pages', 'files', 'html_bytes']:
+        summary[column + '_p50'] = grouped[column].quantile(0.5)
+        summary[column + '_p90'] = grouped[column].quantile(0.9)
+        summary[column + '_max'] = grouped[column].max()
+    summary['html_max'] = grouped['html_max'].max()
+
+    unique = refs.drop_duplicates(['department', 'kind', 'entity']).merge(spread, on=['kind', 'entity'])
+    for kind in SHARED:
+        of_kind = unique[unique['kind'] == kind]
+        counts = [
+            (kind + '_refs', refs[refs['kind'] == kind]),
+            (kind + '_unique', of_kind),
+            (kind + '_shared', of_kind[of_kind['departments'] > 1]),
+            (kind + '_new', first[first['kind'] == kind]),
+        ]
+        for column, frame in counts:
+            summary[column] = frame.groupby('department').size().reindex(summary.index).fillna(0)
+    return summary
+
+
+def project(summary, rate=10.0, latency=0.25, concurrency=32, publish=False, assets=False):
+    """
+    Project the requests and wall-clock time of importing each department into an empty
+    space with add_catalog: one create per course, page, file and media entry and per new
+    shared entity, one save for the courseware and for every page that files or media
+    link to, plus bulk publishing and asset ingestion if asked for. Time is bounded both
+    by the space's rate limit and by concurrency requests of the given latency in flight.
+
+    :param summary: DataFrame from summarize.
+    :param rate: requests per second allowed by the rate limit.
+    :param latency: seconds per request.
+    :param concurrency: requests in flight (processes x workers).
+    :return: copy of summary with entries, requests, seconds and hours columns.
+    """
+    projected = summary.copy()
+    projected['entries'] = (projected['courses'] + projected[COURSE_ENTRIES].sum(axis=1) +
+                            projected[[kind + '_new' for kind in SHARED]].sum(axis=1))
+    projected['creates'] = projected['entries']
+    projected['saves'] = projected['courses'] + projected['linked_pages']
+    projected['publishes'] = 2 * np.ceil(projected['entries'] / float(PUBLISH_BATCH)) if publish else 0
+    projected['asset_requests'] = ASSET_REQUESTS * projected['files'] if assets else 0
+    projected['requests'] = projected[['creates', 'saves', 'publishes', 'asset_requests']].sum(axis=1)
+    projected['seconds'] = np.maximum(projected['requests'] / float(rate),
+                                      projected['requests'] * latency / float(concurrency))
+    projected['hours'] = projected['seconds'] / 3600.0
+    return projected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('departments', nargs='*', help='OCW department ids, e.g. physics (default: all)')
+    parser.add_argument('--source', choices=['master', 'department'], default='master',
+                        help='S3 master records, or the department JSON only (no HTML sizes)')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='courses fetched in parallel')
+    parser.add_argument('--rate', type=float, default=10.0, help='rate limit, requests per second')
+    parser.add_argument('--latency', type=float, default=0.25, help='seconds per request')
+    parser.add_argument('--processes', type=int, default=1, help='import processes (see catalog_runner.py)')
+    parser.add_argument('--workers', type=int, default=4, help='threads per course import')
+    parser.add_argument('--publish', action='store_true', help='include bulk publishing')
+    parser.add_argument('--assets', action='store_true', help='include asset ingestion of course files')
+    parser.add_argument('--csv', help='write the per-course rows to this CSV file')
+    parser.add_argument('--json', help='write the per-department projection to this JSON file')
+    args = parser.parse_args(argv)
+
+    profiler = CatalogProfiler(Ocw2Contentful(), args.fetch_workers)
+    courses, refs = profiler.scan(args.departments or None, args.source)
+    if args.csv:
+        courses.to_csv(args.csv, index=False)
+    concurrency = args.processes * args.workers
+    projected = project(summarize(courses, refs), args.rate, args.latency, concurrency, args.publish, args.assets)
+    if args.json:
+        projected.to_json(args.json, orient='index')
+
+    pd.set_option('display.width', 200)
+    print(projected[['courses', 'entries', 'html_bytes', 'pages_p90', 'files_p90', 'tag_shared',
+                     'instructor_shared', 'requests', 'hours']].to_string())
+    # Little's law: requests in flight needed to use the whole rate limit
+    print("Concurrency {} ({} processes x {} workers); the rate limit is reached at {} requests in flight.".format(
+        concurrency, args.processes, args.workers, int(math.ceil(args.rate * args.latency))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
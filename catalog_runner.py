@@ -0,0 +1,359 @@
+'''
+Multi-process catalog migration: courses go into a SQLite work queue and worker processes lease them.
+
+Usage:
+    python catalog_runner.py --processes 8
+    python catalog_runner.py physics mathematics --journal ocw_journal.sqlite
+    python catalog_runner.py --resume
+    python catalog_runner.py physics --publish
+    python catalog_runner.py --mirror ocw_mirror.sqlite
+'''
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue(object):
+    def __init__(self, path='ocw_queue.sqlite', lease_seconds=600, max_attempts=3):
+        """
+        Course URLs waiting to be imported, shared by worker processes through SQLite.
+        A worker leases a course for lease_seconds and renews the lease with heartbeat()
+        while it works; a lease that runs out (e.g. its process died) makes the course
+        available again. Failed courses are retried until max_attempts leases were used.
+
+        Every process opens its own WorkQueue on the same file.
+
+        :param path: SQLite database file (created if missing).
+        :param lease_seconds: seconds a lease lasts without a heartbeat.
+        :param max_attempts: leases a course gets before it is marked failed.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit, so lease() can take the write lock itself with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS courses ('
+            'url TEXT PRIMARY KEY, department TEXT, state TEXT NOT NULL, worker TEXT, '
+            'lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)'
+        )
+        self._lock = threading.Lock()
+
+    def add(self, courses):
+        """
+        Queue courses that are not queued yet.
+
+        :param courses: iterable of (url, department id) tuples.
+        :return: number of courses added.
+        """
+        rows = [(url, department, PENDING) for url, department in courses]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany('INSERT OR IGNORE INTO courses (url, department, state) VALUES (?, ?, ?)', rows)
+            self._db.execute('COMMIT')
+            return self._db.total_changes - before
+
+    def lease(self, worker):
+        """
+        Take the next pending course, or one whose lease expired.
+
+        :return: course URL, or None if nothing is available right now.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._expire(now)
+                row = self._db.execute(
+                    'SELECT url FROM courses WHERE attempts < ? AND '
+                    '(state = ? OR (state = ? AND lease_until < ?)) ORDER BY attempts, rowid LIMIT 1',
+                    (self.max_attempts, PENDING, LEASED, now)).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        'UPDATE courses SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 '
+                        'WHERE url = ?', (LEASED, worker, now + self.lease_seconds, row[0]))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return row[0] if row is not None else None
+
+    def _expire(self, now):
+        # A lease that ran out on its last attempt fails the course
+        self._db.execute(
+            'UPDATE courses SET state = ?, error = ? WHERE state = ? AND lease_until < ? AND attempts >= ?',
+            (FAILED, 'lease expired', LEASED, now, self.max_attempts))
+
+    def heartbeat(self, url, worker):
+        """
+        Extend a lease.
+
+        :return: False if the lease was lost to another worker.
+        """
+        return self._update_leased(url, worker, 'lease_until = ?', (time.time() + self.lease_seconds,))
+
+    def complete(self, url, worker):
+        return self._update_leased(url, worker, 'state = ?, lease_until = NULL, error = NULL', (DONE,))
+
+    def release(self, url, worker, error=None):
+        """
+        Give a course back after a failure: pending again, or failed once it used max_attempts.
+        """
+        return self._update_leased(
+            url, worker,
+            'state = CASE WHEN attempts < ? THEN ? ELSE ? END, lease_until = NULL, error = ?',
+            (self.max_attempts, PENDING, FAILED, error))
+
+    def _update_leased(self, url, worker, assignments, values):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE courses SET {} WHERE url = ? AND worker = ? AND state = ?'.format(assignments),
+                tuple(values) + (url, worker, LEASED))
+            return cursor.rowcount == 1
+
+    def retry_failed(self):
+        """
+        Make failed courses pending again with fresh attempts.
+
+        :return: number of courses requeued.
+        """
+        with self._lock:
+            return self._db.execute(
+                'UPDATE courses SET state = ?, attempts = 0 WHERE state = ?', (PENDING, FAILED)).rowcount
+
+    def progress(self):
+        """
+        :return: dict with the number of courses per state (pending, leased, done, failed).
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            counts = dict(self._db.execute('SELECT state, COUNT(*) FROM courses GROUP BY state'))
+            # Expired leases of dead workers are pending work
+            expired = self._db.execute(
+                'SELECT COUNT(*) FROM courses WHERE state = ? AND lease_until < ?', (LEASED, now)).fetchone()[0]
+        result = dict((state, counts.get(state, 0)) for state in (PENDING, LEASED, DONE, FAILED))
+        result[PENDING] += expired
+        result[LEASED] -= expired
+        return result
+
+    def failures(self):
+        """
+        :return: list of (url, error) for failed courses.
+        """
+        with self._lock:
+            return list(self._db.execute('SELECT url, error FROM courses WHERE state = ?', (FAILED,)))
+
+    def finished(self):
+        """
+        True when no course is pending or leased.
+        """
+        progress = self.progress()
+        return not progress[PENDING] and not progress[LEASED]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM courses').fetchone()[0]
+
+
+def enqueue_catalog(ocw, queue, department_ids=None):
+    """
+    Queue every course of the given departments (all departments by default).
+
+    :param ocw: Ocw2Contentful used to read the department JSON.
+    :return: number of courses added.
+    """
+    if department_ids is None:
+        department_ids = [ocw.departments_by_num[n]['id'] for n in sorted(ocw.departments_by_num)]
+    added = 0
+    for department_id in department_ids:
+        added += queue.add((url, department_id) for url in ocw.catalog_urls([department_id]))
+    return added
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renews a lease every third of the lease time while a course is imported. Once the
+    lease is lost, lost is set and the course belongs to whichever worker leases it next.
+    """
+    def __init__(self, queue, url, worker):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.url = url
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3.0):
+            if not self.queue.heartbeat(self.url, self.worker):
+                print("Lost lease on {}".format(self.url))
+                self.lost.set()
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(queue_path, options, ocw_factory=None):
+    """
+    Worker process: lease courses and import them with add_courseware until the queue is finished.
+
+    With options['mirror'], the workers share a mirror.SpaceMirror, so they start
+    without listing or reading existing entries.
+
+    With options['publish'], the entries each process writes are published in bulk
+    actions (see publish.Publisher) whenever a full batch is queued, and once more
+    before the process exits.
+
+    :param options: dict with workers, journal, manifest, mirror, publish, lease_seconds, max_attempts and poll.
+    :param ocw_factory: callable returning the Ocw2Contentful to use (a new default one by default).
+    :return: number of courses completed.
+    """
+    from journal import Journal
+    from manifest import Manifest
+    from mirror import SpaceMirror
+    from ocw2contentful import Ocw2Contentful
+
+    worker = '{}-{}'.format(os.uname()[1], os.getpid())
+    queue = WorkQueue(queue_path, options['lease_seconds'], options['max_attempts'])
+    journal = Journal(options['journal']) if options.get('journal') else None
+    manifest = Manifest(options['manifest']) if options.get('manifest') else None
+    ocw = ocw_factory() if ocw_factory else Ocw2Contentful()
+    if options.get('mirror'):
+        ocw.T.mirror = SpaceMirror(options['mirror'])
+    publisher = None
+    if options.get('publish'):
+        from publish import Publisher
+        publisher = Publisher(ocw.T)
+
+    completed = 0
+    while True:
+        url = queue.lease(worker)
+        if url is None:
+            if queue.finished():
+                if publisher is not None:
+                    _publish(publisher)
+                return completed
+            time.sleep(options['poll'])
+            continue
+
+        heartbeat = _Heartbeat(queue, url, worker)
+        heartbeat.start()
+        try:
+            ocw.add_courseware(url, workers=options['workers'], manifest=manifest, journal=journal)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        heartbeat.stop()
+        if heartbeat.lost.is_set():
+            # Neither done nor given back: the worker now leasing the course decides
+            print("Dropped {}: lease lost".format(url))
+            continue
+        if error is not None:
+            print("Failed: {}\n{}".format(url, error))
+            queue.release(url, worker, error)
+        elif queue.complete(url, worker):
+            completed += 1
+            if publisher is not None and len(publisher) >= publisher.batch_size:
+                _publish(publisher)
+
+
+def _publish(publisher):
+    result = publisher.publish()
+    print("Published {} entries.".format(result['published']))
+    for entry_uid, error in sorted(result['failed'].items()):
+        print("Publish failed: {} ({})".format(entry_uid, error))
+
+
+def run(queue_path, processes=None, report_every=10.0, ocw_factory=None, **options):
+    """
+    Start worker processes on a filled queue and report aggregate progress until they exit.
+
+    :param processes: int, worker processes (defaults to one per core).
+    :param report_every: seconds between progress lines.
+    :param ocw_factory: passed to work() (must be picklable on platforms without fork).
+    :param options: see work(); missing ones take the command line defaults.
+    :return: final progress dict (see WorkQueue.progress).
+    """
+    options = dict(dict(workers=4, journal=None, manifest=None, mirror=None, publish=False, lease_seconds=600,
+                        max_attempts=3, poll=1.0),
+                   **options)
+    queue = WorkQueue(queue_path, options['lease_seconds'], options['max_attempts'])
+    processes = processes or multiprocessing.cpu_count()
+    pool = [multiprocessing.Process(target=work, args=(queue_path, options, ocw_factory))
+            for _ in range(processes)]
+    for p in pool:
+        p.start()
+
+    started = time.time()
+    total = len(queue)
+    while any(p.is_alive() for p in pool):
+        reported = time.time()
+        while time.time() - reported < report_every and any(p.is_alive() for p in pool):
+            time.sleep(min(1.0, report_every))
+        progress = queue.progress()
+        elapsed = time.time() - started
+        rate = progress[DONE] / elapsed if elapsed else 0.0
+        print("{done}/{total} done, {leased} in progress, {failed} failed, {pending} pending "
+              "({rate:.2f} courses/s, {alive} processes)".format(
+                  total=total, rate=rate, alive=sum(p.is_alive() for p in pool), **progress))
+    for p in pool:
+        p.join()
+    return queue.progress()
+
+
+def main(argv=None):
+    from mirror import SpaceMirror
+    from ocw2contentful import Ocw2Contentful
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('departments', nargs='*', help='OCW department ids, e.g. physics (default: all)')
+    parser.add_argument('--queue', default='ocw_queue.sqlite', help='work queue database')
+    parser.add_argument('--resume', action='store_true', help='work on the existing queue without enumerating courses')
+    parser.add_argument('--retry-failed', action='store_true', help='requeue courses that failed before')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='worker processes')
+    parser.add_argument('--workers', type=int, default=4, help='threads per course import')
+    parser.add_argument('--journal', help='checkpoint journal shared by the workers (see journal.py)')
+    parser.add_argument('--manifest', help='content hash manifest shared by the workers (see manifest.py)')
+    parser.add_argument('--mirror', help='local mirror of the space, synced before the workers start (see mirror.py)')
+    parser.add_argument('--publish', action='store_true', help='publish imported entries in bulk actions')
+    parser.add_argument('--lease-seconds', type=int, default=600, help='lease time without a heartbeat')
+    parser.add_argument('--max-attempts', type=int, default=3, help='leases per course before it fails')
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.queue, args.lease_seconds, args.max_attempts)
+    if not args.resume:
+        added = enqueue_catalog(Ocw2Contentful(), queue, args.departments or None)
+        print("Queued {} courses ({} in the queue).".format(added, len(queue)))
+    if args.retry_failed:
+        print("Requeued {} failed courses.".format(queue.retry_failed()))
+    if args.mirror:
+        synced = SpaceMirror(args.mirror).sync()
+        print("Mirror synced: {updated} entries updated, {deleted} deleted.".format(**synced))
+
+    progress = run(args.queue, args.processes, workers=args.workers, journal=args.journal,
+                   manifest=args.manifest, mirror=args.mirror, publish=args.publish,
+                   lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    for url, error in queue.failures():
+        print("Failed: {}\n{}".format(url, error))
+    return 1 if progress[FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
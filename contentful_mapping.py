@@ -1,120 +1,540 @@
 '''
 Stores the content model mappings we populate with OCW content.
 '''
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
 import contentful_management
+from contentful_management.errors import VersionMismatchError, get_error
+from contentful_management.resource import Link
+from contentful_management.resource_builder import ResourceBuilder
 
+from metrics import default_metrics
+from scheduler import ScheduledClient
+from schema import MAX_LENGTH, EntryMapper, to_camel_case
 import secure
 
 
+# Translate payload method -> content type id
+CONTENT_TYPE_IDS = dict((name, to_camel_case(name)) for name in [
+    'courseware', 'instructor', 'tag', 'department', 'course_page', 'course_file', 'embedded_media'])
+
+# Tries of a field-level update whose entry changed in between (409) before giving up
+PATCH_ATTEMPTS = 3
+JSON_PATCH_TYPE = 'application/json-patch+json'
+# Limits for payloads mapped without a schema (validate=False, or an export without a content
+# model): Text fields of the OCW content model, and Symbol fields with a size validation;
+# every other text field is a Symbol of at most MAX_LENGTH['Symbol'] characters
+TEXT_FIELDS = frozenset(['description', 'text', 'imageDescription', 'imageCaption', 'thumbnailImageDescription',
+                         'otherInformationText', 'highlightsText', 'altText', 'credit'])
+SYMBOL_SIZES = {'technicalLocation': 250, 'VideoYoutubeStream': 200}
+
+
+def _pointer(token):
+    return token.replace('~', '~0').replace('/', '~1')
+
+
+def _comparable(value):
+    # Links and entries compare by id, as do raw link JSON (async_client.AsyncEntry fields)
+    if hasattr(value, 'sys'):
+        return value.sys['id']
+    if isinstance(value, dict) and 'sys' in value:
+        return value['sys']['id']
+    if isinstance(value, list):
+        return [_comparable(v) for v in value if v]
+    return value
+
+
+def fields_patch(current, fields):
+    """
+    JSON Patch operations that bring an entry's stored fields to the mapped ones,
+    touching only the fields that differ. Fields the payload does not mention are left
+    alone (e.g. links saved later by a UnitOfWork).
+
+    :param current: stored fields, {fieldId: {locale: value}}.
+    :param fields: mapped payload fields, {fieldId: {locale: value} or None (empty)}.
+    :return: list of add/replace/remove operations, empty if nothing changed.
+    """
+    operations = []
+    for field_id in sorted(fields):
+        value = fields[field_id]
+        path = '/fields/' + _pointer(field_id)
+        if value is None:
+            if field_id in current:
+                operations.append({'op': 'remove', 'path': path})
+        elif field_id not in current:
+            operations.append({'op': 'add', 'path': path, 'value': value})
+        elif current[field_id] != value:
+            operations.append({'op': 'replace', 'path': path, 'value': value})
+    return operations
+
+
+def _link_json(value):
+    link_type = value.sys.get('link_type') or value.sys.get('linkType') or value.sys.get('type') or 'Entry'
+    return {'sys': {'type': 'Link', 'linkType': link_type, 'id': value.sys['id']}}
+
+
+class EntryCache(object):
+    """
+    Size-bounded LRU of Contentful Entry objects keyed by entry id. Shared entries
+    (departments, tags) are looked up once per run instead of once per course.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entry_uid):
+        with self._lock:
+            entry = self._entries.pop(entry_uid, None)
+            if entry is not None:
+                self._entries[entry_uid] = entry
+            return entry
+
+    def put(self, entry_uid, entry):
+        with self._lock:
+            self._entries.pop(entry_uid, None)
+            self._entries[entry_uid] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, entry_uid):
+        return entry_uid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UnitOfWork(object):
+    """
+    Collects field and link changes per entry during a course import. Nothing is sent
+    until flush(), which saves each changed entry exactly once through
+    Translate.save_entry with all of its links merged.
+    """
+    def __init__(self, translate):
+        self.translate = translate
+        self._entries = dict()  # entry id -> Entry
+        self._changes = OrderedDict()  # entry id -> {field: value}
+        self._lock = threading.Lock()
+
+    def set(self, entry, field, value):
+        """
+        Replace the value of a field on entry.
+        """
+        with self._lock:
+            self._changes_for(entry)[field] = value
+
+    def add_links(self, entry, field, links):
+        """
+        Append links to a multi-reference field on entry, skipping ids already linked
+        during this unit of work.
+        """
+        with self._lock:
+            changes = self._changes_for(entry)
+            current = changes.setdefault(field, [])
+            seen = set(l.sys['id'] for l in current)
+            for link in links:
+                if link.sys['id'] not in seen:
+                    seen.add(link.sys['id'])
+                    current.append(link)
+
+    def flush(self, executor=None, on_save=None):
+        """
+        Save every dirty entry once.
+
+        :param executor: optional object with submit() (e.g. a ThreadPoolExecutor) used to run the saves.
+        :param on_save: optional callable run with each Entry as soon as it is saved.
+        :return: list of saved Entry objects.
+        """
+        with self._lock:
+            pending = [(self._entries[k], v) for k, v in self._changes.items()]
+            self._changes.clear()
+
+        save = self.translate.save_entry
+        if on_save is not None:
+            def save(entry, changes):
+                entry = self.translate.save_entry(entry, changes)
+                on_save(entry)
+                return entry
+
+        if executor is None:
+            return [save(entry, changes) for entry, changes in pending]
+        futures = [executor.submit(save, entry, changes) for entry, changes in pending]
+        return [f.result() for f in futures]
+
+    def _changes_for(self, entry):
+        entry_uid = entry.sys['id']
+        self._entries[entry_uid] = entry
+        return self._changes.setdefault(entry_uid, dict())
+
+    def __len__(self):
+        return len(self._changes)
+
+
+def _truncate_unmapped(fields):
+    """
+    Cut the text of fields mapped without a schema to the content model's limits.
+    """
+    for field_id, value in fields.items():
+        if value and isinstance(value['en-US'], unicode):
+            if field_id in TEXT_FIELDS:
+                limit = MAX_LENGTH['Text']
+            else:
+                limit = SYMBOL_SIZES.get(field_id, MAX_LENGTH['Symbol'])
+            value['en-US'] = value['en-US'][:limit]
+
+
 class Translate(object):
-    def __init__(self):
+    def __init__(self, cache_size=1024, client=None, metrics=None, validate=True, truncate=True, mirror=None,
+                 connect=True):
         '''
         Must be called with a department already set.
+
+        :param cache_size: maximum number of Entry objects kept in the LRU cache.
+        :param client: optional contentful_management.Client (e.g. one pointed at a local fake API);
+            defaults to a scheduler.ScheduledClient sharing the process-wide rate limits.
+        :param metrics: metrics.Metrics timing entry operations per content type (defaults to default_metrics()).
+        :param validate: map payloads with mappers compiled from the space's content types and
+            check them locally, so invalid entries fail before any create request.
+        :param truncate: cut text longer than its field allows instead of failing validation.
+        :param mirror: mirror.SpaceMirror answering which entries exist, and their versions,
+            links and short fields, without requests; every write is recorded in it.
+        :param connect: build the default client when none is given; False leaves client
+            None for subclasses that send through their own client (async_client.AsyncTranslate)
+            or none at all (export.ExportTranslate).
         '''        
-        self.client = contentful_management.Client(secure.MANAGEMENT_API_TOKEN)
-        self.entries_client = self.client.entries(secure.SPACE_ID, secure.ENVIRONMENT_ID)
-        self.content_types_client = self.client.content_types(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+        self.metrics = metrics or default_metrics()
+        self.client = client
+        if client is None and connect:
+            self.client = ScheduledClient(secure.MANAGEMENT_API_TOKEN, metrics=self.metrics)
+        self.entries_client = self.content_types_client = None
+        if self.client is not None:
+            self.entries_client = self.client.entries(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+            self.content_types_client = self.client.content_types(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+        self.entry_cache = EntryCache(cache_size)
+        self._existing = dict()  # content_type_id -> set of entry ids already in the space
+        self._lock = threading.Lock()
+        self._uid_locks = dict()  # key -> [Lock, callers holding or waiting], see _keyed_lock
+        self.validate = validate
+        self.truncate = truncate
+        self._mappers = dict()  # content_type_id -> schema.EntryMapper
+        self.mirror = mirror
+        self._partial = set()  # ids of cached entries built from the mirror (see mirror.mirrored_fields)
+        # Called with every Entry this Translate creates, patches or saves (see publish.Publisher)
+        self.on_write = None
         return None
+
+    def index_existing(self, content_type_name, page_size=1000):
+        """
+        Return the ids of every entry of a content type in the space, listing them
+        once with paginated bulk requests (sys only) and reusing the result afterwards.
+        With a mirror, the ids are read from it instead.
+
+        :param content_type_name: str naming a payload method, e.g. 'course_page'.
+        :param page_size: entries requested per page (Contentful allows up to 1000).
+        :return: set of entry ids.
+        """
+        content_type_id = self.to_camel_case(content_type_name)
+        with self._lock:
+            if content_type_id in self._existing:
+                return self._existing[content_type_id]
+
+        # Concurrent callers wait for a single listing
+        with self._keyed_lock(('index', content_type_id)):
+            with self._lock:
+                if content_type_id in self._existing:
+                    return self._existing[content_type_id]
+
+            ids = set() if self.mirror is None else self.mirror.ids(content_type_id)
+            skip = 0
+            while self.mirror is None:
+                page = self.entries_client.all({
+                    'content_type': content_type_id,
+                    'select': 'sys',
+                    'limit': page_size,
+                    'skip': skip,
+                })
+                ids.update(e.sys['id'] for e in page)
+                skip += len(page)
+                if not len(page) or skip >= page.total:
+                    break
+
+            with self._lock:
+                return self._existing.setdefault(content_type_id, ids)
+
+    def _find_or_create(self, content_type_name, entry_uid, entry_attributes, update=False):
+        """
+        Shared lookup for create_entry/new_create_entry. Existence is answered by the
+        LRU cache and the prefetched id index, so only entries known to exist are
+        fetched and new entries are created without a failed find first. With update,
+        an existing entry is patched where it differs from the mapped entry_attributes.
+        """
+        started = time.time()
+        entry, operation = self._lookup(content_type_name, entry_uid, entry_attributes, update)
+        self.metrics.observe_entry(self.to_camel_case(content_type_name), operation, time.time() - started)
+        return entry
+
+    @contextmanager
+    def _keyed_lock(self, key):
+        """
+        Hold a lock private to key. The lock is dropped once no caller holds or
+        waits for it, so a long run doesn't keep one per entry it has looked up.
+        """
+        with self._lock:
+            holder = self._uid_locks.setdefault(key, [threading.Lock(), 0])
+            holder[1] += 1
+        try:
+            with holder[0]:
+                yield
+        finally:
+            with self._lock:
+                holder[1] -= 1
+                if not holder[1]:
+                    del self._uid_locks[key]
+
+    def _lookup(self, content_type_name, entry_uid, entry_attributes, update):
+        """
+        :return: (Entry, operation), operation being 'cache', 'mirror', 'find', 'update', 'unchanged' or 'create'.
+        """
+        entry = self.entry_cache.get(entry_uid)
+        if entry is not None and not update:
+            return entry, 'cache'
+
+        existing = self.index_existing(content_type_name)
+
+        # Concurrent callers asking for the same entry wait for the first one
+        with self._keyed_lock(entry_uid):
+            entry = self.entry_cache.get(entry_uid)
+            if entry is not None and not update:
+                return entry, 'cache'
+
+            if entry_uid in existing:
+                operation = 'find'
+                if entry is None or (update and entry_uid in self._partial):
+                    # An upsert compares every field, so it needs the whole entry
+                    entry = None if update else self._from_mirror(entry_uid)
+                    if entry is not None:
+                        operation = 'mirror'
+                    else:
+                        entry = self._find(entry_uid)
+                if update:
+                    entry, changed = self.patch_entry(entry, getattr(self, content_type_name)(entry_attributes)['fields'])
+                    operation = 'update' if changed else 'unchanged'
+                    if changed:
+                        print "Updating {}: {}".format(content_type_name, entry_uid)
+                        self._written(entry)
+            else:
+                operation = 'create'
+                print "Creating {}: {}".format(content_type_name, entry_uid)
+                try:
+                    entry = self.entries_client.create(
+                        entry_uid,
+                        getattr(self, content_type_name)(entry_attributes) # naming convention required
+                    )
+                except VersionMismatchError:
+                    # Created elsewhere after the index was built
+                    entry = self.entries_client.find(entry_uid)
+                self._written(entry)
+                with self._lock:
+                    existing.add(entry_uid)
+
+            self.entry_cache.put(entry_uid, entry)
+            return entry, operation
     
-    def new_create_entry(self, content_type_name, entry_uid, entry_attributes):
+    def new_create_entry(self, content_type_name, entry_uid, entry_attributes, update=False):
         """
         Return a Contentful Entry from OCW input data. If entry exists, returns Entry without creating or updating.   
-        For non-existent Entries, metadata are added based on their types and found in the _set_field_type function.
-        unicode: text field
-        contentful class: single reference field
-        list: multi-reference field
+        For non-existent Entries, metadata are mapped by the content type's compiled schema.EntryMapper
+        (see payload), which picks the field kind from the content type:
+        Symbol/Text: text field
+        Link: single reference field
+        Array: multi-reference field
         
         When calling create_entry(), provide the following parameters:
 
         :param content_type_name: str used to identify Contentful content_type. Convention: {content_type_name}_type.
         :param entry_uid: the entry's unique Contentful ID (we attempt to use OCW UIDs as much as possible).
         :param entry_attributes: dict containing metadata that will be mapped to Contentful.
-        :param force_creation: default None, intended to force creation when needing to change/update an existing Entry.
+        :param update: default False, upsert: update the fields of an existing Entry that differ
+            from entry_attributes (see patch_entry).
         :return: Contentful Entry object.
         """
+        return self._find_or_create(content_type_name, entry_uid, entry_attributes, update)
 
-        # Return the entry if the entry_uid already exists in Contentul 
-        try:
-            return self.entries_client.find(entry_uid)
-        except:
-            # print(type(content_type_name), type(str(entry_uid.encode)))
-            print "Creating {}: {}".format(content_type_name, entry_uid)
-        
-        # Create the entry and return 
-        return self.entries_client.create(
-            entry_uid, 
-            getattr(self, content_type_name)(entry_attributes) # naming convention required
-        )
-
-    def create_entry(self, content_type_name, entry_uid, entry_attributes):
+    def create_entry(self, content_type_name, entry_uid, entry_attributes, update=False):
         """
         Generalizing the entry creation process for OCW to Contentful. 
-        Step 1: Try to get the entry for content_type and entry_uid.
+        Step 1: Look up the entry_uid in the entry cache and the index of existing entries.
         Step 2: if does not exist, try to create the entry of type content_type_name with entry_uid and entry_attributes.
         :param content_type_name: str used to identify Contentful content_type. Convention: {content_type_name}_type
         :param entry_uid: the entry's unique id in Contentful
         :param entry_attributes: dict containing metadata that will be mapped to Contentful.
+        :param update: if True, an existing entry is upserted (only fields that differ from
+            entry_attributes are sent, see patch_entry) instead of returned untouched.
         """
+        return self._find_or_create(content_type_name, entry_uid, entry_attributes, update)
 
-        # Return the entry if the entry_uid already exists in Contentul 
-        try:
-            return self.entries_client.find(entry_uid)
-        except:
-            # print(type(content_type_name), type(str(entry_uid.encode)))
-            print "Creating {}: {}".format(content_type_name, entry_uid)
-        
-        # Create the entry and return 
-        return self.entries_client.create(
-            entry_uid, 
-            getattr(self, content_type_name)(entry_attributes) # naming convention required
-        )
+    def find_entry(self, entry_uid):
+        """
+        Fetch an entry known to exist with a single read, without building the id index.
+        """
+        entry = self.entry_cache.get(entry_uid)
+        if entry is None:
+            entry = self._from_mirror(entry_uid) or self._find(entry_uid)
+            self.entry_cache.put(entry_uid, entry)
+        return entry
+
+    def _find(self, entry_uid):
+        entry = self.entries_client.find(entry_uid)
+        self._partial.discard(entry_uid)
+        return entry
+
+    def _from_mirror(self, entry_uid):
+        """
+        Entry holding the sys and fields the mirror has for entry_uid (no request), or None.
+        save_entry sends the changes to such an entry as a patch.
+        """
+        raw = self.mirror.entry_json(entry_uid) if self.mirror is not None else None
+        if raw is None:
+            return None
+        self._partial.add(entry_uid)
+        return ResourceBuilder(self.client, self.client.default_locale, raw).build()
+
+    def entry_link(self, entry_uid):
+        """
+        Link to an entry known to exist, usable anywhere an Entry is linked, without a read.
+        """
+        return Link({'sys': {'type': 'Link', 'linkType': 'Entry', 'id': entry_uid}}, client=self.client)
+
+    def save_entry(self, entry, changes):
+        """
+        Apply a set of field changes to an entry and save it with a single update, or
+        return it unsaved if it already holds those values and links.
+
+        :param entry: Contentful Entry object.
+        :param changes: dict of snake_case field name -> value (see _set_field_type for value types).
+        :return: the saved Entry.
+        """
+        started = time.time()
+        stored = entry.fields()
+        if all(_comparable(stored.get(field)) == _comparable(value) for field, value in changes.items()):
+            # Same values and links as stored: nothing to send
+            self.metrics.observe_entry(entry.sys['content_type'].id, 'unchanged', time.time() - started)
+            return entry
+        if entry.sys['id'] in self._partial:
+            # Built from the mirror: a PUT would drop the fields it does not hold
+            fields = dict((self.to_camel_case(field), self._patch_value(value)) for field, value in changes.items())
+            entry = self.patch_entry(entry, fields)[0]
+            self._partial.discard(entry.sys['id'])
+        else:
+            for field, value in changes.items():
+                setattr(entry, field, value)
+            entry.save()
+        self.entry_cache.put(entry.sys['id'], entry)
+        self._written(entry)
+        self.metrics.observe_entry(entry.sys['content_type'].id, 'save', time.time() - started)
+        return entry
+
+    def _written(self, entry):
+        if self.mirror is not None:
+            self.mirror.record(entry)
+        if self.on_write is not None:
+            self.on_write(entry)
+
+    def _patch_value(self, value):
+        # Like _set_field_type, keeping the link type of links to assets
+        if hasattr(value, 'sys'):
+            return {'en-US': _link_json(value)}
+        if isinstance(value, list):
+            return {'en-US': [_link_json(v) for v in value if v]}
+        return self._set_field_type(value)
+
+    def patch_entry(self, entry, fields):
+        """
+        Upsert an existing entry: compare mapped fields with the stored ones and send only
+        those that differ, as one JSON Patch checked against the entry's version. Nothing
+        is sent when no field differs. If the entry changed in between (409), it is
+        fetched again and compared anew.
+
+        :param fields: mapped payload fields (see payload).
+        :return: (Entry, True if it was updated)
+        """
+        for attempt in range(PATCH_ATTEMPTS):
+            stored = dict((k, v) for k, v in entry.to_json()['fields'].items() if k is not None)
+            operations = fields_patch(stored, fields)
+            if not operations:
+                return entry, False
+            response = self.client._http_request('patch', entry._update_url(), {
+                'data': json.dumps(operations),
+                'headers': {'Content-Type': JSON_PATCH_TYPE, 'X-Contentful-Version': str(entry.sys['version'])},
+            })
+            if response.status_code < 300:
+                return ResourceBuilder(self.client, self.client.default_locale, response.json()).build(), True
+            error = get_error(response)
+            if not isinstance(error, VersionMismatchError) or attempt == PATCH_ATTEMPTS - 1:
+                raise error
+            entry = self.entries_client.find(entry.sys['id'])
+
+    def mapper(self, content_type_id):
+        """
+        Return the schema.EntryMapper for a content type, fetching its schema from the
+        space the first time. None when validation is off.
+        """
+        if not self.validate:
+            return None
+        mapper = self._mappers.get(content_type_id)
+        if mapper is None:
+            with self._keyed_lock(('schema', content_type_id)):
+                mapper = self._mappers.get(content_type_id)
+                if mapper is None:
+                    content_type = self.content_types_client.find(content_type_id)
+                    mapper = self._mappers[content_type_id] = EntryMapper(content_type.raw, self.truncate)
+        return mapper
+
+    def payload(self, content_type_name, entry_attributes):
+        """
+        Map entry attributes to a create payload with the content type's compiled mapper.
+
+        :raises schema.ValidationError: if Contentful would reject the entry.
+        """
+        content_type_id = CONTENT_TYPE_IDS.get(content_type_name) or self.to_camel_case(content_type_name)
+        mapper = self._mappers.get(content_type_id) or self.mapper(content_type_id)
+        if mapper is None:
+            fields = dict((self.to_camel_case(e), self._set_field_type(v)) for e, v in entry_attributes.iteritems())
+            if self.truncate:
+                _truncate_unmapped(fields)
+        else:
+            fields = mapper.map(entry_attributes)
+        return {'content_type_id': content_type_id, 'fields': fields}
 
     def courseware(self, entry_attributes):
-        return { 
-            'content_type_id': 'courseware',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('courseware', entry_attributes)
 
     def instructor(self, entry_attributes):
-        return { 
-            'content_type_id': 'instructor',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('instructor', entry_attributes)
     
     def tag(self, entry_attributes):
-        return {
-            'content_type_id': 'tag',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('tag', entry_attributes)
 
     def department(self, entry_attributes):
-        return {
-            'content_type_id': 'department',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('department', entry_attributes)
 
     def course_page(self, entry_attributes):
-        return {
-            'content_type_id': 'coursePage',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('course_page', entry_attributes)
 
     def course_file(self, entry_attributes):
-        return {
-            'content_type_id': 'courseFile',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('course_file', entry_attributes)
 
     def embedded_media(self, entry_attributes):
-        return {
-            'content_type_id': 'embeddedMedia',
-            'fields': {self.to_camel_case(e): self._set_field_type(v) for e,v in entry_attributes.iteritems()}
-        }
+        return self.payload('embedded_media', entry_attributes)
 
     def _set_field_type(self, v):
         if isinstance(v, unicode):
             return self._text_field(v)
-        elif isinstance(v, contentful_management.entry.Entry):
+        elif hasattr(v, 'sys'):  # Entry, Link or async_client.AsyncEntry
             return self._single_reference_field(v.sys['id'])
         elif isinstance(v, list):
             return self._multi_reference_field([l.sys['id'] for l in v if l])
@@ -140,8 +560,7 @@ class Translate(object):
         return {'sys': {'type': 'Link', 'linkType': 'Entry', 'id': cid}}
 
     def to_camel_case(self, string):
-        components = string.replace('-','_').split('_')
-        return components[0] + ''.join(x.title() for x in components[1:])
+        return to_camel_case(string)
     
 
 if __name__ == "__main__":
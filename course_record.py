@@ -0,0 +1,148 @@
+'''
+Course records (_master.json) read incrementally, so large courses are never decoded whole.
+'''
+import io
+import json
+import shutil
+import tempfile
+
+import json_stream
+
+
+# Members that grow with the size of the course; everything else is decoded up front
+STREAMED = ('course_pages', 'course_files', 'course_embedded_media')
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+class CourseRecord(dict):
+    def __init__(self, path, chunk_size=1 << 16, temporary=None):
+        """
+        A course's _master.json read from a local file. The small members (title,
+        department_number, instructors, tags, ...) are decoded into the dict right away;
+        the STREAMED ones are only located, and stream() decodes them one element at a
+        time, so memory stays bounded by the largest page or file record.
+
+        :param path: local copy of the _master.json.
+        :param chunk_size: bytes read at a time while scanning.
+        :param temporary: file object of a temporary copy, closed (and so deleted) by close().
+        """
+        super(CourseRecord, self).__init__()
+        self.path = path
+        self.chunk_size = chunk_size
+        self._temporary = temporary
+        with io.open(path, 'rb') as f:
+            index = json_stream.index_object(f, chunk_size)
+            self._streamed = dict((k, index.pop(k)) for k in STREAMED if k in index)
+            for key, (offset, length) in index.items():
+                self[key] = json_stream.read_at(f, offset, length)
+
+    @classmethod
+    def from_s3(cls, s3, bucket, key, chunk_size=1 << 16):
+        """
+        Copy an S3 object to a temporary file, a chunk at a time, and read it as a CourseRecord.
+        """
+        temporary = tempfile.NamedTemporaryFile(prefix='ocw_master_', suffix='.json')
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            shutil.copyfileobj(body, temporary, chunk_size)
+        finally:
+            body.close()
+        temporary.flush()
+        return cls(temporary.name, chunk_size, temporary)
+
+    def _members(self, f, key):
+        """
+        :return: ('[', None) for an array member, ('{', index of its members) for an object member.
+        """
+        offset, length = self._streamed[key]
+        f.seek(offset)
+        if f.read(1) == '[':
+            return '[', None
+        f.seek(offset)
+        return '{', json_stream.index_object(f, self.chunk_size)
+
+    def stream(self, key):
+        """
+        Generator of the elements of a STREAMED member (the values, for an object such
+        as course_embedded_media), decoded one at a time. Every call reads its own
+        handle, so several streams can be consumed side by side.
+        """
+        if key not in self._streamed:
+            for value in _values(self.get(key)):
+                yield value
+            return
+        with io.open(self.path, 'rb') as f:
+            kind, members = self._members(f, key)
+            if kind == '[':
+                f.seek(self._streamed[key][0])
+                for offset, length, element in json_stream.iter_array(f, self.chunk_size):
+                    yield element
+            else:
+                for offset, length in members.values():
+                    yield json_stream.read_at(f, offset, length)
+
+    def json_chunks(self):
+        """
+        The record as compact JSON with sorted keys (the form manifest digests are taken
+        of), produced a member or element at a time.
+        """
+        yield '{'
+        for i, key in enumerate(sorted(set(self) | set(self._streamed))):
+            yield (',' if i else '') + _dumps(key) + ':'
+            if key not in self._streamed:
+                yield _dumps(self[key])
+                continue
+            with io.open(self.path, 'rb') as f:
+                kind, members = self._members(f, key)
+                if kind == '[':
+                    yield '['
+                    f.seek(self._streamed[key][0])
+                    for j, (offset, length, element) in enumerate(json_stream.iter_array(f, self.chunk_size)):
+                        yield (',' if j else '') + _dumps(element)
+                    yield ']'
+                else:
+                    yield '{'
+                    for j, member in enumerate(sorted(members)):
+                        value = json_stream.read_at(f, *members[member])
+                        yield (',' if j else '') + _dumps(member) + ':' + _dumps(value)
+                    yield '}'
+        yield '}'
+
+    def close(self):
+        if self._temporary is not None:
+            self._temporary.close()
+            self._temporary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def _values(items):
+    if items is None:
+        return []
+    return items.values() if isinstance(items, dict) else items
+
+
+def stream(record, key):
+    """
+    Elements of a STREAMED member of a CourseRecord, or of a plain dict record.
+    """
+    if isinstance(record, CourseRecord):
+        return record.stream(key)
+    return iter(_values(record.get(key)))
+
+
+def json_chunks(record):
+    """
+    CourseRecord.json_chunks for a CourseRecord or a plain dict record.
+    """
+    if isinstance(record, CourseRecord):
+        return record.json_chunks()
+    return iter([_dumps(record)])
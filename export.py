@@ -0,0 +1,202 @@
+'''
+Network-free export of the OCW -> Contentful transformation into a contentful-import bundle.
+
+Usage:
+    python export.py --course https://ocw.mit.edu/courses/physics/8-01sc-classical-mechanics-fall-2016/ -o course.json
+    python export.py --department physics -o physics.ndjson --ndjson
+    python export.py --catalog -o catalog.json
+'''
+import argparse
+from collections import OrderedDict
+import json
+import sys
+import time
+
+from contentful_management.utils import snake_case
+
+from contentful_mapping import Translate
+from schema import EntryMapper
+
+
+class ExportEntry(object):
+    """
+    Entry held in memory by ExportTranslate; links to it resolve to sys['id'].
+    """
+    def __init__(self, entry_id, content_type_id, fields):
+        self.sys = {'id': entry_id, 'type': 'Entry', 'version': 1, 'content_type_id': content_type_id}
+        self.raw_fields = fields
+
+    def fields(self, locale='en-US'):
+        return dict((snake_case(k), v.get(locale)) for k, v in self.raw_fields.items() if v)
+
+    def to_json(self):
+        return {
+            'sys': {
+                'id': self.sys['id'],
+                'type': 'Entry',
+                'contentType': {'sys': {'type': 'Link', 'linkType': 'ContentType', 'id': self.sys['content_type_id']}},
+            },
+            'fields': dict((k, v) for k, v in self.raw_fields.items() if v is not None),
+        }
+
+
+class ExportTranslate(Translate):
+    def __init__(self, content_types=None, truncate=True):
+        """
+        Translate that keeps every mapped payload in memory instead of sending it. Entries
+        are built with the same payload methods, links and unit-of-work saves as a live
+        run; nothing here needs a Contentful client.
+
+        :param content_types: optional list of content type JSON (e.g. the contentTypes of a
+            contentful-export file). Their entries are validated and truncated like in a
+            live run; entries of other content types are mapped without a schema.
+        """
+        Translate.__init__(self, validate=True, truncate=truncate, connect=False)
+        self._mappers = dict((ct['sys']['id'], EntryMapper(ct, truncate)) for ct in content_types or [])
+        self.entries = OrderedDict()  # entry id -> ExportEntry not yet written out
+        self.written = set()  # ids already written to the bundle
+
+    def index_existing(self, content_type_name, page_size=1000):
+        return self.written
+
+    def mapper(self, content_type_id):
+        return self._mappers.get(content_type_id)
+
+    def _find_or_create(self, content_type_name, entry_uid, entry_attributes, update=False):
+        with self._lock:
+            entry = self.entries.get(entry_uid)
+            if entry is not None and not update:
+                return entry
+            if entry is None and entry_uid in self.written and not update:
+                return self.entry_link(entry_uid)
+            payload = getattr(self, content_type_name)(entry_attributes)
+            entry = ExportEntry(entry_uid, payload['content_type_id'], payload['fields'])
+            self.entries[entry_uid] = entry
+            return entry
+
+    def save_entry(self, entry, changes):
+        with self._lock:
+            entry = self.entries[entry.sys['id']]
+            for field, value in changes.items():
+                entry.raw_fields[self.to_camel_case(field)] = self._set_field_type(value)
+            return entry
+
+    def drain(self):
+        """
+        Hand over the entries mapped since the last drain, sorted by id, and forget them.
+        """
+        with self._lock:
+            entries = [self.entries[k] for k in sorted(self.entries)]
+            self.entries.clear()
+            self.written.update(e.sys['id'] for e in entries)
+            return entries
+
+
+class BundleWriter(object):
+    def __init__(self, fileobj, ndjson=False):
+        """
+        Streams entries into a contentful-import bundle: a single JSON document
+        ({"entries": [...]}) or, with ndjson, one entry per line. Output is deterministic
+        (sorted keys, entries in course order and sorted by id within a course).
+        Link targets are tracked so dangling links can be reported at the end.
+        """
+        self.fileobj = fileobj
+        self.ndjson = ndjson
+        self.count = 0
+        self.ids = set()
+        self.linked = set()
+
+    def __enter__(self):
+        if not self.ndjson:
+            self.fileobj.write('{"entries": [\n')
+        return self
+
+    def write(self, entries):
+        for entry in entries:
+            data = entry.to_json()
+            self.ids.add(data['sys']['id'])
+            for value in data['fields'].values():
+                self.linked.update(_link_ids(value))
+            if self.count and not self.ndjson:
+                self.fileobj.write(',\n')
+            self.fileobj.write(json.dumps(data, sort_keys=True, separators=(',', ':')))
+            if self.ndjson:
+                self.fileobj.write('\n')
+            self.count += 1
+
+    def unresolved(self):
+        return sorted(self.linked - self.ids)
+
+    def __exit__(self, *exc_info):
+        if not self.ndjson:
+            self.fileobj.write('\n]}\n')
+        return False
+
+
+def _link_ids(value):
+    value = value.get('en-US') if isinstance(value, dict) else value
+    links = value if isinstance(value, list) else [value]
+    return [l['sys']['id'] for l in links
+            if isinstance(l, dict) and l.get('sys', {}).get('type') == 'Link']
+
+
+class Exporter(object):
+    def __init__(self, ocw, writer):
+        """
+        :param ocw: Ocw2Contentful built with an ExportTranslate.
+        :param writer: open BundleWriter.
+        """
+        self.ocw = ocw
+        self.writer = writer
+
+    def export_course(self, ocw_url):
+        self.ocw.add_courseware(ocw_url)
+        self.writer.write(self.ocw.T.drain())
+
+    def export_department(self, department_id):
+        for course_path in self.ocw.catalog_urls([department_id]):
+            print("Exporting: {}".format(course_path))
+            self.export_course(course_path)
+
+    def export_catalog(self):
+        for depNo in sorted(self.ocw.departments_by_num):
+            self.export_department(self.ocw.departments_by_num[depNo]['id'])
+
+
+def main(argv=None):
+    from ocw2contentful import Ocw2Contentful
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--course', help='OCW course URL')
+    target.add_argument('--department', help='OCW department id, e.g. physics')
+    target.add_argument('--catalog', action='store_true', help='every department')
+    parser.add_argument('-o', '--output', required=True, help='bundle file to write')
+    parser.add_argument('--ndjson', action='store_true', help='one entry per line instead of one JSON document')
+    parser.add_argument('--content-model', help='contentful-export JSON whose contentTypes are used to validate entries')
+    args = parser.parse_args(argv)
+
+    content_types = None
+    if args.content_model:
+        with open(args.content_model) as f:
+            content_types = json.load(f)['contentTypes']
+
+    started = time.time()
+    ocw = Ocw2Contentful(translate=ExportTranslate(content_types))
+    with open(args.output, 'w') as f, BundleWriter(f, ndjson=args.ndjson) as writer:
+        exporter = Exporter(ocw, writer)
+        if args.course:
+            exporter.export_course(args.course)
+        elif args.department:
+            exporter.export_department(args.department)
+        else:
+            exporter.export_catalog()
+
+    print("Wrote {} entries to {} in {:.1f}s.".format(writer.count, args.output, time.time() - started))
+    if writer.unresolved():
+        print("Links to entries outside the bundle: {}".format(len(writer.unresolved())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,542 @@
+'''
+In-memory stand-in for the parts of the Contentful Management API this project uses,
+served over local HTTP so the sync and async clients can run without a real space.
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from datetime import datetime
+import hashlib
+import json
+import math
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urlparse
+import uuid
+
+from scheduler import LIMIT_HEADER, REMAINING_HEADER, RESET_HEADER
+
+
+# The OCW content model: field id -> type (Link: single reference, Array: multiple
+# references), (type, max length) for text fields with a size validation, or
+# ('Link', link type) for references to something other than an entry
+CONTENT_MODEL = {
+    'courseware': {
+        'title': 'Symbol', 'description': 'Text', 'departmentNumber': 'Symbol', 'masterCourseNumber': 'Symbol',
+        'url': 'Symbol', 'shortUrl': 'Symbol', 'trackingTitle': 'Symbol', 'imageSrc': 'Symbol',
+        'imageDescription': 'Text', 'imageAlternateText': 'Symbol', 'imageCaption': 'Text',
+        'thumbnailImageSrc': 'Symbol', 'thumbnailImageDescription': 'Text', 'fromSemester': 'Symbol',
+        'fromYear': 'Symbol', 'toSemester': 'Symbol', 'toYear': 'Symbol', 'courseLevel': 'Symbol',
+        'sortAs': 'Symbol', 'otherInformationText': 'Text', 'highlightsText': 'Text', 'publishdate': 'Symbol',
+        'department': 'Array', 'instructors': 'Array', 'tags': 'Array', 'coursePages': 'Array', 'courseFiles': 'Array',
+    },
+    'instructor': {
+        'firstName': 'Symbol', 'lastName': 'Symbol', 'middleInitial': 'Symbol', 'suffix': 'Symbol',
+        'title': 'Symbol', 'directoryTitle': 'Symbol', 'department': 'Array',
+    },
+    'tag': {'name': 'Symbol'},
+    'department': {'depNo': 'Symbol', 'id': 'Symbol', 'title': 'Symbol'},
+    'coursePage': {
+        'title': 'Symbol', 'url': 'Symbol', 'text': 'Text', 'shortUrl': 'Symbol', 'coursePageType': 'Symbol',
+        'parentUid': 'Symbol', 'description': 'Text', 'trackingTitle': 'Symbol', 'files': 'Array',
+    },
+    'courseFile': {
+        'title': 'Symbol', 'fileType': 'Symbol', 'fileLocation': 'Symbol', 'altText': 'Text', 'credit': 'Text',
+        'parentUid': 'Symbol', 'description': 'Text', 'trackingTitle': 'Symbol', 'courseware': 'Link',
+        'asset': ('Link', 'Asset'),
+    },
+    'embeddedMedia': {
+        'title': 'Symbol', 'technicalLocation': ('Symbol', 250), 'inlineEmbedId': 'Symbol', 'uid': 'Symbol',
+        'parentUid': 'Symbol', 'id': 'Symbol', 'trackingTitle': 'Symbol', 'VideoYoutubeStream': ('Symbol', 200),
+        'courseware': 'Array',
+    },
+}
+
+_ROUTE = re.compile(r'^/spaces/(?P<space>[^/]+)/environments/(?P<env>[^/]+)/(?P<kind>entries|content_types|assets)'
+                    r'(?:/(?P<id>[^/]+))?(?:/files/(?P<locale>[^/]+)/process)?/?$')
+_UPLOAD_ROUTE = re.compile(r'^/spaces/(?P<space>[^/]+)/uploads/?$')
+_BULK_ROUTE = re.compile(r'^/spaces/(?P<space>[^/]+)/environments/(?P<env>[^/]+)/bulk_actions/'
+                         r'(?:(?P<action>publish)|actions/(?P<id>[^/]+))/?$')
+_SYNC_ROUTE = re.compile(r'^/spaces/(?P<space>[^/]+)/environments/(?P<env>[^/]+)/sync/?$')
+BULK_MAX_ITEMS = 200
+# Management API sys attributes the sync API does not return
+SYNC_DROPPED_SYS = frozenset(['version', 'publishedVersion', 'publishedAt', 'publishedCounter', 'archivedVersion'])
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeContentful(object):
+    def __init__(self, space_id='space', environment_id='master', latency=0.0, rate_limit=None):
+        """
+        Keeps entries in memory and serves find, list, create and versioned update of
+        entries (including JSON Patch updates), plus the content types of CONTENT_MODEL (other content types are
+        synthesized from the fields written so far). Entries are published with bulk
+        actions of up to BULK_MAX_ITEMS links; each action finishes on its first poll
+        and fails the members whose version is not current. Assets can be created from file
+        uploads and processed; uploaded bodies are read in chunks and only their size
+        and SHA-1 are kept (self.uploads). Entries can be deleted, and the sync endpoint
+        pages through every entry (initial=true) or the entries changed and deleted since
+        a sync token. Every request is counted in self.requests by (method, kind).
+
+        :param latency: seconds every request takes before it is answered.
+        :param rate_limit: requests per second allowed, as announced in the
+            X-Contentful-RateLimit-* headers; requests over it get a 429 and are counted
+            in self.throttled instead of self.requests.
+
+        Usage:
+            api = FakeContentful().start()
+            client = contentful_management.Client('token', api_url=api.host, uploads_api_url=api.host, https=False)
+            ...
+            api.stop()
+        """
+        self.space_id = space_id
+        self.environment_id = environment_id
+        self.entries = dict()
+        self.deleted = dict()  # entry id -> sys of the deleted entry
+        self._changed = dict()  # entry id -> sequence number of its last change
+        self._sequence = 0
+        self.bulk_actions = dict()
+        self.assets = dict()
+        self.uploads = dict()  # upload id -> {'size': bytes, 'sha1': hex digest}
+        self.requests = Counter()
+        self.throttled = 0
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self._window = None
+        self._window_count = 0
+        self._server = None
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self._server.server_address)
+
+    def start(self, port=0):
+        class Handler(_Handler):
+            api = self
+        self._server = _Server(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _link(self, link_type, link_id):
+        return {'sys': {'type': 'Link', 'linkType': link_type, 'id': link_id}}
+
+    def _touch(self, entry_id):
+        # Called with the lock held whenever an entry is written, published or deleted
+        self._sequence += 1
+        self._changed[entry_id] = self._sequence
+
+    def _sys(self, resource_type, resource_id, version):
+        now = datetime.utcnow().isoformat() + 'Z'
+        return {
+            'type': resource_type,
+            'id': resource_id,
+            'version': version,
+            'space': self._link('Space', self.space_id),
+            'environment': self._link('Environment', self.environment_id),
+            'createdAt': now,
+            'updatedAt': now,
+        }
+
+    def put_entry(self, entry_id, body, content_type_id=None, version=None):
+        """
+        :return: (status, payload)
+        """
+        with self.lock:
+            current = self.entries.get(entry_id)
+            if current is None:
+                if version is not None or not content_type_id:
+                    return 404, _error('NotFound')
+                entry = {'sys': self._sys('Entry', entry_id, 1), 'fields': body.get('fields', {})}
+                entry['sys']['contentType'] = self._link('ContentType', content_type_id)
+            else:
+                if version is None or int(version) != current['sys']['version']:
+                    return 409, _error('VersionMismatch')
+                entry = {'sys': dict(current['sys']), 'fields': body.get('fields', {})}
+                entry['sys']['version'] += 1
+                entry['sys']['updatedAt'] = datetime.utcnow().isoformat() + 'Z'
+            entry['fields'] = dict((k, v) for k, v in entry['fields'].items() if v is not None)
+            self.entries[entry_id] = entry
+            self.deleted.pop(entry_id, None)
+            self._touch(entry_id)
+            return (201 if current is None else 200), entry
+
+    def patch_entry(self, entry_id, operations, version=None):
+        """
+        Apply JSON Patch add/replace/remove operations below /fields of an entry.
+
+        :return: (status, payload)
+        """
+        with self.lock:
+            current = self.entries.get(entry_id)
+            if current is None:
+                return 404, _error('NotFound')
+            if version is None or int(version) != current['sys']['version']:
+                return 409, _error('VersionMismatch')
+            fields = json.loads(json.dumps(current['fields']))
+            for operation in operations:
+                path = [p.replace('~1', '/').replace('~0', '~') for p in operation['path'].split('/')[1:]]
+                if not path or path[0] != 'fields' or len(path) not in (2, 3):
+                    return 422, _error('UnprocessableEntity')
+                parent = fields if len(path) == 2 else fields.setdefault(path[1], {})
+                if operation['op'] in ('add', 'replace'):
+                    parent[path[-1]] = operation['value']
+                elif operation['op'] == 'remove' and path[-1] in parent:
+                    del parent[path[-1]]
+                else:
+                    return 422, _error('UnprocessableEntity')
+            entry = {'sys': dict(current['sys']), 'fields': fields}
+            entry['sys']['version'] += 1
+            entry['sys']['updatedAt'] = datetime.utcnow().isoformat() + 'Z'
+            self.entries[entry_id] = entry
+            self._touch(entry_id)
+            return 200, entry
+
+    def delete_entry(self, entry_id):
+        with self.lock:
+            entry = self.entries.pop(entry_id, None)
+            if entry is None:
+                return 404, _error('NotFound')
+            self.deleted[entry_id] = dict(entry['sys'], type='DeletedEntry')
+            self._touch(entry_id)
+            return 204, None
+
+    def sync(self, query):
+        """
+        One page of the sync API. A token encodes the change sequence numbers it covers
+        ('since.until.skip' for the next page of a sync, 'until' for the next sync).
+        Entries come as the Preview API sends them, with a revision instead of a version.
+
+        :return: (status, payload) with items and a nextPageUrl or nextSyncUrl.
+        """
+        limit = int(query.get('limit', 100))
+        with self.lock:
+            if query.get('initial'):
+                since, until, skip = 0, self._sequence, 0
+            elif query.get('sync_token'):
+                parts = [int(p) for p in query['sync_token'].split('.')]
+                since, until, skip = parts if len(parts) == 3 else (parts[0], self._sequence, 0)
+            else:
+                return 400, _error('BadRequest')
+            changed = sorted(i for i, n in self._changed.items() if since < n <= until)
+            # An initial sync only lists entries that exist
+            items = [_sync_item(self.entries[i]) if i in self.entries else {'sys': self.deleted[i]}
+                     for i in changed if i in self.entries or since]
+        page = items[skip:skip + limit]
+        url = 'http://{}/spaces/{}/environments/{}/sync?sync_token='.format(
+            self.host, self.space_id, self.environment_id)
+        payload = {'sys': {'type': 'Array'}, 'items': page}
+        if skip + limit < len(items):
+            payload['nextPageUrl'] = url + '{}.{}.{}'.format(since, until, skip + limit)
+        else:
+            payload['nextSyncUrl'] = url + str(until)
+        return 200, payload
+
+    def get_entry(self, entry_id):
+        with self.lock:
+            if entry_id not in self.entries:
+                return 404, _error('NotFound')
+            return 200, self.entries[entry_id]
+
+    def list_entries(self, query):
+        content_type_id = query.get('content_type')
+        ids = set(query['sys.id[in]'].split(',')) if query.get('sys.id[in]') else None
+        skip = int(query.get('skip', 0))
+        limit = int(query.get('limit', 100))
+        with self.lock:
+            items = [e for _, e in sorted(self.entries.items())
+                     if (not content_type_id or e['sys']['contentType']['sys']['id'] == content_type_id)
+                     and (ids is None or e['sys']['id'] in ids)]
+        return 200, {'sys': {'type': 'Array'}, 'total': len(items), 'skip': skip, 'limit': limit,
+                     'items': items[skip:skip + limit]}
+
+    def create_bulk_publish(self, body):
+        """
+        :return: (status, payload) with a bulk action that completes on its first poll.
+        """
+        items = body.get('entities', {}).get('items', [])
+        if not items or len(items) > BULK_MAX_ITEMS:
+            return 422, _error('InvalidPayload')
+        action_id = uuid.uuid4().hex
+        action = {'sys': self._sys('BulkAction', action_id, 1), 'action': 'publish',
+                  'payload': body}
+        action['sys']['status'] = 'created'
+        with self.lock:
+            self.bulk_actions[action_id] = action
+        return 201, action
+
+    def get_bulk_action(self, action_id):
+        with self.lock:
+            action = self.bulk_actions.get(action_id)
+            if action is None:
+                return 404, _error('NotFound')
+            if action['sys']['status'] == 'created':
+                self._run_bulk_publish(action)
+            return 200, action
+
+    def _run_bulk_publish(self, action):
+        errors = []
+        for link in action['payload']['entities']['items']:
+            entry = self.entries.get(link['sys']['id'])
+            if entry is None:
+                error = 'NotFound'
+            elif link['sys'].get('version') != entry['sys']['version']:
+                error = 'VersionMismatch'
+            else:
+                entry['sys']['publishedVersion'] = entry['sys']['version']
+                entry['sys']['publishedAt'] = datetime.utcnow().isoformat() + 'Z'
+                entry['sys']['version'] += 1
+                self._touch(entry['sys']['id'])
+                continue
+            errors.append({'error': _error(error), 'entity': {'sys': dict(link['sys'])}})
+        action['sys']['status'] = 'failed' if errors else 'succeeded'
+        if errors:
+            action['error'] = dict(_error('BulkActionFailed'), details={'errors': errors})
+
+    def put_upload(self, body):
+        """
+        Store the size and SHA-1 of an uploaded file, reading it a chunk at a time.
+        """
+        digest = hashlib.sha1()
+        size = 0
+        for chunk in iter(lambda: body.read(1 << 16), ''):
+            digest.update(chunk)
+            size += len(chunk)
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {'size': size, 'sha1': digest.hexdigest()}
+        payload = {'sys': self._sys('Upload', upload_id, 1)}
+        return 201, payload
+
+    def put_asset(self, asset_id, body, version=None):
+        """
+        :return: (status, payload)
+        """
+        with self.lock:
+            current = self.assets.get(asset_id)
+            if current is None:
+                if version is not None:
+                    return 404, _error('NotFound')
+                asset = {'sys': self._sys('Asset', asset_id, 1)}
+            else:
+                if version is None or int(version) != current['sys']['version']:
+                    return 409, _error('VersionMismatch')
+                asset = {'sys': dict(current['sys'])}
+                asset['sys']['version'] += 1
+            asset['fields'] = dict((k, v) for k, v in body.get('fields', {}).items() if v is not None)
+            self.assets[asset_id] = asset
+            return (201 if current is None else 200), asset
+
+    def process_asset(self, asset_id, locale, version):
+        """
+        Turn the pending upload of one locale into a file URL, as Contentful's asset
+        processing does (here synchronously).
+        """
+        with self.lock:
+            current = self.assets.get(asset_id)
+            if current is None:
+                return 404, _error('NotFound')
+            if version is None or int(version) != current['sys']['version']:
+                return 409, _error('VersionMismatch')
+            file_field = current['fields'].get('file', {}).get(locale)
+            if not file_field or 'uploadFrom' not in file_field:
+                return 422, _error('ValidationFailed')
+            upload = self.uploads.get(file_field['uploadFrom']['sys']['id'])
+            if upload is None:
+                return 422, _error('ValidationFailed')
+            file_field = dict((k, v) for k, v in file_field.items() if k != 'uploadFrom')
+            file_field['url'] = '//assets.fake/{}/{}/{}'.format(
+                self.space_id, upload['sha1'], file_field.get('fileName', ''))
+            file_field['details'] = {'size': upload['size']}
+            current['fields']['file'][locale] = file_field
+            current['sys']['version'] += 1
+            return 204, None
+
+    def get_content_type(self, content_type_id):
+        model = dict(CONTENT_MODEL.get(content_type_id, {}))
+        if not model:
+            with self.lock:
+                for e in self.entries.values():
+                    if e['sys']['contentType']['sys']['id'] == content_type_id:
+                        model.update((f, 'Text') for f in e['fields'])
+        fields = []
+        for f in sorted(model):
+            field_type, option = model[f] if isinstance(model[f], tuple) else (model[f], None)
+            field = {'id': f, 'name': f, 'type': field_type, 'localized': False, 'required': False, 'validations': []}
+            if field_type == 'Link':
+                field['linkType'] = option or 'Entry'
+            elif field_type == 'Array':
+                field['items'] = {'type': 'Link', 'linkType': 'Entry'}
+            elif option:
+                field['validations'].append({'size': {'max': option}})
+            fields.append(field)
+        content_type = {'sys': self._sys('ContentType', content_type_id, 1), 'name': content_type_id,
+                        'displayField': None, 'fields': fields}
+        return 200, content_type
+
+    def _throttle(self):
+        """
+        Count a request against the current one-second window.
+
+        :return: (allowed, rate-limit response headers)
+        """
+        if not self.rate_limit:
+            return True, {}
+        with self.lock:
+            now = time.time()
+            if int(now) != self._window:
+                self._window, self._window_count = int(now), 0
+            self._window_count += 1
+            remaining = self.rate_limit - self._window_count
+            headers = {LIMIT_HEADER: str(self.rate_limit), REMAINING_HEADER: str(max(0, remaining))}
+            if remaining >= 0:
+                return True, headers
+            self.throttled += 1
+        headers[RESET_HEADER] = str(int(math.ceil(self._window + 1 - now)))
+        return False, headers
+
+    def serve(self, method, path, query, headers, body):
+        """
+        handle() behind the simulated latency and rate limit.
+
+        :return: (status, payload, response headers)
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        allowed, response_headers = self._throttle()
+        if not allowed:
+            return 429, _error('RateLimitExceeded'), response_headers
+        status, payload = self.handle(method, path, query, headers, body)
+        return status, payload, response_headers
+
+    def handle(self, method, path, query, headers, body):
+        bulk = _BULK_ROUTE.match(path)
+        if bulk:
+            self.requests[(method, 'bulk_actions')] += 1
+            if method == 'POST' and bulk.group('action'):
+                return self.create_bulk_publish(body)
+            if method == 'GET' and bulk.group('id'):
+                return self.get_bulk_action(bulk.group('id'))
+            return 405, _error('MethodNotAllowed')
+        if _UPLOAD_ROUTE.match(path):
+            self.requests[(method, 'uploads')] += 1
+            if method == 'POST':
+                return self.put_upload(body)
+            return 405, _error('MethodNotAllowed')
+        if _SYNC_ROUTE.match(path):
+            self.requests[(method, 'sync')] += 1
+            if method == 'GET':
+                return self.sync(query)
+            return 405, _error('MethodNotAllowed')
+        match = _ROUTE.match(path)
+        if not match:
+            return 404, _error('NotFound')
+        kind, resource_id = match.group('kind'), match.group('id')
+        self.requests[(method, kind)] += 1
+        if kind == 'assets' and resource_id:
+            version = headers.get('X-Contentful-Version')
+            if method == 'PUT' and match.group('locale'):
+                return self.process_asset(resource_id, match.group('locale'), version)
+            if method == 'PUT':
+                return self.put_asset(resource_id, body, version)
+            if method == 'GET':
+                with self.lock:
+                    if resource_id in self.assets:
+                        return 200, self.assets[resource_id]
+                return 404, _error('NotFound')
+        if kind == 'content_types' and method == 'GET' and resource_id:
+            return self.get_content_type(resource_id)
+        if kind == 'entries' and method == 'GET':
+            return self.get_entry(resource_id) if resource_id else self.list_entries(query)
+        if kind == 'entries' and method == 'PUT' and resource_id:
+            return self.put_entry(resource_id, body, headers.get('X-Contentful-Content-Type'),
+                                  headers.get('X-Contentful-Version'))
+        if kind == 'entries' and method == 'PATCH' and resource_id:
+            return self.patch_entry(resource_id, body, headers.get('X-Contentful-Version'))
+        if kind == 'entries' and method == 'DELETE' and resource_id:
+            return self.delete_entry(resource_id)
+        return 405, _error('MethodNotAllowed')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    api = None
+
+    def _dispatch(self, method):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if method == 'POST' and _UPLOAD_ROUTE.match(url.path):
+            body = _RequestBody(self.rfile, length)
+        else:
+            body = json.loads(self.rfile.read(length)) if length else {}
+        status, payload, headers = self.api.serve(method, url.path, query, self.headers, body)
+        if isinstance(body, _RequestBody):
+            body.drain()  # e.g. after a 429, so the keep-alive connection stays usable
+        self._respond(status, payload, headers)
+
+    def _respond(self, status, payload, headers=None):
+        data = json.dumps(payload) if payload is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.contentful.management.v1+json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+
+class _RequestBody(object):
+    """
+    The unread part of a request body, readable in chunks.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size):
+        data = self.rfile.read(min(size, self.remaining)) if self.remaining else ''
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        while self.read(1 << 16):
+            pass
+
+
+def _error(error_id):
+    return {'sys': {'type': 'Error', 'id': error_id}, 'message': error_id}
+
+
+def _sync_item(entry):
+    # Sync API entries carry a revision instead of the Management API's version
+    sys = dict((k, v) for k, v in entry['sys'].items() if k not in SYNC_DROPPED_SYS)
+    sys['revision'] = entry['sys']['version']
+    return {'sys': sys, 'fields': entry['fields']}
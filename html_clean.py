@@ -0,0 +1,219 @@
+'''
+Single-pass HTML cleaning for OCW course page text.
+
+Output equivalence with the BeautifulSoup 3 implementation it replaces
+(Ocw2Contentful._clean_html before this module):
+    - The same attributes (class, name, style, scope) are removed from every tag, and
+      every other attribute, tag, text node, entity and comment is kept in order.
+    - The output is not prettified: no newlines or indentation are added between
+      tags, so the text differs from prettify() only in insignificant whitespace.
+    - Markup is not repaired: unclosed or misnested tags are written back as they
+      came, where BeautifulSoup 3 would close or reorder them.
+    - CDATA sections are kept as they came. Conditional sections such as <![if !IE]>
+      are kept too, where BeautifulSoup 3 drops them.
+    - Relative links containing /courses/ are made absolute (https://ocw.mit.edu...).
+      The old code meant to do this, but its `"href" in link_tag` test checked the
+      tag's children instead of its attributes, so links were never rewritten.
+'''
+from collections import OrderedDict
+import hashlib
+from HTMLParser import HTMLParser
+import re
+import threading
+
+
+STRIPPED_ATTRIBUTES = frozenset(["class", "name", "style", "scope"])
+OCW_ROOT = u"https://ocw.mit.edu"
+# Marked sections closed by ']>' rather than ']]>' (as HTMLParser's markupbase parses them)
+CONDITIONAL_SECTIONS = frozenset(["if", "else", "endif"])
+
+
+class _Rewriter(HTMLParser):
+    """
+    Streams parser events straight back out as markup, dropping stripped attributes.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.out = []
+
+    def _tag(self, tag, attrs, close):
+        parts = [u'<', tag]
+        for k, v in attrs:
+            if k in STRIPPED_ATTRIBUTES:
+                continue
+            if v is None:
+                parts.append(u' ' + k)
+                continue
+            if tag == 'a' and k == 'href' and v.startswith('/') and '/courses/' in v:
+                v = OCW_ROOT + v
+            parts.append(u' {}="{}"'.format(k, _escape_attribute(v)))
+        parts.append(close + u'>')
+        return u''.join(parts)
+
+    def handle_starttag(self, tag, attrs):
+        self.out.append(self._tag(tag, attrs, u''))
+
+    def handle_startendtag(self, tag, attrs):
+        self.out.append(self._tag(tag, attrs, u' /'))
+
+    def handle_endtag(self, tag):
+        self.out.append(u'</{}>'.format(tag))
+
+    def handle_data(self, data):
+        self.out.append(data)
+
+    def handle_entityref(self, name):
+        self.out.append(u'&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.out.append(u'&#{};'.format(name))
+
+    def handle_comment(self, data):
+        self.out.append(u'<!--{}-->'.format(data))
+
+    def handle_decl(self, decl):
+        self.out.append(u'<!{}>'.format(decl))
+
+    def handle_pi(self, data):
+        self.out.append(u'<?{}>'.format(data))
+
+    def unknown_decl(self, data):
+        # data is the section without its close, e.g. 'CDATA[foo' for <![CDATA[foo]]>
+        if data.split(None, 1)[:1] and data.split(None, 1)[0].lower() in CONDITIONAL_SECTIONS:
+            self.out.append(u'<![{}]>'.format(data))
+        else:
+            self.out.append(u'<![{}]]>'.format(data))
+
+
+def _escape_attribute(value):
+    return value.replace(u'&', u'&amp;').replace(u'"', u'&quot;').replace(u'<', u'&lt;')
+
+
+def clean_html(html):
+    """
+    Clean one HTML fragment in a single pass (see the module docstring for how the
+    output relates to the BeautifulSoup 3 version). Empty values are returned as is.
+    """
+    if not html:
+        return html
+    rewriter = _Rewriter()
+    rewriter.feed(html)
+    rewriter.close()
+    return u''.join(rewriter.out)
+
+
+class HtmlCleaner(object):
+    def __init__(self, max_entries=4096):
+        """
+        clean_html with a memo keyed by a hash of the input, so identical page bodies
+        (shared boilerplate pages, re-runs) are cleaned once.
+
+        :param max_entries: number of cleaned bodies kept, least recently used dropped first.
+        """
+        self.max_entries = max_entries
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clean(self, html):
+        if not html:
+            return html
+        key = hashlib.sha1(html.encode('utf-8')).digest()
+        with self._lock:
+            cleaned = self._memo.pop(key, None)
+            if cleaned is not None:
+                self._memo[key] = cleaned
+                return cleaned
+
+        cleaned = clean_html(html)
+        with self._lock:
+            self._memo[key] = cleaned
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return cleaned
+
+
+SAMPLE_PAGE = (
+    u'<h2 class="subhead">Course Meeting Times</h2> <p>Lectures: 3 sessions / week, 1 hour / session</p> '
+    u'<h2 class="subhead">Textbook</h2> <p>Bucciarelli, Louis. <a href="http://store.doverpublications.com/0486468550.html">'
+    u'<em>Engineering Mechanics for Structures</em></a>, Fall 2002. (The full text is published in the '
+    u'<a href="/courses/civil-and-environmental-engineering/1-050-solid-mechanics-fall-2004/readings">readings section</a>.)</p> '
+    u'<p><a href="http://www.amazon.com/exec/obidos/ASIN/0070134367/ref=nosim/mitopencourse-20">'
+    u'<img alt="Buy at Amazon" src="/images/a_logo_17.gif" border="0" align="absmiddle" /></a> Crandall, S., N. Dahl, '
+    u'and T. Lardner. <em>An Intro. to the Mechanics of Solids</em>. New York, NY: McGraw-Hill, 1978.</p> '
+    u'<h3 class="subsubhead">Quizzes 30%</h3> <p>There will be two one-hour, closed-book quizzes given during the semester.</p> '
+    u'<table summary="grading" class="tablewidth50"><tr><th scope="col">Activity</th><th scope="col">Weight</th></tr>'
+    u'<tr><td style="text-align: center">Final Exam</td><td>30%</td></tr></table> '
+    u'<p>Two grades will be assigned for each exercise: One for &quot;presentation&quot;, the other for &quot;analysis&quot;.&nbsp;</p>'
+)
+
+
+def _bs3_clean_html(html):
+    """
+    The BeautifulSoup 3 implementation this module replaces, kept for benchmarking.
+    """
+    from BeautifulSoup import BeautifulSoup
+    soup = BeautifulSoup(html)
+    for tag in soup():
+        for attribute in ["class", "name", "style", "scope"]:
+            del tag[attribute]
+
+    for link_tag in soup.findAll('a'):
+        if "href" in link_tag and "/courses/" in link_tag["href"]:
+            link_tag["href"] = "https://ocw.mit.edu" + link_tag["href"]
+    return unicode(soup.prettify(), errors='replace')
+
+
+# Markup clean_html must write like the BeautifulSoup 3 version, up to prettify() whitespace
+EQUIVALENCE_CASES = [
+    u'<p class="x">Text with <em style="color: red">emphasis</em> &amp; an entity&nbsp;</p>',
+    u'<table summary="grading"><tr><th scope="col">Activity</th></tr></table>',
+    u'<p>before<!-- a comment -->after</p>',
+    u'<!DOCTYPE html><p>a</p>',
+    u'<p>a<![CDATA[foo]]>b</p>',
+    u'<![CDATA[foo]]>',
+]
+
+
+def _unprettified(html):
+    return re.sub(r'\s*(<[^>]*>)\s*', r'\1', html).strip()
+
+
+def check_equivalence(cases=EQUIVALENCE_CASES):
+    """
+    :return: list of (case, clean_html output, BeautifulSoup 3 output) for the cases whose
+        outputs differ other than in whitespace around tags; empty if all match.
+    """
+    differences = []
+    for html in cases:
+        cleaned, expected = clean_html(html), _bs3_clean_html(html)
+        if _unprettified(cleaned) != _unprettified(expected):
+            differences.append((html, cleaned, expected))
+    return differences
+
+
+def benchmark(repeat=5, scale=20):
+    """
+    Time the BeautifulSoup 3 cleaner against clean_html on a syllabus-sized page.
+
+    :param repeat: timing repetitions (best one is reported).
+    :param scale: how many copies of SAMPLE_PAGE make up one page.
+    :return: dict of best seconds per page for each implementation.
+    """
+    import timeit
+    differences = check_equivalence()
+    if differences:
+        raise AssertionError("clean_html differs from BeautifulSoup 3: {}".format(differences))
+    page = SAMPLE_PAGE * scale
+    number = 10
+    results = dict()
+    for name, fn in [('beautifulsoup3', _bs3_clean_html), ('clean_html', clean_html)]:
+        results[name] = min(timeit.repeat(lambda: fn(page), number=number, repeat=repeat)) / number
+    return results
+
+
+if __name__ == "__main__":
+    results = benchmark()
+    print("Page size: {} characters".format(len(SAMPLE_PAGE * 20)))
+    for name in sorted(results):
+        print("{:>16}: {:.2f} ms/page".format(name, results[name] * 1000))
+    print("Speedup: {:.1f}x".format(results['beautifulsoup3'] / results['clean_html']))
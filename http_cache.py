@@ -0,0 +1,161 @@
+'''
+On-disk HTTP cache for the OCW JSON endpoints (departments.json and department data).
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import requests
+
+
+class CacheMissError(IOError):
+    """
+    Raised in offline mode when a URL has never been cached.
+    """
+
+
+class HttpCache(object):
+    def __init__(self, directory='.ocw_http_cache', max_bytes=2 << 30, max_age=3600, offline=False, session=None):
+        """
+        Stores response bodies on disk next to their ETag/Last-Modified headers. A body
+        younger than max_age is served straight from disk; an older one is revalidated
+        with a conditional GET and only downloaded again when the server says it changed.
+        The least recently used bodies are evicted once the cache grows past max_bytes.
+
+        :param directory: where bodies (<sha1>.body) and metadata (<sha1>.json) are kept.
+        :param max_bytes: size limit for all cached bodies.
+        :param max_age: seconds a cached body is trusted without revalidation.
+        :param offline: serve only from the cache, never touching the network.
+        :param session: optional requests.Session (keep-alive pool shared by all fetches).
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        self.session = session or requests.Session()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, url):
+        """
+        Return a binary file object with the (cached or freshly fetched) body of url.
+        Local paths are opened directly.
+        """
+        if not url.startswith(('http://', 'https://')):
+            return open(url, 'rb')
+        return open(self.path(url), 'rb')
+
+    def get(self, url):
+        """
+        Return the body of url as a string.
+        """
+        with self.open(url) as f:
+            return f.read()
+
+    def get_json(self, url):
+        with self.open(url) as f:
+            return json.load(f)
+
+    def path(self, url):
+        """
+        Return the path of the cached body for url, fetching or revalidating it first.
+        """
+        body_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path) if os.path.exists(body_path) else None
+
+        if self.offline:
+            if meta is None:
+                raise CacheMissError("Not in the HTTP cache (offline): {}".format(url))
+        elif meta is None or time.time() - meta['checked_at'] > self.max_age:
+            meta = self._fetch(url, body_path, meta)
+            self._write_meta(meta_path, meta)
+
+        os.utime(meta_path, None)  # recency for eviction
+        return body_path
+
+    def put(self, url, body):
+        """
+        Store body for url as if it had just been fetched (e.g. to seed a cache for offline runs).
+        """
+        body_path, meta_path = self._paths(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_path, body_path)
+        self._write_meta(meta_path, {'url': url, 'etag': None, 'last_modified': None,
+                                     'size': len(body), 'checked_at': time.time()})
+
+    def _fetch(self, url, body_path, meta):
+        headers = dict()
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = self.session.get(url, headers=headers, stream=True)
+        if response.status_code == 304 and meta is not None:
+            response.close()
+            meta['checked_at'] = time.time()
+            return meta
+        response.raise_for_status()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        response.raw.decode_content = True  # undo gzip transfer encoding while streaming
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(response.raw, f)
+        os.rename(tmp_path, body_path)
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'size': os.path.getsize(body_path),
+            'checked_at': time.time(),
+        }
+        self._evict(keep=body_path)
+        return meta
+
+    def _evict(self, keep=None):
+        """
+        Remove least recently used entries until the cached bodies fit in max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.body'):
+                continue
+            body_path = os.path.join(self.directory, name)
+            meta_path = body_path[:-len('.body')] + '.json'
+            used = os.path.getmtime(meta_path) if os.path.exists(meta_path) else 0
+            entries.append((used, body_path, meta_path, os.path.getsize(body_path)))
+
+        total = sum(e[3] for e in entries)
+        for used, body_path, meta_path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if body_path == keep:
+                continue
+            for p in (body_path, meta_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            total -= size
+
+    def _paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        return (os.path.join(self.directory, key + '.body'),
+                os.path.join(self.directory, key + '.json'))
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, meta_path)
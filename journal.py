@@ -0,0 +1,117 @@
+'''
+Durable checkpoint journal so interrupted course and catalog imports resume where they stopped.
+'''
+import sqlite3
+import threading
+
+
+CREATED = 'created'
+SAVED = 'saved'
+
+
+class Journal(object):
+    def __init__(self, path='ocw_journal.sqlite'):
+        """
+        Records, per course, every entry created (steps 1-7 of add_courseware) and every
+        entry saved with its links (the final flush), and which courses finished. A rerun
+        skips finished courses without any request, and inside an unfinished course
+        links journaled entries by id instead of looking them up again.
+
+        The journal describes one import run: call reset() (or delete the file) before
+        starting a new one. Every read goes to SQLite, so processes sharing the file see
+        each other's progress (e.g. a course taken over from a worker that died).
+
+        :param path: SQLite database file (created if missing); ':memory:' for a throwaway journal.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Entries are journaled one by one as they complete; WAL keeps those commits cheap
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'course TEXT NOT NULL, uid TEXT NOT NULL, state TEXT NOT NULL, '
+            'PRIMARY KEY (course, uid))'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS courses (course TEXT PRIMARY KEY, uid TEXT NOT NULL)'
+        )
+        self._db.commit()
+
+    def finished(self, course):
+        """
+        :param course: course key (the S3 prefix of the course).
+        :return: the courseware entry id if the course finished, otherwise None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT uid FROM courses WHERE course = ?', (course,)).fetchone()
+        return row[0] if row else None
+
+    def course(self, course):
+        """
+        :return: CourseJournal recording the progress of one course.
+        """
+        return CourseJournal(self, course)
+
+    def state(self, course, uid):
+        with self._lock:
+            row = self._db.execute('SELECT state FROM entries WHERE course = ? AND uid = ?', (course, uid)).fetchone()
+        return row[0] if row else None
+
+    def record(self, course, uid, state):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries (course, uid, state) VALUES (?, ?, ?)',
+                             (course, uid, state))
+            self._db.commit()
+
+    def finish(self, course, courseware_uid):
+        """
+        Mark a course finished; its per-entry rows are no longer needed and are dropped.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO courses (course, uid) VALUES (?, ?)', (course, courseware_uid))
+            self._db.execute('DELETE FROM entries WHERE course = ?', (course,))
+            self._db.commit()
+
+    def reset(self, course=None):
+        """
+        Forget the progress of one course, or of every course to start a new run.
+        """
+        with self._lock:
+            if course is None:
+                self._db.execute('DELETE FROM entries')
+                self._db.execute('DELETE FROM courses')
+            else:
+                self._db.execute('DELETE FROM entries WHERE course = ?', (course,))
+                self._db.execute('DELETE FROM courses WHERE course = ?', (course,))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM courses').fetchone()[0]
+
+
+class CourseJournal(object):
+    """
+    Journal entries of a single course, as used by Ocw2Contentful.add_courseware.
+    """
+    def __init__(self, journal, course):
+        self.journal = journal
+        self.course = course
+
+    def state(self, uid):
+        """
+        :return: CREATED, SAVED or None if the entry has not been journaled.
+        """
+        return self.journal.state(self.course, uid)
+
+    def created(self, uid):
+        if self.state(uid) is None:
+            self.journal.record(self.course, uid, CREATED)
+
+    def saved(self, entry):
+        self.journal.record(self.course, entry.sys['id'], SAVED)
+
+    def finish(self, courseware_uid):
+        self.journal.finish(self.course, courseware_uid)
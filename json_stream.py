@@ -0,0 +1,213 @@
+'''
+Incremental readers for large JSON documents that should not be loaded whole.
+'''
+from collections import OrderedDict
+import json
+import re
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_STRUCTURAL = re.compile(r'["\[\]{}]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,\]}]')
+
+
+def iter_array(fileobj, chunk_size=1 << 16):
+    """
+    Yield the elements of a top-level JSON array one at a time, together with their
+    byte offset and length in the file. Only the element being decoded is buffered,
+    so memory is bounded by the largest element rather than by the whole document.
+
+    :param fileobj: file-like object opened in binary mode, positioned at the array.
+    :param chunk_size: bytes read per call to fileobj.read.
+    :return: generator of (offset, length, element) tuples.
+    """
+    buf = ''
+    pos = 0  # position in buf
+    base = fileobj.tell() if hasattr(fileobj, 'tell') else 0  # file offset of buf[0]
+    eof = False
+
+    def fill(buf, pos, base, want):
+        # Drop consumed bytes, then read until at least want unread bytes (or EOF)
+        buf, base = buf[pos:], base + pos
+        more = True
+        while len(buf) < want:
+            data = fileobj.read(max(chunk_size, want - len(buf)))
+            if not data:
+                more = False
+                break
+            buf += data
+        return buf, 0, base, more
+
+    def skip(buf, pos, chars):
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    buf, pos, base, more = fill(buf, pos, base, 1)
+    pos = skip(buf, pos, _WHITESPACE)
+    if not buf[pos:pos + 1] == '[':
+        raise ValueError("Expected a JSON array at offset {}".format(base + pos))
+    pos += 1
+
+    while True:
+        pos = skip(buf, pos, _WHITESPACE + ',')
+        while pos >= len(buf) and not eof:
+            buf, pos, base, more = fill(buf, pos, base, 1)
+            eof = not more
+            pos = skip(buf, pos, _WHITESPACE + ',')
+        if pos >= len(buf):
+            raise ValueError("Unterminated JSON array")
+        if buf[pos] == ']':
+            return
+
+        want = chunk_size
+        while True:
+            try:
+                element, end = _decoder.raw_decode(buf, pos)
+                break
+            except ValueError:
+                if eof:
+                    raise
+                # Element continues past the buffer; at least double what is buffered
+                want = max(want, 2 * (len(buf) - pos))
+                buf, pos, base, more = fill(buf, pos, base, want)
+                eof = not more
+        yield base + pos, end - pos, element
+        pos = end
+
+
+def read_at(fileobj, offset, length):
+    """
+    Decode the JSON value stored at a byte offset found by iter_array.
+    """
+    fileobj.seek(offset)
+    return json.loads(fileobj.read(length))
+
+
+class _Scanner(object):
+    """
+    Reads a JSON document through a sliding buffer, skipping over values without decoding them.
+    """
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.base = fileobj.tell() if hasattr(fileobj, 'tell') else 0  # file offset of buf[0]
+        self.buf = ''
+        self.pos = 0
+
+    def offset(self):
+        return self.base + self.pos
+
+    def more(self):
+        # Drop consumed bytes and read another chunk; False at EOF
+        self.base += self.pos
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        data = self.fileobj.read(self.chunk_size)
+        self.buf += data
+        return bool(data)
+
+    def peek(self):
+        """
+        The next character that is not whitespace ('' at EOF), left unconsumed.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ''
+
+    def search(self, pattern):
+        """
+        Move to the next match of pattern and return the matched character.
+        """
+        while True:
+            match = pattern.search(self.buf, self.pos)
+            if match:
+                self.pos = match.start()
+                return match.group()
+            self.pos = len(self.buf)
+            if not self.more():
+                raise ValueError("Unterminated JSON value at offset {}".format(self.offset()))
+
+    def decode(self):
+        """
+        Decode the (small) value at the current position, e.g. an object key.
+        """
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                self.pos = end
+                return value
+            except ValueError:
+                if not self.more():
+                    raise
+
+    def skip_string(self):
+        self.pos += 1  # opening quote
+        while True:
+            char = self.search(_STRING_SPECIAL)
+            self.pos += 1
+            if char == '"':
+                return
+            # Backslash: the escaped character may be in the next chunk
+            if self.pos >= len(self.buf) and not self.more():
+                raise ValueError("Unterminated JSON string")
+            self.pos += 1
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            return self.skip_string()
+        if char not in '[{':
+            self.search(_SCALAR_END)
+            return
+        depth = 0
+        while True:
+            char = self.search(_STRUCTURAL)
+            if char == '"':
+                self.skip_string()
+                continue
+            self.pos += 1
+            depth += 1 if char in '[{' else -1
+            if depth == 0:
+                return
+
+
+def index_object(fileobj, chunk_size=1 << 16):
+    """
+    Locate the members of a JSON object without decoding their values, so a document
+    with a few very large members is indexed with one chunk of it in memory.
+
+    :param fileobj: file-like object opened in binary mode, positioned at the object.
+    :param chunk_size: bytes read per call to fileobj.read.
+    :return: OrderedDict of key -> (offset, length) of each member value in the file,
+        for read_at (or, after seeking to the offset, iter_array and index_object).
+    """
+    scanner = _Scanner(fileobj, chunk_size)
+    if scanner.peek() != '{':
+        raise ValueError("Expected a JSON object at offset {}".format(scanner.offset()))
+    scanner.pos += 1
+
+    index = OrderedDict()
+    while True:
+        char = scanner.peek()
+        if char == ',':
+            scanner.pos += 1
+            char = scanner.peek()
+        if char == '}':
+            return index
+        if char != '"':
+            raise ValueError("Expected a key at offset {}".format(scanner.offset()))
+        key = scanner.decode()
+        if scanner.peek() != ':':
+            raise ValueError("Expected ':' at offset {}".format(scanner.offset()))
+        scanner.pos += 1
+        scanner.peek()
+        offset = scanner.offset()
+        scanner.skip_value()
+        index[key] = (offset, scanner.offset() - offset)
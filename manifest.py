@@ -0,0 +1,75 @@
+'''
+Local manifest of content hashes for incremental syncs of OCW content into Contentful.
+'''
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+class Manifest(object):
+    def __init__(self, path='ocw_manifest.sqlite'):
+        """
+        Stores a content hash for each course record and sub-record (page, file, media,
+        instructor, tag) that has been synced, keyed by kind and Contentful entry id.
+        A later run compares the hash of the incoming record with the stored one and
+        only touches entries whose content changed. Hashes are read from SQLite on every
+        check, so processes sharing the file see each other's updates.
+
+        :param path: SQLite database file (created if missing); ':memory:' for a throwaway manifest.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'kind TEXT NOT NULL, uid TEXT NOT NULL, digest TEXT NOT NULL, '
+            'PRIMARY KEY (kind, uid))'
+        )
+        self._db.commit()
+
+    def digest(self, *parts):
+        """
+        Stable hash of JSON-serializable parts (key order does not matter).
+        """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+    def digest_chunks(self, chunks):
+        """
+        digest(value) computed from the compact, key-sorted JSON text of value given in
+        pieces (see course_record.json_chunks), so value never has to be decoded whole.
+        """
+        digest = hashlib.sha1('[')
+        for chunk in chunks:
+            digest.update(chunk)
+        digest.update(']')
+        return digest.hexdigest()
+
+    def is_current(self, kind, uid, digest):
+        with self._lock:
+            row = self._db.execute('SELECT digest FROM hashes WHERE kind = ? AND uid = ?', (kind, uid)).fetchone()
+        return row is not None and row[0] == digest
+
+    def update(self, rows):
+        """
+        Record hashes for entries that were synced successfully.
+
+        :param rows: iterable of (kind, uid, digest) tuples.
+        """
+        rows = list(rows)
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO hashes (kind, uid, digest) VALUES (?, ?, ?)', rows)
+            self._db.commit()
+
+    def forget(self, kind, uid):
+        """
+        Drop a stored hash so the next run syncs that entry again.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM hashes WHERE kind = ? AND uid = ?', (kind, uid))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
@@ -0,0 +1,151 @@
+'''
+Counters and latency histograms for the OCW -> Contentful import: add_courseware steps,
+entry operations per content type, and Contentful and S3 requests per verb. Exported in
+the Prometheus text format or as JSON, with an optional JSON-lines log of every event.
+'''
+from contextlib import contextmanager
+from functools import wraps
+import json
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Histogram, generate_latest
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Metrics(object):
+    def __init__(self, log=None, buckets=BUCKETS):
+        """
+        Every histogram also counts its observations (the _count series), so request and
+        step counters come with the latencies.
+
+        :param log: optional file object; each observation is written to it as one JSON line.
+        :param buckets: histogram bucket upper bounds in seconds.
+        """
+        self.log_file = log
+        self.registry = CollectorRegistry()
+        self.steps = Histogram(
+            'ocw_step_seconds', 'Time per add_courseware step call.',
+            ['step'], registry=self.registry, buckets=buckets)
+        self.entries = Histogram(
+            'ocw_entry_seconds', 'Time per entry operation (cache, find, create, update, save).',
+            ['content_type', 'operation'], registry=self.registry, buckets=buckets)
+        self.requests = Histogram(
+            'ocw_http_request_seconds', 'Time per Contentful or S3 request, retries included.',
+            ['service', 'verb', 'resource', 'status'], registry=self.registry, buckets=buckets)
+        self._log_lock = threading.Lock()
+
+    def log(self, event, **fields):
+        if self.log_file is None:
+            return
+        fields.update(event=event, ts=time.time())
+        line = json.dumps(fields, sort_keys=True)
+        with self._log_lock:
+            self.log_file.write(line + '\n')
+
+    def observe_step(self, step, seconds, **fields):
+        self.steps.labels(step=step).observe(seconds)
+        self.log('step', step=step, seconds=seconds, **fields)
+
+    def observe_entry(self, content_type, operation, seconds):
+        self.entries.labels(content_type=content_type, operation=operation).observe(seconds)
+        self.log('entry', content_type=content_type, operation=operation, seconds=seconds)
+
+    def observe_request(self, service, verb, resource, status, seconds):
+        self.requests.labels(service=service, verb=verb, resource=resource, status=str(status)).observe(seconds)
+        self.log('request', service=service, verb=verb, resource=resource, status=status, seconds=seconds)
+
+    @contextmanager
+    def step(self, step, **fields):
+        """
+        Time the body of a with statement as one call of step.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe_step(step, time.time() - started, **fields)
+
+    def timed(self, step, fn):
+        """
+        Wrap fn so each call is timed as one call of step.
+        """
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.step(step):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def instrument_s3(self, s3):
+        """
+        Time every call made by a boto3 S3 client through its botocore event hooks.
+        """
+        def before_call(model, context, **kwargs):
+            context['ocw_started'] = time.time()
+
+        def after_call(model, context, http_response=None, **kwargs):
+            started = context.pop('ocw_started', None)
+            if started is not None:
+                status = getattr(http_response, 'status_code', None)
+                self.observe_request('s3', model.http['method'], model.name, status, time.time() - started)
+
+        s3.meta.events.register('before-call.s3', before_call, unique_id='ocw-metrics-before')
+        s3.meta.events.register('after-call.s3', after_call, unique_id='ocw-metrics-after')
+        return s3
+
+    def prometheus(self):
+        """
+        :return: every metric in the Prometheus text exposition format.
+        """
+        return generate_latest(self.registry)
+
+    def snapshot(self):
+        """
+        :return: {metric: [{labels..., count, sum, buckets: {le: cumulative count}}]} for JSON export.
+        """
+        result = dict()
+        for metric in self.registry.collect():
+            series = dict()
+            for sample in metric.samples:
+                labels = dict((k, v) for k, v in sample.labels.items() if k != 'le')
+                key = tuple(sorted(labels.items()))
+                row = series.setdefault(key, dict(labels, count=0, sum=0.0, buckets=dict()))
+                if sample.name.endswith('_bucket'):
+                    row['buckets'][sample.labels['le']] = sample.value
+                elif sample.name.endswith('_count'):
+                    row['count'] = int(sample.value)
+                elif sample.name.endswith('_sum'):
+                    row['sum'] = sample.value
+            result[metric.name] = [series[k] for k in sorted(series)]
+        return result
+
+
+_default_metrics = None
+_default_lock = threading.Lock()
+
+
+def default_metrics():
+    """
+    The process-wide Metrics shared by every client that is not given its own.
+    """
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
+
+
+def request_resource(url):
+    """
+    Resource name of a Management API path, e.g. 'entries' for
+    /spaces/<id>/environments/<id>/entries/<id>.
+    """
+    parts = [p for p in url.split('?')[0].split('/') if p]
+    for i, p in enumerate(parts):
+        if p == 'environments' and len(parts) > i + 2:
+            return parts[i + 2]
+    if 'spaces' in parts and len(parts) > parts.index('spaces') + 2:
+        return parts[parts.index('spaces') + 2]
+    return parts[-1] if parts else ''
@@ -0,0 +1,267 @@
+'''
+Persistent local mirror of the entries in the Contentful space, kept current with sync tokens.
+'''
+from itertools import count
+import json
+import sqlite3
+import threading
+import urlparse
+
+from contentful_management.errors import get_error
+
+from scheduler import ScheduledClient
+import secure
+
+
+# Longest text kept in the mirror (a Symbol field's limit); longer text is left out
+SYMBOL_LENGTH = 256
+# Entries per Management API page when versions are listed (select=sys allows up to 1000)
+VERSIONS_PAGE = 1000
+# Ids per sys.id[in] query when the versions of changed entries are looked up
+LOOKUP_BATCH = 100
+
+
+def _is_link(value):
+    return isinstance(value, dict) and value.get('sys', {}).get('type') == 'Link'
+
+
+def _mirrored(value):
+    if isinstance(value, basestring):
+        return len(value) <= SYMBOL_LENGTH
+    return _is_link(value) or (isinstance(value, list) and bool(value) and all(_is_link(v) for v in value))
+
+
+def mirrored_fields(fields):
+    """
+    The part of an entry's localized fields kept in the mirror: references (links and
+    arrays of links) and short text such as department and course numbers.
+    """
+    mirrored = dict()
+    for field_id, locales in (fields or {}).items():
+        if field_id is None or not isinstance(locales, dict):
+            continue
+        values = dict((locale, value) for locale, value in locales.items() if _mirrored(value))
+        if values:
+            mirrored[field_id] = values
+    return mirrored
+
+
+def _entry_json(entry):
+    # contentful_management Entry (kept current by save) or async_client.AsyncEntry
+    return entry.to_json() if hasattr(entry, 'to_json') else entry.raw
+
+
+def sync_client():
+    """
+    Client for the sync endpoint: SYNC_API_TOKEN and SYNC_API_URL from secure.py. The
+    token is a Content Preview API token (drafts included) for the default
+    preview.contentful.com, or a Content Delivery API token with SYNC_API_URL =
+    'cdn.contentful.com' (published entries only; drafts are then looked up when written).
+
+    :raises ValueError: if secure.py has no SYNC_API_TOKEN (the management token is not accepted there).
+    """
+    token = getattr(secure, 'SYNC_API_TOKEN', None)
+    if not token:
+        raise ValueError('SpaceMirror.sync needs SYNC_API_TOKEN in secure.py: a Content Preview API token '
+                         '(see secure.py.example)')
+    return ScheduledClient(token, api_url=getattr(secure, 'SYNC_API_URL', 'preview.contentful.com'))
+
+
+def _versions(client, entry_uids=None):
+    """
+    Current Management API versions, listed with select=sys.
+
+    :param entry_uids: ids to look up; every entry in the space when None.
+    :return: {entry id: (version, updatedAt)}
+    """
+    url = 'spaces/{}/environments/{}/entries'.format(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+    if entry_uids is None:
+        queries = ({'select': 'sys', 'limit': VERSIONS_PAGE, 'skip': skip} for skip in count(0, VERSIONS_PAGE))
+    else:
+        entry_uids = sorted(set(entry_uids))
+        queries = ({'select': 'sys', 'limit': LOOKUP_BATCH, 'sys.id[in]': ','.join(entry_uids[i:i + LOOKUP_BATCH])}
+                   for i in range(0, len(entry_uids), LOOKUP_BATCH))
+    versions = dict()
+    for query in queries:
+        response = client._http_request('get', url, {'params': query})
+        if response.status_code >= 300:
+            raise get_error(response)
+        page = response.json()
+        for item in page['items']:
+            versions[item['sys']['id']] = (item['sys']['version'], item['sys'].get('updatedAt'))
+        if entry_uids is None and query['skip'] + len(page['items']) >= page['total']:
+            break
+    return versions
+
+
+class SpaceMirror(object):
+    def __init__(self, path='ocw_mirror.sqlite'):
+        """
+        Id, content type, version, references and short text fields (see
+        mirrored_fields) of every entry in the space,
+        stored in SQLite so that new processes and reruns know what exists without
+        listing or fetching entries. sync() fills it with an initial sync and then
+        applies only the changes since the stored sync token; a Translate given the
+        mirror records its own writes in it as they happen.
+
+        Versions are those of the Management API. Sync items only carry a revision, so
+        sync() lists the versions with the Management API; an entry whose version is
+        unknown, or changed between the two reads, is fetched once before it is written.
+
+        Every process opens its own SpaceMirror on the same file.
+
+        :param path: SQLite database file (created if missing); ':memory:' for a throwaway mirror.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'id TEXT PRIMARY KEY, content_type TEXT NOT NULL, version INTEGER, fields TEXT NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_content_type ON entries (content_type)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._db.commit()
+
+    @property
+    def sync_token(self):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM state WHERE key = ?', ('sync_token',)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, client=None, limit=1000, management_client=None):
+        """
+        Bring the mirror up to date: an initial sync the first time, afterwards only the
+        entries changed or deleted since the last sync. The new sync token is stored
+        with the last page, so an interrupted sync starts over from the previous token.
+        The versions of the synced entries are then read from the Management API (sys
+        only): every entry page by page after an initial sync, the changed ones by id
+        otherwise.
+
+        :param client: contentful_management.Client to send sync requests with (defaults to sync_client()).
+        :param limit: items per page.
+        :param management_client: contentful_management.Client for the Management API
+            (defaults to a scheduler.ScheduledClient with MANAGEMENT_API_TOKEN).
+        :return: dict with the number of entries updated and deleted.
+        """
+        client = client or sync_client()
+        url = 'spaces/{}/environments/{}/sync'.format(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+        token = self.sync_token
+        params = {'sync_token': token} if token else {'initial': 'true', 'type': 'Entry'}
+        counts = dict(updated=0, deleted=0)
+        items, deleted = [], []
+        while True:
+            params['limit'] = limit
+            response = client._http_request('get', url, {'params': params})
+            if response.status_code >= 300:
+                raise get_error(response)
+            page = response.json()
+            for item in page.get('items', []):
+                if item['sys']['type'] == 'DeletedEntry':
+                    deleted.append((item['sys']['id'],))
+                elif item['sys']['type'] == 'Entry':
+                    items.append(item)
+            next_url = page.get('nextPageUrl') or page.get('nextSyncUrl')
+            params = dict(urlparse.parse_qsl(urlparse.urlparse(next_url).query))
+            if 'nextSyncUrl' in page:
+                break
+
+        management_client = management_client or ScheduledClient(secure.MANAGEMENT_API_TOKEN)
+        versions = _versions(management_client, None if token is None else [item['sys']['id'] for item in items])
+        rows = []
+        for item in items:
+            version, updated_at = versions.get(item['sys']['id'], (None, None))
+            # Edited after the sync read it: the version does not go with the mirrored fields
+            if updated_at != item['sys'].get('updatedAt'):
+                version = None
+            rows.append(self._row(item, version))
+
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO entries (id, content_type, version, fields) '
+                                 'VALUES (?, ?, ?, ?)', rows)
+            self._db.executemany('DELETE FROM entries WHERE id = ?', deleted)
+            self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                             ('sync_token', params['sync_token']))
+            self._db.commit()
+        counts['updated'], counts['deleted'] = len(rows), len(deleted)
+        return counts
+
+    def _row(self, item, version):
+        sys = item['sys']
+        return (sys['id'], sys['contentType']['sys']['id'], version,
+                json.dumps(mirrored_fields(item.get('fields')), sort_keys=True))
+
+    def record(self, entry):
+        """
+        Store an entry as just written (created, patched or saved) through the Management API.
+        """
+        raw = _entry_json(entry)
+        row = self._row(raw, raw['sys'].get('version'))
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries (id, content_type, version, fields) '
+                             'VALUES (?, ?, ?, ?)', row)
+            self._db.commit()
+
+    def published(self, entry_uid, version):
+        """
+        Publishing an entry at version bumps it to version + 1.
+        """
+        with self._lock:
+            self._db.execute('UPDATE entries SET version = ? WHERE id = ? AND version = ?',
+                             (version + 1, entry_uid, version))
+            self._db.commit()
+
+    def forget(self, entry_uid):
+        """
+        Drop an entry whose mirrored state turned out to be wrong, so it is fetched again.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM entries WHERE id = ?', (entry_uid,))
+            self._db.commit()
+
+    def get(self, entry_uid):
+        """
+        :return: dict with content_type, version (None if unknown) and fields, or None if not mirrored.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT content_type, version, fields FROM entries WHERE id = ?',
+                                   (entry_uid,)).fetchone()
+        if row is None:
+            return None
+        return dict(content_type=row[0], version=row[1], fields=json.loads(row[2]))
+
+    def entry_json(self, entry_uid):
+        """
+        Entry JSON holding only sys and the mirrored fields, for an entry whose version
+        is known; None otherwise.
+        """
+        mirrored = self.get(entry_uid)
+        if mirrored is None or mirrored['version'] is None:
+            return None
+        return {
+            'sys': {
+                'type': 'Entry', 'id': entry_uid, 'version': mirrored['version'],
+                'contentType': {'sys': {'type': 'Link', 'linkType': 'ContentType', 'id': mirrored['content_type']}},
+                'space': {'sys': {'type': 'Link', 'linkType': 'Space', 'id': secure.SPACE_ID}},
+                'environment': {'sys': {'type': 'Link', 'linkType': 'Environment', 'id': secure.ENVIRONMENT_ID}},
+            },
+            'fields': mirrored['fields'],
+        }
+
+    def ids(self, content_type_id):
+        """
+        :return: set of the ids of every mirrored entry of a content type.
+        """
+        with self._lock:
+            return set(row[0] for row in self._db.execute(
+                'SELECT id FROM entries WHERE content_type = ?', (content_type_id,)))
+
+    def __contains__(self, entry_uid):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries WHERE id = ?', (entry_uid,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
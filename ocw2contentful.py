@@ -1,32 +1,90 @@
-from collections import defaultdict
-import fnmatch
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
 import json
-import urllib
+import time
 
 import boto3
-from BeautifulSoup import BeautifulSoup
-import contentful_management
-
-from contentful_mapping import Translate
+from contentful_management.resource import Link
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from assets import AssetIngester
+from contentful_mapping import Translate, UnitOfWork
+import course_record
+from html_clean import HtmlCleaner
+from http_cache import HttpCache
+from journal import CREATED
+from metrics import default_metrics
+from ocw_parser import OCW
+from s3_index import MASTER_SUFFIX, MasterKeyIndex
+from scheduler import ScheduledClient
 import secure
 
 
-client = contentful_management.Client(secure.MANAGEMENT_API_TOKEN)
+client = ScheduledClient(secure.MANAGEMENT_API_TOKEN)
 sid = secure.SPACE_ID
 eid = secure.ENVIRONMENT_ID
 
+DEPARTMENTS_URL = "https://ocw.mit.edu/courses/find-by-number/departments.json"
+DEPARTMENT_URL = "https://ocw.mit.edu/courses/{0}/{0}.json"
+
 
 class Ocw2Contentful(object):
-    def __init__(self):
+    def __init__(self, s3=None, master_index_path=None, http_cache=None, translate=None, metrics=None,
+                 mirror=None):
         """
-        :param bucket: s3 bucket containing OCW data organized by course.
+        :param s3: boto3 S3 client for the bucket containing OCW data organized by course
+            (defaults to a new client; pass a moto or local stand-in client for tests).
+        :param master_index_path: optional file for a catalog-wide s3_index.MasterKeyIndex.
+            When set, master keys are looked up in the index instead of listing each course.
+        :param http_cache: http_cache.HttpCache used for OCW JSON endpoints (defaults to
+            the on-disk cache in .ocw_http_cache).
+        :param translate: contentful_mapping.Translate used for entries (defaults to a new one;
+            pass an async_client.AsyncTranslate for add_courseware_async).
+        :param metrics: metrics.Metrics receiving step timings and S3 request timings
+            (defaults to default_metrics(), shared with the Contentful clients).
+        :param mirror: mirror.SpaceMirror given to the default Translate, so existing entries
+            are known without reading them from Contentful.
         """
-        self.s3 = boto3.client("s3")
-        self.T = Translate()
-        department_url = "https://ocw.mit.edu/courses/find-by-number/departments.json"
-        jdata = json.loads(urllib.urlopen(department_url).read())
+        self.metrics = metrics or default_metrics()
+        self.s3 = self.metrics.instrument_s3(s3 or boto3.client("s3"))
+        self.T = translate or Translate(metrics=self.metrics, mirror=mirror)
+        self.http_cache = http_cache or HttpCache()
+        self.html_cleaner = HtmlCleaner()
+        self.shared = dict()  # entry id -> Link for departments, tags and instructors created by add_shared_entities
+        jdata = self.http_cache.get_json(DEPARTMENTS_URL)
         self.departments_by_num = dict((r['depNo'], r) for r in jdata)
         self.departments_by_title = dict((r['title'], r) for r in jdata)
+        self.master_index = None
+        if master_index_path:
+            self.master_index = MasterKeyIndex(self.s3, secure.BUCKET, master_index_path)
+            if not len(self.master_index):
+                self.master_index.refresh()
+
+    def _course_prefix(self, ocw_url):
+        try: 
+            return ocw_url.split('/')[5]
+        except:
+            print("Something went wrong splitting your url with /.\n{}".format(ocw_url.split('/')))
+            raise
+
+    def get_master_key(self, prefix):
+        """
+        Find the _master.json key for a course prefix, from the master index when there is
+        one, otherwise by listing the prefix (all pages, so large courses are covered).
+        """
+        if self.master_index is not None:
+            course = self.master_index.get(prefix)
+            if course:
+                return course['key']
+
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=secure.BUCKET, Prefix=prefix, StartAfter=prefix):
+            for r in page.get('Contents', []):
+                if r['Key'].endswith(MASTER_SUFFIX):
+                    return r['Key']
+        raise KeyError("No {} found under {}".format(MASTER_SUFFIX, prefix))
 
     def get_courseware_metadata(self, ocw_url):
         """
@@ -37,20 +95,26 @@ class Ocw2Contentful(object):
         :param ocw_url: str, making up the unique pattern in an OCW URL
         :return:
         """
-        try: 
-            prefix = ocw_url.split('/')[5]
-        except:
-            print("Something went wrong splitting your url with /.\n{}".format(ocw_url.split('/')))
-
-        contents = self.s3.list_objects_v2(Bucket=secure.BUCKET, Prefix=prefix, StartAfter=prefix)['Contents']
-        course_keys = [r['Key'] for r in contents if "_master.json" in r['Key']] 
-        master_key = fnmatch.filter(course_keys, "*_master.json")[0]
+        master_key = self.get_master_key(self._course_prefix(ocw_url))
         record = self.s3.get_object(Bucket=secure.BUCKET, Key=master_key)
         return json.loads(record['Body'].read().decode())
 
+    def open_courseware_metadata(self, ocw_url):
+        """
+        Streaming version of get_courseware_metadata: the master file is copied to a
+        temporary file in chunks and returned as a course_record.CourseRecord, whose
+        course_pages, course_files and course_embedded_media are read one record at a
+        time with course_record.stream(). Close it (or use it in a with block) when done.
+        """
+        master_key = self.get_master_key(self._course_prefix(ocw_url))
+        return course_record.CourseRecord.from_s3(self.s3, secure.BUCKET, master_key)
+
     def _make_camel(self, string):
         return ''.join(x for x in string.title() if x.isalnum())
 
+    def _tag_uid(self, record):
+        return self._make_camel(record['name'][0:64])  # contentful uids max 64 char
+
     def _generate_tracking_title(self, courseware, title):
         return u"{}.{} - {}".format(
             courseware.fields()['department_number'], 
@@ -59,18 +123,12 @@ class Ocw2Contentful(object):
         )
 
     def _clean_html(self, html):
-        if html: 
-            soup = BeautifulSoup(html)
-            for tag in soup():
-                for attribute in ["class", "name", "style", "scope"]:
-                    del tag[attribute]
-
-            for link_tag in soup.findAll('a'):
-                if "href" in link_tag and "/courses/" in link_tag["href"]:
-                    link_tag["href"] = "https://ocw.mit.edu" + link_tag["href"]
-            return unicode(soup.prettify(), errors='replace')
-        else:
-            return html
+        """
+        Strip presentational attributes and absolutize /courses/ links; see html_clean for
+        how the output compares to the former BeautifulSoup 3 version.
+        """
+        with self.metrics.step('clean_html'):
+            return self.html_cleaner.clean(html)
 
     def _prepare_metadata(self, record, delete_fields=None, additional_metadata=None):
         metadata = dict((k,record[k]) for k in record.keys() if isinstance(record[k], unicode)==True)
@@ -84,7 +142,7 @@ class Ocw2Contentful(object):
 
         return metadata
 
-    def create_courseware(self, record):
+    def create_courseware(self, record, update=False):
         """
         Create an autoCourseware entry inside Contentful space. Does not create if the
         entry already exists.
@@ -102,7 +160,7 @@ class Ocw2Contentful(object):
                 u'tracking_title': tracking_title,
             },
         )
-        return self.T.create_entry('courseware', record['uid'], metadata)
+        return self.T.create_entry('courseware', record['uid'], metadata, update)
 
     def create_department(self, record):
         """
@@ -114,6 +172,8 @@ class Ocw2Contentful(object):
 
         :param record: dict, with fields shown above
         """
+        if record['id'] in self.shared:
+            return self.shared[record['id']]
         metadata = self._prepare_metadata(
             record,
             delete_fields=None,
@@ -121,7 +181,7 @@ class Ocw2Contentful(object):
         )
         return self.T.create_entry('department', record['id'], metadata)
 
-    def create_instructor(self, record, courseware):
+    def create_instructor(self, record, courseware, update=False):
         """
         Create an Instructor entry inside Contentful space. Does not create if the
         entry already exists. Example:
@@ -140,6 +200,8 @@ class Ocw2Contentful(object):
         :param irecord: JSON record with instructor metadata
         :return: Contentful Entry for instructor content type 
         """
+        if record['uid'] in self.shared and not update:
+            return self.shared[record['uid']]
         ### Pattern Break: faculty listed by school, rather than department (e.g., School of Engineering)
         if record['department'] in self.departments_by_title:
             department_entry = self.create_department(
@@ -152,9 +214,9 @@ class Ocw2Contentful(object):
             delete_fields=['uid', 'mit_id', 'department'],
             additional_metadata={'department': [department_entry]},
         )
-        return self.T.new_create_entry('instructor', record['uid'], metadata)
+        return self.T.new_create_entry('instructor', record['uid'], metadata, update)
 
-    def create_tag(self, record):
+    def create_tag(self, record, update=False):
         """
         Old OCW tagging hierarchy: Topic -> Subtopic -> Speciality
         New tagging is just a list of keywords.
@@ -168,15 +230,17 @@ class Ocw2Contentful(object):
         :param record: JSON record with tag metadata 
         :return: Contentful Entry for the tag 
         """
-        uid = self._make_camel(record['name'][0:64])  # contentful uids max 64 char
+        uid = self._tag_uid(record)
+        if uid in self.shared and not update:
+            return self.shared[uid]
         metadata = self._prepare_metadata(
             record, 
             delete_fields=None,
             additional_metadata=None,
         )
-        return self.T.create_entry('tag', uid, metadata)
+        return self.T.create_entry('tag', uid, metadata, update)
 
-    def create_course_page(self, record, courseware):
+    def create_course_page(self, record, courseware, update=False):
         """
         Example Course Page.
         {
@@ -204,9 +268,9 @@ class Ocw2Contentful(object):
         # Likely candidate for future refactor; requires changing content model in contentful.
         metadata[u"course_page_type"] = metadata.pop("type")
         metadata[u"text"] = self._clean_html(record["text"])
-        return self.T.create_entry("course_page", record["uid"], metadata)
+        return self.T.create_entry("course_page", record["uid"], metadata, update)
 
-    def create_course_file(self, record, courseware):
+    def create_course_file(self, record, courseware, update=False):
         """
         Example Course File.
         {
@@ -233,9 +297,9 @@ class Ocw2Contentful(object):
                 u'courseware': courseware,
             },
         )
-        return self.T.create_entry('course_file', record['uid'], metadata)
+        return self.T.create_entry('course_file', record['uid'], metadata, update)
 
-    def create_course_embedded_media(self, record, courseware):
+    def create_course_embedded_media(self, record, courseware, update=False):
         """
             "course_embedded_media": {
                 "65153023courseintroduction80419621": {
@@ -279,87 +343,449 @@ class Ocw2Contentful(object):
                 u'courseware': [courseware],
             },
         )
-        return self.T.create_entry('embedded_media', record['uid'], metadata)
+        return self.T.create_entry('embedded_media', record['uid'], metadata, update)
 
-    def add_courseware(self, ocw_url):
+    def _prepare_embedded_media(self, record):
         """
-        Main routine to add a single course from OCW to Contentful.
+        Flatten each embedded media page with its YouTube stream id. Field size limits
+        (e.g. 200 characters for the stream id, 250 for the location) come from the
+        embeddedMedia content type and are applied by the Translate mapper (or, without a
+        schema, by the fallback limits in contentful_mapping).
         """
-        #Grab the single course record from OCW JSON data
-        record = self.get_courseware_metadata(ocw_url)
-
-        #Step 1: create the basic metadata for a courseware entry in Contentful
-        courseware = self.create_courseware(record)
-
-        #Step 2: add department
-        department = self.create_department(
-            self.departments_by_num[record['department_number']])
-        courseware.department = [department]
-        courseware.save()
-
-        #Step 3: iterate over the faculty list; create if does not exist, link to courseware
-        courseware.instructors = [self.create_instructor(
-            f, courseware) for f in record['instructors']]
-        courseware.save()
-
-        #Step 4: iterate through course tags and attach to courseware
-        # Update new_courseware with tag clinks
-        courseware.tags = [self.create_tag(t) for t in record['tags']]
-        courseware.save()
-
-        #Step 5: iterate through course pages and attach to courseware
-        courseware.course_pages = [self.create_course_page(cp, courseware) for cp in record['course_pages']]
-        print([p.sys['id'] for p in courseware.course_pages])
-        courseware.save()
-
-        #Step 6: iterate through course files, create them, then go back and add them to each course page
-        page_links = defaultdict(list)
-        for cf in record['course_files']:
-            page_links[cf['parent_uid']].append(
-                self.create_course_file(cf, courseware))
-
-        # Link all files
-        courseware.course_files = list(
-            set(j for i in page_links for j in page_links[i]))  # Grabbing unique entries
-        courseware.save()
-
-        # Link to specific course pages
-        for key in page_links:
-            try:
-                # print(key, page_links[key])
-                course_page = client.entries(sid, eid).find(key)
-                course_page.files = page_links[key]
-                course_page.save()
-                print("Added {} files to {} page.".format(
-                    len(page_links[key]), key))
-            except Exception as e:
-                print("Issue saving entries to course pages: {}".format(key))
-                print(e)
-
-        #Step 7: iterate through embedded media, create entries, and attach to course page
-        em_links = defaultdict(list)
-        for key in record['course_embedded_media']:
-            page = record['course_embedded_media'][key]
-            em = {r['id']: r['media_info'][0:200]
+        for page in course_record.stream(record, 'course_embedded_media'):
+            em = {r['id']: r['media_info']
                   for r in page['embedded_media'] if r["id"] == "Video-YouTube-Stream"}
             page.update(em)
-            page['technical_location'] = page['technical_location'][0:250]
-            em_links[page['parent_uid']].append(
-                self.create_course_embedded_media(page, courseware))
-
-        for key in em_links:
-            try:
-                course_page = client.entries(sid, eid).find(key)
-                course_page.files = em_links[key]
-                course_page.save()
-                print("Added {} files to {} page.".format(
-                    len(em_links[key]), key))
-            except Exception as e:
-                print("Issue saving media to course pages: {}".format(key))
-                print(e)
+            yield page
+
+    def _as_link(self, entry):
+        """
+        Link to a created entry, so the Entry (and its fields) need not be kept for linking.
+        """
+        if isinstance(entry, Link):
+            return entry
+        return self.T.entry_link(entry.sys['id'])
+
+    def _link_to_page(self, uow, pages_by_uid, parent_uid, entry):
+        """
+        Queue a link from a course page (created in step 5) to a file or media entry.
+        """
+        if parent_uid in pages_by_uid:
+            uow.add_links(pages_by_uid[parent_uid], 'files', [entry])
+        else:
+            print("Issue linking {} to course pages: {}".format(entry.sys['id'], parent_uid))
 
+    def _submit_changed(self, pool, manifest, synced, journal, kind, uid, parts, fn, *args):
+        """
+        Submit fn(*args) to the pool. With a manifest, a record whose content hash is
+        unchanged since the last sync is not sent at all and resolves to a link to its
+        existing entry; changed records update their entry and are queued in synced.
+        """
+        if manifest is None:
+            return self._submit_journaled(pool, journal, uid, False, fn, *args)
+        digest = manifest.digest(*parts)
+        if manifest.is_current(kind, uid, digest):
+            return _resolved(self.T.entry_link(uid))
+        synced.append((kind, uid, digest))
+        return self._submit_journaled(pool, journal, uid, False, fn, *args, update=True)
+
+    def _submit_journaled(self, pool, journal, uid, needs_entry, fn, *args, **kwargs):
+        """
+        Submit fn(*args, **kwargs) to the pool and journal the entry once it exists. An
+        entry already journaled by an interrupted run resolves to a link without a read,
+        or, with needs_entry (it still has fields to save), is fetched with a single find.
+        """
+        if journal is None:
+            return pool.submit(fn, *args, **kwargs)
+        if journal.state(uid) is not None:
+            if needs_entry:
+                return pool.submit(self.T.find_entry, uid)
+            return _resolved(self.T.entry_link(uid))
+
+        def create():
+            entry = fn(*args, **kwargs)
+            journal.created(uid)
+            return entry
+        return pool.submit(create)
+
+    def _submit_page(self, pool, manifest, synced, journal, fn, record, children, courseware):
+        """
+        _submit_changed for a course page. A journaled page whose links were already
+        saved resolves to a link and is left alone, like an unchanged page; one that
+        still has files or media to link is fetched so they can be saved on it.
+        """
+        if journal is not None and children and journal.state(record['uid']) == CREATED:
+            if manifest is not None:
+                synced.append(('course_page', record['uid'], manifest.digest(record, sorted(children))))
+            return self._submit_journaled(pool, journal, record['uid'], True, fn, record, courseware)
+        return self._submit_changed(pool, manifest, synced, journal, 'course_page', record['uid'],
+                                    (record, sorted(children)), fn, record, courseware)
+
+    def add_courseware(self, ocw_url, workers=None, manifest=None, journal=None):
+        """
+        Main routine to add a single course from OCW to Contentful.
+
+        Entries are created in dependency order: the department before the courseware,
+        the courseware before its instructors, tags, pages, files and media, and the
+        pages before the files and media are linked to them. Creates that do not depend
+        on each other are submitted together, so with workers > 1 they run on a bounded
+        thread pool; without workers every call runs immediately, in the same order.
+        Link changes are collected in a UnitOfWork and each changed entry is saved once.
+
+        The course record is streamed (see open_courseware_metadata): pages, files and
+        media are decoded as they are submitted, with at most 4 x workers of each kind
+        pending, and created files and media are kept as links only. Memory per course
+        is bounded by that window, the page entries that are saved with their links, and
+        the ids of files and media per page.
+
+        With a manifest the run is incremental: an unchanged course is skipped entirely,
+        and within a changed course only the entries whose content hash changed are
+        created or updated. A page's hash covers the ids of its files and media, so a
+        page is re-linked whenever its children change.
+
+        With a journal the run can be resumed after a failure: a course the journal has
+        finished is skipped before any request, and in an interrupted course every entry
+        created or saved before the failure is linked by id instead of being looked up.
+        Only the courseware and the pages whose links were not saved yet are fetched.
+
+        Every step is timed in self.metrics: 'fetch', one observation per create call
+        in steps '1_courseware' (which includes the department) and '3_instructors' to
+        '7_embedded_media', 'save' for the final flush and 'course' for the whole course.
+
+        :param ocw_url: str, OCW course URL (see get_courseware_metadata)
+        :param workers: int, size of the thread pool used for independent creates
+        :param manifest: manifest.Manifest holding content hashes from previous runs
+        :param journal: journal.Journal recording the progress of this run
+        :return: Contentful Entry for the courseware (a Link if the course was skipped)
+        """
+        if journal is not None:
+            finished = journal.finished(self._course_prefix(ocw_url))
+            if finished:
+                print("Skipping finished courseware: {}".format(finished))
+                return self.T.entry_link(finished)
+            journal = journal.course(self._course_prefix(ocw_url))
+
+        started = time.time()
+        step = self.metrics.timed
+
+        #Grab the single course record from OCW JSON data; pages, files and media are
+        #read from it one at a time as they are submitted
+        with self.metrics.step('fetch'):
+            record = self.open_courseware_metadata(ocw_url)
+        try:
+            synced = []
+            if manifest is not None:
+                course_digest = manifest.digest_chunks(course_record.json_chunks(record))
+                if manifest.is_current('courseware', record['uid'], course_digest):
+                    print("Skipping unchanged courseware: {}".format(record['uid']))
+                    return self.T.entry_link(record['uid'])
+
+            # Records submitted but not yet created, per step
+            depth = 4 * (workers or 1)
+
+            with _executor(workers) as pool:
+                #Step 1: create the basic metadata for a courseware entry in Contentful
+                #(create_courseware resolves the department before the courseware itself)
+                courseware = self._submit_journaled(pool, journal, record['uid'], True,
+                                                    step('1_courseware', self.create_courseware),
+                                                    record, update=manifest is not None).result()
+
+                #A first pass over the files and media collects the ids each page links to
+                children = defaultdict(list)
+                for r in itertools.chain(course_record.stream(record, 'course_files'),
+                                         self._prepare_embedded_media(record)):
+                    children[r['parent_uid']].append(r['uid'])
+
+                #Steps 3-5 only need the courseware entry, so their creates go out together
+                create_instructor = step('3_instructors', self.create_instructor)
+                instructors = [self._submit_changed(pool, manifest, synced, journal, 'instructor', f['uid'], (f,),
+                                                    create_instructor, f, courseware)
+                               for f in record['instructors']]
+                create_tag = step('4_tags', self.create_tag)
+                tags = [self._submit_changed(pool, manifest, synced, journal, 'tag', self._tag_uid(t), (t,),
+                                             create_tag, t)
+                        for t in record['tags']]
+                create_course_page = step('5_course_pages', self.create_course_page)
+                pages = [page for uid, page in _pipelined(
+                    ((cp['uid'], self._submit_page(pool, manifest, synced, journal, create_course_page, cp,
+                                                   children[cp['uid']], courseware))
+                     for cp in course_record.stream(record, 'course_pages')), depth)]
+
+                uow = UnitOfWork(self.T)
+
+                #Step 2: the department was linked when the courseware was created in step 1
+
+                #Step 3: link the faculty list
+                uow.set(courseware, 'instructors', [f.result() for f in instructors])
+
+                #Step 4: link the course tags
+                uow.set(courseware, 'tags', [t.result() for t in tags])
+
+                #Step 5: link the course pages; keep the ones just written so steps 6 and 7 can link to them
+                uow.set(courseware, 'course_pages', pages)
+                print([p.sys['id'] for p in pages])
+                pages_by_uid = dict((p.sys['id'], p) for p in pages if not isinstance(p, Link))
+                unchanged_pages = set(p.sys['id'] for p in pages if isinstance(p, Link))
+
+                #Step 6: create the course files, linked to the courseware and to their course page
+                create_course_file = step('6_course_files', self.create_course_file)
+                course_files = ((cf['parent_uid'],
+                                 self._submit_changed(pool, manifest, synced, journal, 'course_file', cf['uid'],
+                                                      (cf,), create_course_file, cf, courseware))
+                                for cf in course_record.stream(record, 'course_files'))
+                for parent_uid, cf in _pipelined(course_files, depth):
+                    cf = self._as_link(cf)
+                    uow.add_links(courseware, 'course_files', [cf])
+                    if parent_uid not in unchanged_pages:
+                        self._link_to_page(uow, pages_by_uid, parent_uid, cf)
+
+                #Step 7: create the embedded media, linked to their course page next to the files
+                create_embedded_media = step('7_embedded_media', self.create_course_embedded_media)
+                embedded_media = ((page['parent_uid'],
+                                   self._submit_changed(pool, manifest, synced, journal, 'embedded_media',
+                                                        page['uid'], (page,), create_embedded_media, page, courseware))
+                                  for page in self._prepare_embedded_media(record))
+                for parent_uid, em in _pipelined(embedded_media, depth):
+                    if parent_uid not in unchanged_pages:
+                        self._link_to_page(uow, pages_by_uid, parent_uid, self._as_link(em))
+
+                #Save the courseware and every changed page once, with all links merged
+                with self.metrics.step('save'):
+                    saved = uow.flush(pool, on_save=journal.saved if journal is not None else None)
+                print("Saved {} entries for {}.".format(len(saved), courseware.sys['id']))
+        finally:
+            if isinstance(record, course_record.CourseRecord):
+                record.close()
+
+        if manifest is not None:
+            manifest.update(synced + [('courseware', record['uid'], course_digest)])
+        if journal is not None:
+            journal.finish(record['uid'])
+
+        self.metrics.observe_step('course', time.time() - started, uid=record['uid'])
         return courseware
 
+
+    def add_course_assets(self, ocw_url, workers=4, manifest=None, max_memory=64 << 20):
+        """
+        Upload the files of a course as Contentful assets, streamed from S3, and link each
+        one from its courseFile entry. Run after add_courseware has created the entries.
+
+        :param workers: int, parallel transfers.
+        :param manifest: optional manifest.Manifest; files whose S3 ETag is unchanged are skipped.
+        :param max_memory: bytes of file data held in memory at once across transfers.
+        :return: dict counting files per outcome: created, updated or skipped.
+        """
+        ingester = AssetIngester(self.s3, self.T, manifest=manifest, workers=workers,
+                                 max_memory=max_memory, metrics=self.metrics)
+        with self.open_courseware_metadata(ocw_url) as record, self.metrics.step('8_course_assets'):
+            counts = ingester.ingest(course_record.stream(record, 'course_files'))
+        print("Assets for {}: {}".format(record['uid'], counts))
+        return counts
+
+    def catalog_urls(self, department_ids=None):
+        """
+        Yield the OCW URL of every course in the given departments, read from each
+        department's JSON in stream mode.
+
+        :param department_ids: e.g. ['physics']; every department by default.
+        """
+        if department_ids is None:
+            department_ids = [self.departments_by_num[n]['id'] for n in sorted(self.departments_by_num)]
+        for department_id in department_ids:
+            with OCW(DEPARTMENT_URL.format(department_id), stream=True, http_cache=self.http_cache) as department:
+                for ocw_uid, course in department.iter_courses():
+                    yield course['course_path']
+
+    def _collect_shared(self, record, departments, tags, instructors):
+        """
+        Add the departments, tags and instructors of one course record, keyed by entry id.
+        """
+        department = self.departments_by_num[record['department_number']]
+        departments.setdefault(department['id'], department)
+        for f in record['instructors']:
+            instructors.setdefault(f['uid'], f)
+            if f['department'] in self.departments_by_title:
+                department = self.departments_by_title[f['department']]
+                departments.setdefault(department['id'], department)
+        for t in record['tags']:
+            tags.setdefault(self._tag_uid(t), t)
+
+    def add_shared_entities(self, records, workers=None):
+        """
+        Phase 1 of add_catalog: create each department, tag and instructor used by the
+        course records once, deduplicated by entry id. Afterwards create_department,
+        create_tag and create_instructor return links to them without any lookup.
+
+        :param records: iterable of course records (consumed once, not kept).
+        :param workers: int, size of the thread pool used for the creates.
+        :return: dict with the number of shared entities per kind.
+        """
+        departments, tags, instructors = dict(), dict(), dict()
+        for record in records:
+            self._collect_shared(record, departments, tags, instructors)
+
+        with _executor(workers) as pool:
+            #Departments first: instructors link to them
+            for group in [[(d['id'], pool.submit(self.create_department, d)) for d in departments.values()],
+                          [(uid, pool.submit(self.create_tag, t)) for uid, t in tags.items()] +
+                          [(uid, pool.submit(self.create_instructor, f, None)) for uid, f in instructors.items()]]:
+                for uid, future in group:
+                    future.result()
+                    self.shared[uid] = self.T.entry_link(uid)
+
+        print("Shared entities: {} departments, {} tags, {} instructors.".format(
+            len(departments), len(tags), len(instructors)))
+        return dict(department=len(departments), tag=len(tags), instructor=len(instructors))
+
+    def _catalog_record(self, ocw_url, manifest, journal):
+        """
+        The course record for phase 1 of add_catalog, or None if phase 2 will skip the course.
+        """
+        if journal is not None and journal.finished(self._course_prefix(ocw_url)):
+            return None
+        # Only the small members (instructors, tags) are used; the temporary copy can go
+        with self.open_courseware_metadata(ocw_url) as record:
+            if manifest is not None:
+                digest = manifest.digest_chunks(course_record.json_chunks(record))
+                if manifest.is_current('courseware', record['uid'], digest):
+                    return None
+        return record
+
+    def _scan_catalog(self, ocw_urls, workers, manifest, journal):
+        """
+        Yield the records add_catalog needs for phase 1, fetching a few at a time so
+        only a bounded number of records is held in memory.
+        """
+        batch = 4 * (workers or 1)
+        with _executor(workers) as pool:
+            for i in range(0, len(ocw_urls), batch):
+                futures = [pool.submit(self._catalog_record, url, manifest, journal)
+                           for url in ocw_urls[i:i + batch]]
+                for future in futures:
+                    record = future.result()
+                    if record is not None:
+                        yield record
+
+    def add_catalog(self, ocw_urls, workers=None, manifest=None, journal=None):
+        """
+        Two-phase import of many courses. Phase 1 reads every course record and creates
+        the departments, tags and instructors they share once each; phase 2 imports the
+        courses with add_courseware, which links those shared entries by id. Requests
+        for shared entities grow with the number of unique entities instead of with
+        courses x entities per course.
+
+        Courses the journal has finished or the manifest has unchanged are left out of
+        phase 1 as well as skipped in phase 2.
+
+        Usage:
+            OCW.add_catalog(OCW.catalog_urls(['physics', 'mathematics']), workers=8)
+
+        :param ocw_urls: iterable of OCW course URLs (see catalog_urls)
+        :return: list of courseware entries, one per URL (links for skipped courses)
+        """
+        ocw_urls = list(ocw_urls)
+        with self.metrics.step('catalog_shared'):
+            self.add_shared_entities(self._scan_catalog(ocw_urls, workers, manifest, journal), workers)
+        return [self.add_courseware(url, workers=workers, manifest=manifest, journal=journal) for url in ocw_urls]
+
+    @gen.coroutine
+    def add_courseware_async(self, ocw_url):
+        """
+        Coroutine version of add_courseware for an Ocw2Contentful built with an
+        async_client.AsyncTranslate. The same dependency order applies; every create of
+        steps 3-7 is in flight at once on the IOLoop, and the unit of work saves each
+        changed entry once.
+
+        Usage:
+            courseware = IOLoop.current().run_sync(lambda: OCW.add_courseware_async(url))
+        """
+        #Grab the single course record from S3 without blocking the IOLoop
+        started = time.time()
+        record = yield IOLoop.current().run_in_executor(None, self.get_courseware_metadata, ocw_url)
+        self.metrics.observe_step('fetch', time.time() - started)
+
+        #Step 1: courseware (its department is resolved inside create_courseware)
+        courseware = yield self.create_courseware(record)
+
+        #Steps 3-7: all creates go out together (shared entities may already be links)
+        media_pages = list(self._prepare_embedded_media(record))
+        instructors = [gen.maybe_future(self.create_instructor(f, courseware)) for f in record['instructors']]
+        tags = [gen.maybe_future(self.create_tag(t)) for t in record['tags']]
+        course_pages = [self.create_course_page(cp, courseware) for cp in record['course_pages']]
+        course_files = [self.create_course_file(cf, courseware) for cf in record['course_files']]
+        embedded_media = [self.create_course_embedded_media(page, courseware) for page in media_pages]
+
+        uow = UnitOfWork(self.T)
+        uow.set(courseware, 'instructors', (yield instructors))
+        uow.set(courseware, 'tags', (yield tags))
+        pages = yield course_pages
+        uow.set(courseware, 'course_pages', pages)
+        pages_by_uid = dict((p.sys['id'], p) for p in pages)
+
+        files = yield course_files
+        for cf, entry in zip(record['course_files'], files):
+            uow.add_links(courseware, 'course_files', [entry])
+            self._link_to_page(uow, pages_by_uid, cf['parent_uid'], entry)
+
+        media = yield embedded_media
+        for page, entry in zip(media_pages, media):
+            self._link_to_page(uow, pages_by_uid, page['parent_uid'], entry)
+
+        #Save the courseware and every changed page once, concurrently
+        flush_started = time.time()
+        saved = yield uow.flush()
+        self.metrics.observe_step('save', time.time() - flush_started)
+        print("Saved {} entries for {}.".format(len(saved), courseware.sys['id']))
+        self.metrics.observe_step('course', time.time() - started, uid=record['uid'])
+        raise gen.Return(courseware)
+
+class _SerialExecutor(object):
+    """
+    Executor with the ThreadPoolExecutor interface that runs each call as it is submitted.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _pipelined(submissions, depth):
+    """
+    Consume (tag, future) pairs from a lazy generator of submissions, keeping at most
+    depth of them pending, and yield (tag, result) in order.
+    """
+    pending = deque()
+    for tag, future in submissions:
+        pending.append((tag, future))
+        if len(pending) >= depth:
+            tag, future = pending.popleft()
+            yield tag, future.result()
+    while pending:
+        tag, future = pending.popleft()
+        yield tag, future.result()
+
+
+def _executor(workers):
+    if workers and workers > 1:
+        return ThreadPoolExecutor(max_workers=workers)
+    return _SerialExecutor()
+
 def _courseware_stats(record):
     keys = ['course_pages', 'tags', 'course_embedded_media', 'course_files']
     for k in keys:
@@ -381,16 +807,4 @@ if __name__ == "__main__":
     c = OCW.add_courseware(url)
     print("Success creating courseware: {}".format(c))
 
-    # OCW = Ocw2Contentful()
-    # counter = 0
-    # for k,v in OCW.departments_by_num.iteritems():
-    #     if counter < 10: 
-    #         dept_url = "https://ocw.mit.edu/courses/{}/{}.json".format(v['id'], v['id'])
-    #         dept_data = json.loads(urllib.urlopen(dept_url).read())
-    #         course_record = dept_data[4]
-    #         course_url = course_record[course_record.keys()[0]]['course_path']
-    #         print("Parsing: {}".format(course_url))
-    #         c = OCW.add_courseware(course_url)
-    #         print("Success creating courseware: {}".format(c))
-    #         counter = counter + 1
-    
+    # Whole departments, across every core: python catalog_runner.py physics mathematics
@@ -1,9 +1,19 @@
-import json
-import urllib
+from collections import OrderedDict
+import io
+import itertools
+import multiprocessing
+import threading
+
+from http_cache import HttpCache
+import json_stream
+
+
+# Courses per task sent to a worker process by parse_all and parse_departments
+CHUNK_SIZE = 16
 
 
 class OCW(object):
-    def __init__(self, department_url):
+    def __init__(self, department_url, stream=False, http_cache=None):
         """
         OCW provides courseware data in a JSON format organized by department. Each 
         department has a list of courses with metadata and file links  nested by type. 
@@ -11,24 +21,73 @@ class OCW(object):
         single course (ocw uids are keys) or loop through courses. Department URL
         example:  https://ocw.mit.edu/courses/biology/biology.json
 
+        With stream=True the department JSON is read from its on-disk cache file and
+        scanned incrementally; only an index of course uids to byte offsets is kept, and
+        each course is decoded on demand, so memory stays bounded for large departments.
+
         :param department_url: OCW endpoint for deparment JSON data 
+        :param stream: bool, index the department JSON instead of loading it whole
+        :param http_cache: http_cache.HttpCache for the download (defaults to .ocw_http_cache)
         
         Attributes
         ----------
         :department_url: OCW endpoint used to initiate object
-        :jdata: json data returned from the input url
+        :jdata: json data returned from the input url, ocw uid -> course in file order (None when streaming)
+        :index: ocw uid -> (offset, length) of each course in the spooled JSON (streaming only)
 
         Future work: automatically grab department Contentful ID
         """
         self.department_url = department_url
+        self.http_cache = http_cache or HttpCache()
+        self.jdata = None
+        self.index = None
+        self._handlers = dict()  # course key -> parse method, resolved once per key
         
-        #Munge department data so ocw uid are directly the keys of the json data
-        #Will allow us to parse one course at a time, or reparse a course to make updates/fix
-        jdata = json.loads(urllib.urlopen(department_url).read())
-        self.jdata = dict((v.keys()[0], v[v.keys()[0]]) for v in jdata)
+        if stream:
+            self._file = self.http_cache.open(department_url)
+            self._file_lock = threading.Lock()
+            self.index = dict()
+            self._order = []
+            for offset, length, v in json_stream.iter_array(self._file):
+                uid = v.keys()[0]
+                self.index[uid] = (offset, length)
+                self._order.append(uid)
+        else:
+            #Munge department data so ocw uid are directly the keys of the json data
+            #Will allow us to parse one course at a time, or reparse a course to make updates/fix
+            jdata = self.http_cache.get_json(department_url)
+            self.jdata = OrderedDict((v.keys()[0], v[v.keys()[0]]) for v in jdata)
 
         print("Parsing the following OCW endpoint: {}".format(department_url))
 
+    def close(self):
+        """
+        Close the cached department file held open when streaming.
+        """
+        if self.index is not None and not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def course_uids(self):
+        """
+        :return: list of ocw uids in the department, in file order.
+        """
+        if self.index is not None:
+            return list(self._order)
+        return list(self.jdata.keys())
+
+    def _course_datum(self, ocw_uid):
+        if self.index is None:
+            return self.jdata[ocw_uid]
+        offset, length = self.index[ocw_uid]
+        with self._file_lock:
+            return json_stream.read_at(self._file, offset, length)[ocw_uid]
+
     def parse_course(self, ocw_uid):
         """
         Given a specific ocw_uid, visitor pattern iteration through each object within 
@@ -42,14 +101,48 @@ class OCW(object):
         :param course_datum: a nested json object containing all relevant metadata and content links for a single course
         :returns: json data representing transformation of course_datum 
         """
-        course_datum = self.jdata[ocw_uid]
-        
+        return self.parse_datum(self._course_datum(ocw_uid))
+
+    def parse_datum(self, course_datum):
+        """
+        Parse an already decoded course (see parse_course), dispatching each key through
+        the handler table.
+        """
+        handlers = self._handlers
         record = dict()
         for k in course_datum:
-            parse = getattr(self, '_' + k, self._default)
+            parse = handlers.get(k)
+            if parse is None:
+                parse = handlers[k] = getattr(self, '_' + k, self._default)
             record[k] = parse(course_datum, k)
-        
         return record
+
+    def iter_courses(self):
+        """
+        Yield (ocw_uid, record) for every course in the department, parsing one course
+        at a time.
+        """
+        for ocw_uid in self.course_uids():
+            yield ocw_uid, self.parse_course(ocw_uid)
+
+    def parse_all(self, processes=None, chunk_size=CHUNK_SIZE):
+        """
+        Like iter_courses, with the courses parsed by a pool of worker processes in
+        chunks of chunk_size. Results come back in department order. When streaming,
+        workers decode their courses from the cached department file themselves, so
+        only offsets are sent to them.
+
+        :param processes: int, worker processes (defaults to one per core).
+        :return: generator of (ocw_uid, record).
+        """
+        if self.index is not None:
+            courses = [(ocw_uid,) + self.index[ocw_uid] for ocw_uid in self._order]
+            tasks = [(type(self), self._file.name, chunk) for chunk in _chunks(courses, chunk_size)]
+            parse = _parse_offsets
+        else:
+            tasks = [(type(self), None, chunk) for chunk in _chunks(self.jdata.items(), chunk_size)]
+            parse = _parse_data
+        return _imap(parse, tasks, processes)
     
     def _get_element(self, entry, key, default=None):
         value = entry.get(key, '_default')
@@ -76,6 +169,103 @@ class OCW(object):
         return entry[k]
 
 
+def parse_departments(department_urls, processes=None, chunk_size=CHUNK_SIZE, http_cache=None, parser_class=OCW):
+    """
+    Parse every course of several departments with one pool of worker processes. The
+    department files are fetched and indexed in parallel, then their courses are parsed
+    in chunks of chunk_size, so large and small departments keep every core busy.
+    Results come back in the order of department_urls and of the courses within each.
+
+    :param department_urls: OCW department JSON endpoints (or local paths).
+    :param processes: int, worker processes (defaults to one per core).
+    :param http_cache: http_cache.HttpCache for the downloads (defaults to .ocw_http_cache).
+    :param parser_class: OCW or a subclass with more handlers; it must be importable by the workers.
+    :return: generator of (department_url, ocw_uid, record).
+    """
+    http_cache = http_cache or HttpCache()
+    pool = _pool(processes)
+    try:
+        indexes = (pool.map if pool else map)(
+            _index_department, [(parser_class, url, http_cache) for url in department_urls])
+        tasks = [(parser_class, path, [(url,) + course for course in chunk])
+                 for url, (path, courses) in zip(department_urls, indexes)
+                 for chunk in _chunks(courses, chunk_size)]
+        results = (pool.imap if pool else itertools.imap)(_parse_department_offsets, tasks)
+        for url, ocw_uid, record in _flatten(results):
+            yield url, ocw_uid, record
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def _chunks(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _flatten(chunks):
+    for chunk in chunks:
+        for result in chunk:
+            yield result
+
+
+def _pool(processes):
+    # With a single process the work is done in this one, without pickling every record
+    if (processes or multiprocessing.cpu_count()) == 1:
+        return None
+    return multiprocessing.Pool(processes)
+
+
+def _imap(fn, tasks, processes):
+    pool = _pool(processes)
+    try:
+        for result in _flatten((pool.imap if pool else itertools.imap)(fn, tasks)):
+            yield result
+    finally:
+        if pool:
+            pool.terminate()
+
+
+# One parser per worker process and class, so each handler table is resolved once per process
+_worker_parsers = dict()
+
+
+def _worker_parser(parser_class):
+    parser = _worker_parsers.get(parser_class)
+    if parser is None:
+        # Handlers need no department data: skip __init__ and its download
+        parser = _worker_parsers[parser_class] = parser_class.__new__(parser_class)
+        parser._handlers = dict()
+    return parser
+
+
+def _index_department(task):
+    parser_class, department_url, http_cache = task
+    with parser_class(department_url, stream=True, http_cache=http_cache) as department:
+        return department._file.name, [(ocw_uid,) + department.index[ocw_uid] for ocw_uid in department._order]
+
+
+def _parse_offsets(task):
+    parser_class, path, chunk = task
+    parser = _worker_parser(parser_class)
+    with io.open(path, 'rb') as f:
+        return [(ocw_uid, parser.parse_datum(json_stream.read_at(f, offset, length)[ocw_uid]))
+                for ocw_uid, offset, length in chunk]
+
+
+def _parse_department_offsets(task):
+    parser_class, path, chunk = task
+    urls = [course[0] for course in chunk]
+    parsed = _parse_offsets((parser_class, path, [course[1:] for course in chunk]))
+    return [(url,) + result for url, result in zip(urls, parsed)]
+
+
+def _parse_data(task):
+    parser_class, path, chunk = task
+    parser = _worker_parser(parser_class)
+    return [(ocw_uid, parser.parse_datum(course_datum)) for ocw_uid, course_datum in chunk]
+
+
 if __name__ == "__main__":
     """
     Example of parsing a single course from the physics department.
@@ -85,3 +275,8 @@ if __name__ == "__main__":
     department = OCW('https://ocw.mit.edu/courses/physics/physics.json')
     record = department.parse_course('8-286-the-early-universe-fall-2013')
     pprint(record)
+
+    # Several departments at once, over every core
+    urls = ['https://ocw.mit.edu/courses/{0}/{0}.json'.format(d) for d in ['physics', 'mathematics']]
+    for url, ocw_uid, record in parse_departments(urls):
+        print(url, ocw_uid)
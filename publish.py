@@ -0,0 +1,199 @@
+'''
+Publishes the entries an import created or changed, with Contentful bulk actions.
+
+Usage:
+    publisher = Publisher(ocw.T)
+    ocw.add_courseware(url, workers=8)
+    publisher.publish()
+'''
+import json
+import threading
+import time
+
+from contentful_management.errors import get_error
+
+import secure
+
+
+# Entities a bulk action may hold
+BULK_MAX_ITEMS = 200
+# Bulk actions that may be in progress at once
+MAX_ACTIONS = 5
+# Ids per sys.id[in] query when versions are looked up
+LOOKUP_BATCH = 100
+
+
+class PublishTimeout(Exception):
+    pass
+
+
+class Publisher(object):
+    def __init__(self, translate, batch_size=BULK_MAX_ITEMS, poll_interval=1.0, max_attempts=3, timeout=600):
+        """
+        Collects the id and version of every entry translate creates, patches or saves
+        (it becomes translate.on_write) and publishes them with bulk publish actions of
+        up to batch_size entries, so going live costs a few batch calls instead of one
+        publish call per entry. Actions are polled until they finish; only the members
+        of a failed action that were rejected are retried, with their current version.
+
+        :param translate: contentful_mapping.Translate (or an AsyncTranslate given a sync client)
+            doing the import.
+        :param batch_size: entries per bulk action (at most BULK_MAX_ITEMS).
+        :param poll_interval: seconds between status polls of running actions.
+        :param max_attempts: bulk publishes an entry gets before it is reported as failed.
+        :param timeout: seconds an action may take before PublishTimeout is raised.
+        """
+        if translate.client is None:
+            raise ValueError('Publisher needs a Translate with a Contentful client (AsyncTranslate(client=...))')
+        self.T = translate
+        self.client = translate.client
+        self.metrics = translate.metrics
+        self.batch_size = min(batch_size, BULK_MAX_ITEMS)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.bulk_url = 'spaces/{}/environments/{}/bulk_actions'.format(secure.SPACE_ID, secure.ENVIRONMENT_ID)
+        self._pending = dict()  # entry id -> version to publish (None: look it up)
+        self._lock = threading.Lock()
+        translate.on_write = self.record
+
+    def record(self, entry):
+        """
+        Queue an entry for publishing at its current version.
+        """
+        entry_uid = entry.sys['id']
+        version = entry.sys.get('version')
+        with self._lock:
+            if self._pending.get(entry_uid) is None or version > self._pending[entry_uid]:
+                self._pending[entry_uid] = version
+
+    def add(self, entry_uids):
+        """
+        Queue entries by id, e.g. drafts left by an earlier run; their versions are
+        looked up when they are published.
+        """
+        with self._lock:
+            for entry_uid in entry_uids:
+                self._pending.setdefault(entry_uid, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def publish(self):
+        """
+        Publish every queued entry. Entries that still fail after max_attempts stay
+        queued for the next call.
+
+        :return: dict with published (number of entries) and failed ({entry id: error id}).
+        """
+        with self._lock:
+            queued = dict(self._pending)
+        published = 0
+        errors = dict()
+        todo = queued
+        with self.metrics.step('publish', entries=len(queued)):
+            for attempt in range(self.max_attempts):
+                if not todo:
+                    break
+                todo, missing = self._with_versions(todo)
+                errors = self._run(todo)
+                errors.update(missing)
+                for entry_uid in todo:
+                    if entry_uid not in errors:
+                        published += 1
+                        self._published(entry_uid, todo[entry_uid])
+                # Retry the rejected members with their current versions
+                todo = dict((entry_uid, None) for entry_uid in errors if entry_uid not in missing)
+                if todo:
+                    print("Retrying publish of {} entries: {}".format(len(todo), sorted(set(errors.values()))))
+
+        with self._lock:
+            for entry_uid, version in queued.items():
+                if entry_uid not in errors and self._pending.get(entry_uid) == version:
+                    del self._pending[entry_uid]
+        return dict(published=published, failed=errors)
+
+    def _published(self, entry_uid, version):
+        # Publishing bumps the version; keep the cached entry saveable
+        entry = self.T.entry_cache.get(entry_uid)
+        if entry is not None and entry.sys.get('version') == version:
+            entry.sys['version'] = version + 1
+        if getattr(self.T, 'mirror', None) is not None:
+            self.T.mirror.published(entry_uid, version)
+
+    def _with_versions(self, todo):
+        """
+        :return: (todo with every version filled in, {entry id: 'NotFound'} for ids not in the space)
+        """
+        unknown = sorted(entry_uid for entry_uid, version in todo.items() if version is None)
+        todo = dict((entry_uid, version) for entry_uid, version in todo.items() if version is not None)
+        for i in range(0, len(unknown), LOOKUP_BATCH):
+            batch = unknown[i:i + LOOKUP_BATCH]
+            for entry in self.T.entries_client.all({
+                    'sys.id[in]': ','.join(batch), 'select': 'sys', 'limit': len(batch)}):
+                todo[entry.sys['id']] = entry.sys['version']
+        missing = dict((entry_uid, 'NotFound') for entry_uid in unknown if entry_uid not in todo)
+        return todo, missing
+
+    def _run(self, todo):
+        """
+        Publish todo ({entry id: version}) in bulk actions, at most MAX_ACTIONS at a time.
+
+        :return: {entry id: error id} for the rejected members.
+        """
+        ids = sorted(todo)
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        running = []  # (action id, batch, started)
+        errors = dict()
+        while batches or running:
+            while batches and len(running) < MAX_ACTIONS:
+                batch = batches.pop(0)
+                running.append((self._start(batch, todo), batch, time.time()))
+            still_running = []
+            for action_id, batch, started in running:
+                action = self._request('get', '{}/actions/{}'.format(self.bulk_url, action_id))
+                status = action['sys']['status']
+                if status == 'succeeded':
+                    continue
+                if status == 'failed':
+                    errors.update(_failed_members(action, batch))
+                elif time.time() - started > self.timeout:
+                    raise PublishTimeout('Bulk action {} still {} after {}s'.format(action_id, status, self.timeout))
+                else:
+                    still_running.append((action_id, batch, started))
+            running = still_running
+            if running:
+                time.sleep(self.poll_interval)
+        return errors
+
+    def _start(self, batch, todo):
+        """
+        :return: id of a new bulk publish action for batch.
+        """
+        items = [{'sys': {'type': 'Link', 'linkType': 'Entry', 'id': entry_uid, 'version': todo[entry_uid]}}
+                 for entry_uid in batch]
+        action = self._request('post', '{}/publish'.format(self.bulk_url),
+                               {'entities': {'sys': {'type': 'Array'}, 'items': items}})
+        return action['sys']['id']
+
+    def _request(self, method, url, body=None):
+        kwargs = {}
+        if body is not None:
+            kwargs['data'] = json.dumps(body)
+        response = self.client._http_request(method, url, kwargs)
+        if response.status_code >= 300:
+            raise get_error(response)
+        return response.json()
+
+
+def _failed_members(action, batch):
+    """
+    :return: {entry id: error id} from a failed bulk action; every member if it names none.
+    """
+    error = action.get('error') or {}
+    details = (error.get('details') or {}).get('errors') or []
+    failed = dict((e['entity']['sys']['id'], e.get('error', {}).get('sys', {}).get('id', 'Unknown'))
+                  for e in details if e.get('entity'))
+    if not failed:
+        failed = dict((entry_uid, error.get('sys', {}).get('id', 'BulkActionFailed')) for entry_uid in batch)
+    return failed
@@ -0,0 +1,82 @@
+'''
+Catalog-wide index of the _master.json key for each course prefix in the OCW bucket.
+'''
+import json
+import os
+import threading
+
+
+MASTER_SUFFIX = '_master.json'
+
+
+class MasterKeyIndex(object):
+    def __init__(self, s3, bucket, path='ocw_master_index.json'):
+        """
+        Maps each course prefix in the bucket (the first path component of its keys,
+        e.g. 8-01-classical-mechanics-fall-2016) to the key, ETag and size of its
+        _master.json. The whole bucket is listed once with a paginated scan and the
+        result is persisted, so looking up a course costs no S3 call at all.
+
+        :param s3: boto3 S3 client (works against moto or any local S3 stand-in).
+        :param bucket: str, bucket holding OCW data organized by course.
+        :param path: JSON file the index is persisted to; None keeps it in memory only.
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.path = path
+        self._lock = threading.Lock()
+        self.courses = dict()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.courses = json.load(f)
+
+    def refresh(self):
+        """
+        Scan the bucket and bring the index up to date. ETags are compared with the
+        previous scan so callers can re-sync only the courses whose master file changed.
+
+        :return: sorted list of course prefixes that were added, changed or removed.
+        """
+        scanned = dict()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if not key.endswith(MASTER_SUFFIX):
+                    continue
+                scanned[key.split('/')[0]] = {
+                    'key': key,
+                    'etag': obj['ETag'].strip('"'),
+                    'size': obj['Size'],
+                }
+
+        with self._lock:
+            changed = set(p for p in scanned if self.courses.get(p, {}).get('etag') != scanned[p]['etag'])
+            changed.update(p for p in self.courses if p not in scanned)
+            self.courses = scanned
+            self.save()
+        return sorted(changed)
+
+    def get(self, prefix):
+        """
+        :return: dict with key, etag and size of the course master file, or None.
+        """
+        return self.courses.get(prefix)
+
+    def etag(self, prefix):
+        course = self.get(prefix)
+        return course['etag'] if course else None
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.courses, f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def __contains__(self, prefix):
+        return prefix in self.courses
+
+    def __len__(self):
+        return len(self.courses)
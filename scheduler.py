@@ -0,0 +1,207 @@
+'''
+Central scheduler for Contentful Management API requests: a token bucket fed by the
+rate-limit response headers, exponential backoff with jitter on 429/5xx, and AIMD
+concurrency that settles at the largest rate the space's plan allows.
+'''
+import random
+import threading
+import time
+
+import contentful_management
+from contentful_management.errors import RateLimitExceededError
+import requests
+from tornado import gen
+
+from metrics import default_metrics, request_resource
+
+
+LIMIT_HEADER = 'X-Contentful-RateLimit-Second-Limit'
+REMAINING_HEADER = 'X-Contentful-RateLimit-Second-Remaining'
+RESET_HEADER = 'X-Contentful-RateLimit-Reset'
+
+
+def _status(response):
+    # requests.Response or tornado HTTPResponse
+    return getattr(response, 'status_code', None) or getattr(response, 'code', None)
+
+
+class RequestScheduler(object):
+    def __init__(self, rate=10.0, concurrency=4, max_concurrency=64, max_retries=8,
+                 base_delay=0.25, max_delay=60.0):
+        """
+        :param rate: requests per second allowed before any response says otherwise
+            (replaced by the X-Contentful-RateLimit-Second-Limit header once seen).
+        :param concurrency: starting number of requests in flight.
+        :param max_concurrency: ceiling for the additive increase.
+        :param max_retries: retries of a throttled (429), failed (5xx) or unreachable request.
+        :param base_delay: first backoff delay in seconds, doubled on every retry.
+        :param max_delay: largest backoff delay in seconds.
+        """
+        self.rate = float(rate)
+        self.tokens = float(rate)
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.stats = dict(requests=0, throttled=0, server_errors=0, retries=0)
+        self._refilled_at = time.time()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        """
+        Take a concurrency slot and a token if both are free.
+
+        :return: 0 when acquired, otherwise seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.time()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self.tokens = min(self.rate, self.tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self.in_flight >= int(self.limit):
+                return 0.01
+            if self.tokens < 1.0:
+                return (1.0 - self.tokens) / self.rate
+            self.tokens -= 1.0
+            self.in_flight += 1
+            self.stats['requests'] += 1
+            return 0
+
+    def _release(self, response):
+        """
+        Give back the slot and adapt rate and concurrency to the response.
+
+        :return: seconds to wait before retrying, or None if the response is final.
+        """
+        status = _status(response) if response is not None else None
+        headers = getattr(response, 'headers', None) or {}
+        with self._lock:
+            self.in_flight -= 1
+            if headers.get(LIMIT_HEADER):
+                self.rate = float(headers[LIMIT_HEADER])
+            if headers.get(REMAINING_HEADER) is not None:
+                self.tokens = min(self.tokens, float(headers[REMAINING_HEADER]))
+
+            if status is not None and status != 429 and status < 500:
+                # Additive increase: about one more slot per window of successful requests
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                return None
+
+            # Multiplicative decrease on throttling, server errors and connection failures
+            self.limit = max(1.0, self.limit / 2)
+            if status == 429:
+                self.stats['throttled'] += 1
+                self.tokens = 0.0
+                reset = headers.get(RESET_HEADER)
+                if reset:
+                    self._paused_until = max(self._paused_until, time.time() + float(reset))
+            elif status is not None:
+                self.stats['server_errors'] += 1
+            return 0.0
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs), which sends one request and returns its response, under
+        the rate and concurrency limits, retrying 429/5xx responses and IOErrors.
+
+        :return: the final response (still a 429/5xx one if all retries were used).
+        """
+        for attempt in range(self.max_retries + 1):
+            wait = self._try_acquire()
+            while wait:
+                time.sleep(wait)
+                wait = self._try_acquire()
+
+            try:
+                response = fn(*args, **kwargs)
+            except IOError:
+                self._release(None)
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if self._release(response) is None or attempt == self.max_retries:
+                    return response
+            with self._lock:
+                self.stats['retries'] += 1
+            time.sleep(self._backoff(attempt))
+
+    @gen.coroutine
+    def call_async(self, fn, *args, **kwargs):
+        """
+        Coroutine version of call for fn returning a future of a tornado HTTPResponse
+        (fetched with raise_error=False; connection failures arrive as code 599).
+        """
+        for attempt in range(self.max_retries + 1):
+            wait = self._try_acquire()
+            while wait:
+                yield gen.sleep(wait)
+                wait = self._try_acquire()
+
+            response = yield fn(*args, **kwargs)
+            if self._release(response) is None or attempt == self.max_retries:
+                raise gen.Return(response)
+            with self._lock:
+                self.stats['retries'] += 1
+            yield gen.sleep(self._backoff(attempt))
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    The process-wide scheduler shared by every client that is not given its own.
+    """
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
+
+
+class ScheduledClient(contentful_management.Client):
+    def __init__(self, access_token, scheduler=None, session=None, metrics=None, **kwargs):
+        """
+        contentful_management.Client whose HTTP requests all go through a
+        RequestScheduler, over one pooled keep-alive requests.Session. The library's own
+        rate-limit retry is disabled; the scheduler handles 429s instead.
+
+        :param scheduler: RequestScheduler (defaults to default_scheduler()).
+        :param session: requests.Session to send with.
+        :param metrics: metrics.Metrics timing each request (defaults to default_metrics()).
+        """
+        kwargs.setdefault('max_rate_limit_retries', 0)
+        super(ScheduledClient, self).__init__(access_token, **kwargs)
+        self.scheduler = scheduler or default_scheduler()
+        self.session = session or requests.Session()
+        self.metrics = metrics or default_metrics()
+
+    def _http_request(self, method, url, request_kwargs=None):
+        kwargs = request_kwargs if request_kwargs is not None else {}
+
+        headers = self._request_headers()
+        headers.update(self.additional_headers)
+        if 'headers' in kwargs:
+            headers.update(kwargs['headers'])
+        kwargs['headers'] = headers
+
+        if self._has_proxy():
+            kwargs['proxies'] = self._proxy_parameters()
+
+        request_url = self._url(url, file_upload=kwargs.pop('file_upload', False))
+        started = time.time()
+        response = self.scheduler.call(self.session.request, method.upper(), request_url, **kwargs)
+        self.metrics.observe_request('contentful', method.upper(), request_resource(url),
+                                     response.status_code, time.time() - started)
+
+        if response.status_code == 429:
+            raise RateLimitExceededError(response)
+        return response
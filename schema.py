@@ -0,0 +1,193 @@
+'''
+Entry mappers compiled from Contentful content type schemas, with local validation.
+'''
+import re
+
+
+DEFAULT_LOCALE = 'en-US'
+
+# Hard limits Contentful applies to text fields regardless of their validations
+MAX_LENGTH = {'Symbol': 256, 'Text': 50000}
+
+
+class ValidationError(ValueError):
+    """
+    A payload that Contentful would reject with a 422, caught before any request.
+    """
+    def __init__(self, content_type_id, errors):
+        self.content_type_id = content_type_id
+        self.errors = errors
+        super(ValidationError, self).__init__(
+            "Invalid {} entry: {}".format(content_type_id, "; ".join(errors)))
+
+
+def to_camel_case(string):
+    components = string.replace('-', '_').split('_')
+    return components[0] + ''.join(x.title() for x in components[1:])
+
+
+def _link(resource_id, link_type='Entry'):
+    return {'sys': {'type': 'Link', 'linkType': link_type, 'id': resource_id}}
+
+
+class FieldMapper(object):
+    def __init__(self, field, truncate=True):
+        """
+        Converts values for one content type field, as described by its schema
+        (the raw JSON of a content type field), and checks them against its validations.
+
+        :param truncate: cut text longer than the field allows instead of rejecting it.
+        """
+        self.id = field['id']
+        self.type = field['type']
+        self.required = field.get('required', False)
+        self.disabled = field.get('disabled', False) or field.get('omitted', False)
+        self.items_type = field.get('items', {}).get('type')
+        self.link_type = field.get('linkType') or field.get('items', {}).get('linkType') or 'Entry'
+        self.truncate = truncate
+
+        validations = list(field.get('validations', []))
+        if self.type == 'Array':
+            item_validations = field.get('items', {}).get('validations', [])
+        else:
+            item_validations = validations
+
+        value_type = self.items_type if self.type == 'Array' else self.type
+        self.max_length = MAX_LENGTH.get(value_type)
+        self.min_length = None
+        self.max_items = None
+        self.min_items = None
+        self.allowed = None
+        self.pattern = None
+        for v in item_validations:
+            if 'size' in v and value_type in MAX_LENGTH:
+                if v['size'].get('max') is not None:
+                    self.max_length = min(self.max_length, v['size']['max'])
+                self.min_length = v['size'].get('min')
+            if 'in' in v:
+                self.allowed = frozenset(v['in'])
+            if 'regexp' in v:
+                self.pattern = re.compile(v['regexp']['pattern'], re.UNICODE)
+        if self.type == 'Array':
+            for v in validations:
+                if 'size' in v:
+                    self.max_items = v['size'].get('max')
+                    self.min_items = v['size'].get('min')
+
+        # Text that needs no check beyond its length takes the short path in _text
+        self._plain = self.min_length is None and self.allowed is None and self.pattern is None
+        self.convert = {
+            'Symbol': self._text,
+            'Text': self._text,
+            'Link': self._single_link,
+            'Array': self._links if self.items_type == 'Link' else self._symbols,
+        }.get(self.type, self._other)
+
+    def _check_text(self, value):
+        if not isinstance(value, basestring):
+            raise ValueError("expected text, got {}".format(type(value).__name__))
+        if self.max_length is not None and len(value) > self.max_length:
+            if not self.truncate:
+                raise ValueError("longer than {} characters".format(self.max_length))
+            value = value[0:self.max_length]
+        if self.min_length is not None and len(value) < self.min_length:
+            raise ValueError("shorter than {} characters".format(self.min_length))
+        if self.allowed is not None and value not in self.allowed:
+            raise ValueError("{!r} is not one of the allowed values".format(value))
+        if self.pattern is not None and not self.pattern.search(value):
+            raise ValueError("does not match {}".format(self.pattern.pattern))
+        return value
+
+    def _text(self, value):
+        if not value:
+            if value is None or value == '':
+                return None
+        elif self._plain and type(value) is unicode and len(value) <= self.max_length:
+            return {DEFAULT_LOCALE: value}
+        return {DEFAULT_LOCALE: self._check_text(value)}
+
+    def _single_link(self, value):
+        if value is None:
+            return None
+        if not hasattr(value, 'sys'):
+            raise ValueError("expected a single entry, got {}".format(type(value).__name__))
+        return {DEFAULT_LOCALE: _link(value.sys['id'], self.link_type)}
+
+    def _check_items(self, items):
+        if self.max_items is not None and len(items) > self.max_items:
+            raise ValueError("more than {} items".format(self.max_items))
+        if self.min_items is not None and len(items) < self.min_items:
+            raise ValueError("fewer than {} items".format(self.min_items))
+
+    def _links(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, list):
+            raise ValueError("expected a list of entries, got {}".format(type(value).__name__))
+        items = [l for l in value if l]
+        for l in items:
+            if not hasattr(l, 'sys'):
+                raise ValueError("expected entries, got {}".format(type(l).__name__))
+        self._check_items(items)
+        return {DEFAULT_LOCALE: [_link(l.sys['id'], self.link_type) for l in items]}
+
+    def _symbols(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, list):
+            raise ValueError("expected a list, got {}".format(type(value).__name__))
+        items = [self._check_text(v) for v in value if v]
+        self._check_items(items)
+        return {DEFAULT_LOCALE: items}
+
+    def _other(self, value):
+        return {DEFAULT_LOCALE: value} if value is not None else None
+
+
+class EntryMapper(object):
+    def __init__(self, content_type, truncate=True):
+        """
+        Maps snake_case entry attributes to the fields payload of one content type.
+        Field names, kinds and limits are resolved once here, so mapping an entry is a
+        dict lookup and one converter call per attribute. Unknown fields, values of the
+        wrong kind, missing required fields and failed validations raise ValidationError.
+
+        :param content_type: raw JSON of the content type (with 'sys' and 'fields').
+        :param truncate: cut text longer than its field allows (e.g. 200-character
+            YouTube ids, 250-character locations) instead of rejecting the entry.
+        """
+        self.content_type_id = content_type['sys']['id']
+        self.fields = dict((f['id'], FieldMapper(f, truncate)) for f in content_type['fields'])
+        self.required = [f.id for f in self.fields.values() if f.required and not f.disabled]
+        self._by_attribute = dict()  # attribute name -> FieldMapper (None if unknown)
+
+    def field(self, name):
+        try:
+            return self._by_attribute[name]
+        except KeyError:
+            field = self._by_attribute[name] = self.fields.get(to_camel_case(name))
+            return field
+
+    def map(self, entry_attributes):
+        """
+        :return: fields payload ({fieldId: {locale: value}}).
+        :raises ValidationError: listing every problem found in the entry.
+        """
+        fields = dict()
+        errors = []
+        by_attribute = self._by_attribute
+        for name, value in entry_attributes.iteritems():
+            field = by_attribute[name] if name in by_attribute else self.field(name)
+            if field is None:
+                errors.append("{}: no such field".format(name))
+                continue
+            try:
+                fields[field.id] = field.convert(value)
+            except ValueError as e:
+                errors.append("{}: {}".format(field.id, e))
+        for field_id in self.required:
+            if fields.get(field_id) is None:
+                errors.append("{}: required".format(field_id))
+        if errors:
+            raise ValidationError(self.content_type_id, errors)
+        return fields